@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 
 from pathlib import Path, os
 from datetime import timedelta
-from decouple import config
+from decouple import Csv, config
 
 
 
@@ -62,6 +62,7 @@ ROOT_URLCONF = 'ShopZone.urls'
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'products.replicas.PrimaryPinMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     "corsheaders.middleware.CorsMiddleware",
@@ -95,13 +96,101 @@ WSGI_APPLICATION = 'ShopZone.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
 
+# Configured from the environment; defaults to the local SQLite file. For
+# Postgres set DB_ENGINE=django.db.backends.postgresql and the DB_* below.
+# Django 5.0 has no built-in pool: connections are kept open for
+# DB_CONN_MAX_AGE seconds, and a pooler such as PgBouncer can sit in front
+# (set DB_DISABLE_SERVER_SIDE_CURSORS with transaction pooling).
+
+DB_ENGINE = config('DB_ENGINE', default='django.db.backends.sqlite3')
+
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'ENGINE': DB_ENGINE,
+        'NAME': config('DB_NAME', default=str(BASE_DIR / 'db.sqlite3')),
+        'USER': config('DB_USER', default=''),
+        'PASSWORD': config('DB_PASSWORD', default=''),
+        'HOST': config('DB_HOST', default=''),
+        'PORT': config('DB_PORT', default=''),
+        'CONN_MAX_AGE': config('DB_CONN_MAX_AGE', default=60, cast=int),
+        'CONN_HEALTH_CHECKS': config('DB_CONN_HEALTH_CHECKS', default=True, cast=bool),
+        'DISABLE_SERVER_SIDE_CURSORS': config('DB_DISABLE_SERVER_SIDE_CURSORS', default=False, cast=bool),
     }
 }
 
+# Opt-in tuning for single-node SQLite deployments (see
+# products.backends.sqlite3): WAL, synchronous=NORMAL, BEGIN IMMEDIATE and
+# queued writes. mmap_size is in bytes, cache_size follows SQLite (negative
+# values are KiB) and the busy timeout is in milliseconds.
+
+SQLITE_TUNING = config('SQLITE_TUNING', default=False, cast=bool)
+SQLITE_MMAP_SIZE = config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)
+SQLITE_CACHE_SIZE = config('SQLITE_CACHE_SIZE', default=-64 * 1024, cast=int)
+SQLITE_BUSY_TIMEOUT = config('SQLITE_BUSY_TIMEOUT', default=5000, cast=int)
+
+if SQLITE_TUNING and DB_ENGINE == 'django.db.backends.sqlite3':
+    DATABASES['default']['ENGINE'] = 'products.backends.sqlite3'
+
+# Comma-separated read replicas (see products.replicas): hosts, or database
+# files for SQLite, e.g. DB_REPLICAS=replica.sqlite3 to try routing locally
+# against a copy of db.sqlite3. Tests run them against the test database.
+
+DATABASE_REPLICAS = []
+for index, replica in enumerate(config('DB_REPLICAS', default='', cast=Csv()), start=1):
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'NAME' if DB_ENGINE.endswith('sqlite3') else 'HOST': replica,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['products.replicas.ReplicaRouter']
+
+# Seconds a client that wrote keeps reading from the primary, covering replica lag
+
+DB_REPLICA_PIN_SECONDS = config('DB_REPLICA_PIN_SECONDS', default=5, cast=int)
+
+# Cache
+# https://docs.djangoproject.com/en/5.0/topics/cache/
+# Set CACHE_URL (e.g. redis://127.0.0.1:6379/1) to share the cache between
+# workers; without it each process keeps its own in-memory cache, and cache
+# invalidation (response caches, the category registry) does not reach the
+# other workers. Multi-process deployments must set it.
+
+CACHE_URL = config('CACHE_URL', default='')
+
+if CACHE_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'shopzone',
+        }
+    }
+
+# Cache alias and TTL (seconds) for the public catalogue responses
+CATALOGUE_CACHE_ALIAS = 'default'
+CATALOGUE_CACHE_TIMEOUT = config('CATALOGUE_CACHE_TIMEOUT', default=300, cast=int)
+
+# Minutes a cart holds stock for the products added to it
+
+STOCK_RESERVATION_TTL = config('STOCK_RESERVATION_TTL', default=15, cast=int)
+
+# Cart storage engine: 'db', 'memory' or 'redis' (see products.carts). Hash
+# stores write carts back to the database at checkout and on flush_carts.
+
+CART_STORE = config('CART_STORE', default='db')
+CART_STORE_URL = config('CART_STORE_URL', default=CACHE_URL)
+# Seconds an untouched cart stays in Redis
+CART_STORE_TTL = config('CART_STORE_TTL', default=7 * 24 * 60 * 60, cast=int)
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
 EMAIL_PORT = 587
@@ -152,6 +241,43 @@ USE_TZ = True
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Product images are stored once per distinct content, named by their SHA-256
+
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+    'products': {'BACKEND': 'products.storage.ContentAddressedStorage'},
+}
+
+# How media files are sent: 'python' streams them from Django, 'x-accel-redirect'
+# (nginx) and 'x-sendfile' (Apache, lighttpd) hand them to the front proxy
+
+MEDIA_SERVE_MODE = config('MEDIA_SERVE_MODE', default='python')
+
+# Internal nginx location mapped to MEDIA_ROOT, used with 'x-accel-redirect'
+
+MEDIA_ACCEL_REDIRECT_PREFIX = config('MEDIA_ACCEL_REDIRECT_PREFIX', default='/protected-media/')
+
+# Seconds clients may cache media that is not content-addressed
+
+MEDIA_CACHE_MAX_AGE = config('MEDIA_CACHE_MAX_AGE', default=3600, cast=int)
+
+# Widths, in pixels, of the resized copies made of every product image
+
+PRODUCT_IMAGE_WIDTHS = (160, 320, 640, 1280)
+
+# Width, in pixels, of the product image variant shown in catalogue listings
+
+PRODUCT_THUMBNAIL_WIDTH = 320
+
+# Number of background threads generating product image variants
+
+PRODUCT_IMAGE_WORKERS = config('PRODUCT_IMAGE_WORKERS', default=2, cast=int)
+
+
+# Upper bounds of the catalogue's price facet buckets; the last bucket is open-ended
+
+PRODUCT_PRICE_BUCKETS = (500, 1000, 5000, 10000, 50000)
 
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [
@@ -267,3 +393,27 @@ MPESA_INITIATOR_USERNAME = 'testapi'
 # Plaintext password for initiator (to be used in B2C, B2B, AccountBalance and TransactionStatusQuery Transactions)
 
 MPESA_INITIATOR_SECURITY_CREDENTIAL = 'Safaricom999!*!'
+
+# Daraja base URL override, e.g. a local fake server; empty uses MPESA_ENVIRONMENT's URL
+
+MPESA_API_BASE_URL = config('MPESA_API_BASE_URL', default='')
+
+# URL Daraja posts STK push results to
+
+MPESA_CALLBACK_URL = config('MPESA_CALLBACK_URL', default='https://api.darajambili.com/express-payment')
+
+# Secret appended to MPESA_CALLBACK_URL as ?token=; results without it are refused
+
+MPESA_CALLBACK_TOKEN = config('MPESA_CALLBACK_TOKEN', default='')
+
+# Addresses results may come from (Safaricom's callback IPs); empty accepts any
+
+MPESA_CALLBACK_ALLOWED_IPS = config('MPESA_CALLBACK_ALLOWED_IPS', default='', cast=Csv())
+
+# Number of background threads performing STK pushes (also the HTTP connection pool size)
+
+MPESA_WORKERS = config('MPESA_WORKERS', default=4, cast=int)
+
+# Seconds to wait for Daraja before giving up on a request
+
+MPESA_HTTP_TIMEOUT = config('MPESA_HTTP_TIMEOUT', default=10, cast=int)
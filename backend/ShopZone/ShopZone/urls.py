@@ -4,12 +4,17 @@ from rest_framework.schemas import get_schema_view
 
 schema_view = get_schema_view(title="Django Ecommerce API")
 
+import re
+
+from django.conf import settings
 from django.contrib import admin
 from django.urls import path, re_path, include
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
 
+from products import media
+
 schema_view = get_schema_view(
     openapi.Info(
         title="Django  ecommerce API",
@@ -40,6 +45,8 @@ urlpatterns = [
     re_path(r'^swagger(?P<format>\.json|\.yaml)$', schema_view.without_ui(cache_timeout=0), name='schema-json'),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
+    # Served in every environment; see products.media for handing files to the front proxy
+    re_path(r'^%s(?P<path>.+)$' % re.escape(settings.MEDIA_URL.lstrip('/')), media.serve, name='media'),
 ]
 
 # urlpatterns += [re_path(r'^.*', TemplateView.as_view(template_name='index.html'))]
\ No newline at end of file
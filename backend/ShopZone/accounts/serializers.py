@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import authenticate
+from django.contrib.auth.signals import user_logged_in
 from .models import CustomUser
 
 
@@ -40,6 +41,9 @@ class RegisterCustomerSerializer(serializers.ModelSerializer):
 class LoginSerializer(serializers.Serializer):
     email = serializers.EmailField()
     password = serializers.CharField()
+    # An anonymous cart to hand over to the user (see products.signals)
+    cart = serializers.IntegerField(required=False)
+    cart_token = serializers.UUIDField(required=False)
 
     def validate(self, data):
         email = data.get('email')
@@ -61,6 +65,10 @@ class LoginSerializer(serializers.Serializer):
     def create(self, validated_data):
         user = validated_data['user']
         refresh = RefreshToken.for_user(user)
+        user_logged_in.send(
+            sender=user.__class__, request=self.context.get('request'), user=user,
+            cart=validated_data.get('cart'), cart_token=validated_data.get('cart_token'),
+        )
 
         return {
             'refresh': str(refresh),
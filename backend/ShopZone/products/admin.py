@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Product, Category, Cart, CartItem, ContactInfo, Order, OrderItem
+from .models import Product, Category, Cart, CartItem, ContactInfo, Order, OrderItem, Payment, PaymentCallback, StockReservation
 # Register your models here.
 
 admin.site.register(Product)
@@ -8,4 +8,7 @@ admin.site.register(Cart)
 admin.site.register(CartItem)
 admin.site.register(ContactInfo)
 admin.site.register(Order)
-admin.site.register(OrderItem)
\ No newline at end of file
+admin.site.register(OrderItem)
+admin.site.register(Payment)
+admin.site.register(PaymentCallback)
+admin.site.register(StockReservation)
\ No newline at end of file
@@ -0,0 +1,245 @@
+"""
+Bulk product import and export.
+
+Imports read CSV or JSONL incrementally and write products in chunks: each
+chunk is validated row by row, then inserted with one `bulk_create` and
+updated with one `bulk_update` inside its own transaction. Rows that fail
+validation are reported with their line number and skipped, so one bad row
+does not sink a 200k-row catalogue. Categories are resolved through the
+cached name -> id registry; unknown names are created in bulk.
+
+Updates are partial: only the columns a row carries (and fills in) are
+written, so a CSV of just `id,stock` restocks products without touching
+their names or images. New products need a name, price and category.
+
+Exports stream rows straight from a server-side cursor (`iterator()`), so
+memory use does not grow with the catalogue.
+
+Bulk writes skip model signals, so both directions announce their changes
+through `signals.products_bulk_changed` instead, and imports queue image
+variants themselves for rows whose image is new.
+"""
+import csv
+import io
+import json
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+
+from . import facets, images
+from .categories import registry as category_registry
+from .models import Product
+from .signals import products_bulk_changed
+
+FORMATS = ('csv', 'jsonl')
+COLUMNS = ['id', 'name', 'description', 'price', 'stock', 'category', 'image']
+IMPORT_CHUNK_SIZE = 1000
+EXPORT_CHUNK_SIZE = 2000
+# Errors beyond this many are counted but not listed
+MAX_REPORTED_ERRORS = 1000
+# Columns a new product cannot do without, and what the others default to
+CREATE_REQUIRED = ('name', 'price', 'category')
+CREATE_DEFAULTS = {'description': '', 'stock': 0, 'image': ''}
+
+
+class ProductRowSerializer(serializers.Serializer):
+    id = serializers.IntegerField(required=False, allow_null=True, min_value=1)
+    name = serializers.CharField(required=False, max_length=200)
+    description = serializers.CharField(required=False, allow_blank=True)
+    price = serializers.DecimalField(required=False, max_digits=8, decimal_places=2, min_value=Decimal('0'))
+    stock = serializers.IntegerField(required=False, min_value=0)
+    category = serializers.CharField(required=False, max_length=200)
+    image = serializers.CharField(required=False, allow_blank=True, max_length=100)
+
+    def to_internal_value(self, data):
+        # CSV cells are strings; treat empty optional cells as missing
+        data = {key: value for key, value in data.items() if key and value not in ('', None)}
+        return super().to_internal_value(data)
+
+    def validate(self, data):
+        # Rows with an id may still create a product if it does not exist; `_write_chunk` checks those
+        if not data.get('id'):
+            errors = create_errors(data)
+            if errors:
+                raise serializers.ValidationError(errors)
+        return data
+
+
+def create_errors(row):
+    """
+    Return the errors that keep `row` from creating a product, if any.
+    """
+    return {field: ['This field is required.'] for field in CREATE_REQUIRED if field not in row}
+
+
+class ImportResult:
+
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, errors):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'errors': errors})
+
+    def as_dict(self):
+        return {'created': self.created, 'updated': self.updated, 'failed': self.failed, 'errors': self.errors}
+
+
+def read_rows(stream, format):
+    """
+    Yield (line number, row dict) pairs from a binary or text stream.
+    """
+    if isinstance(stream.read(0), bytes):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if format == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+    elif format == 'jsonl':
+        for line, text in enumerate(stream, start=1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as ex:
+                row = ex
+            yield line, row
+    else:
+        raise ValueError(f'Unsupported format {format!r}; use one of {", ".join(FORMATS)}.')
+
+
+def import_products(stream, format, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Create or update products from a CSV or JSONL stream. Rows with an `id`
+    of an existing product update it; other rows create new products.
+
+    Returns:
+    - ImportResult: Counts of created, updated and failed rows, with errors by line.
+    """
+    result = ImportResult()
+    # One serializer validates every row; building one per row deep-copies its fields each time
+    validator = ProductRowSerializer()
+    chunk = []
+    for line, row in read_rows(stream, format):
+        if not isinstance(row, dict):
+            result.error(line, {'non_field_errors': [str(row) if isinstance(row, ValueError) else 'Expected an object.']})
+            continue
+        try:
+            chunk.append((line, validator.run_validation(row)))
+        except serializers.ValidationError as ex:
+            result.error(line, ex.detail)
+            continue
+        if len(chunk) >= chunk_size:
+            _write_chunk(chunk, result)
+            chunk = []
+    if chunk:
+        _write_chunk(chunk, result)
+    return result
+
+
+def _write_chunk(rows, result):
+    with transaction.atomic():
+        ids = [row['id'] for line, row in rows if row.get('id')]
+        # Updates start from the current row, so columns missing from the import keep their values
+        existing = {}
+        if ids:
+            current = Product.objects.select_for_update().filter(pk__in=ids).only(
+                'name', 'description', 'price', 'stock', 'reserved', 'category_id', 'image'
+            )
+            existing = {product.pk: product for product in current}
+
+        accepted = []
+        for line, row in rows:
+            product = existing.get(row.get('id'))
+            errors = create_errors(row) if product is None else {}
+            if product is not None and row.get('stock', product.stock) < product.reserved:
+                errors['stock'] = [f'{product.reserved} units are held in carts; stock cannot go below that.']
+            if errors:
+                result.error(line, errors)
+            else:
+                accepted.append((row, product))
+        categories = category_registry.resolve_many({row['category'] for row, _ in accepted if 'category' in row})
+
+        now = timezone.now()
+        creates, updates, counted, images_before = [], [], [], {}
+        update_fields = {'updated_at'}
+        for row, product in accepted:
+            if product is None:
+                values = {**CREATE_DEFAULTS, **row}
+                creates.append(Product(
+                    name=values['name'],
+                    description=values['description'],
+                    price=values['price'],
+                    stock=values['stock'],
+                    category_id=categories[values['category']],
+                    image=values['image'],
+                    updated_at=now,
+                ))
+                continue
+            if product.pk not in images_before:
+                # A product named twice in one chunk is counted and written once, with both rows applied
+                counted.append(facets.snapshot(product))
+                images_before[product.pk] = product.image.name
+                updates.append(product)
+            fields = [field for field in row if field != 'id']
+            for field in fields:
+                if field == 'category':
+                    product.category_id = categories[row['category']]
+                else:
+                    setattr(product, field, row[field])
+            product.updated_at = now
+            update_fields.update(fields)
+        created = Product.objects.bulk_create(creates)
+        if updates:
+            Product.objects.bulk_update(updates, sorted(update_fields))
+        facets.apply_delta(counted, [facets.snapshot(product) for product in created + updates])
+
+        changed = [product.pk for product in created] + [product.pk for product in updates]
+        transaction.on_commit(lambda: products_bulk_changed.send(sender=Product, product_ids=changed))
+        images.enqueue(
+            [product.pk for product in created if product.image]
+            + [product.pk for product in updates if product.image and product.image.name != images_before[product.pk]]
+        )
+    result.created += len(created)
+    result.updated += len(updates)
+
+
+def export_rows(queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield one dict per product, streamed from the database in chunks.
+    """
+    queryset = Product.objects.all() if queryset is None else queryset
+    values = queryset.order_by('pk').values_list(
+        'id', 'name', 'description', 'price', 'stock', 'category__name', 'image'
+    )
+    for row in values.iterator(chunk_size=chunk_size):
+        yield dict(zip(COLUMNS, row))
+
+
+class _Echo:
+    # csv.writer only needs write(); handing back the line lets it be streamed
+    def write(self, value):
+        return value
+
+
+def export_lines(format, queryset=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield the export as encoded CSV or JSONL lines.
+    """
+    if format == 'csv':
+        writer = csv.writer(_Echo())
+        yield writer.writerow(COLUMNS)
+        for row in export_rows(queryset, chunk_size):
+            yield writer.writerow([row[column] for column in COLUMNS])
+    elif format == 'jsonl':
+        for row in export_rows(queryset, chunk_size):
+            row['price'] = str(row['price'])
+            yield json.dumps(row) + '\n'
+    else:
+        raise ValueError(f'Unsupported format {format!r}; use one of {", ".join(FORMATS)}.')
@@ -0,0 +1,71 @@
+"""
+Response cache for the public catalogue endpoints.
+
+Cached entries are keyed by request path and query parameters and tagged
+with the current generation of every scope they depend on ('products',
+'product:<pk>', 'categories', 'category:<pk>'). Saving or deleting a
+product or category bumps exactly the generations it affects (see
+`products.signals`), so stale entries are never read again and simply age
+out; the TTL only bounds memory.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+KEY_PREFIX = 'catalogue'
+STATS_KEYS = {'hits': f'{KEY_PREFIX}:stats:hits', 'misses': f'{KEY_PREFIX}:stats:misses'}
+
+
+def get_cache():
+    return caches[settings.CATALOGUE_CACHE_ALIAS]
+
+
+def generation_key(scope):
+    return f'{KEY_PREFIX}:gen:{scope}'
+
+
+def get_generations(scopes):
+    cache = get_cache()
+    keys = [generation_key(scope) for scope in scopes]
+    generations = cache.get_many(keys)
+    missing = {key: time.time_ns() for key in keys if key not in generations}
+    if missing:
+        # Seeding with the clock rather than 1 means an evicted generation can
+        # never come back at a value older entries were tagged with
+        cache.set_many(missing, timeout=None)
+        generations.update(missing)
+    return [generations[key] for key in keys]
+
+
+def invalidate(*scopes):
+    cache = get_cache()
+    for scope in scopes:
+        key = generation_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, time.time_ns(), timeout=None)
+
+
+def response_key(request, scopes):
+    params = sorted(request.query_params.lists())
+    digest = hashlib.sha1(f'{request.path}?{params}'.encode()).hexdigest()
+    generations = '.'.join(str(generation) for generation in get_generations(scopes))
+    return f'{KEY_PREFIX}:response:{digest}:{generations}'
+
+
+def record(outcome):
+    cache = get_cache()
+    key = STATS_KEYS[outcome]
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 0, timeout=None)
+        cache.incr(key)
+
+
+def stats():
+    values = get_cache().get_many(STATS_KEYS.values())
+    return {name: values.get(key, 0) for name, key in STATS_KEYS.items()}
@@ -0,0 +1,436 @@
+"""
+Cart storage engines.
+
+Cart contents live behind the `CartStore` interface, selected by the
+`CART_STORE` setting:
+
+- 'db' keeps them in `CartItem` rows, holding stock for every line as the
+  `CartItem` endpoints do.
+- 'memory' and 'redis' keep each cart as a hash of product id to quantity,
+  in process memory or in Redis. Mutations never touch the database; changed
+  carts are only written back to `CartItem` rows by `flush`, which runs at
+  checkout and periodically through the `flush_carts` command. Stock is not
+  held for these carts; checkout takes it from unreserved stock.
+
+The `Cart` row itself always lives in the database, so carts keep their
+ids and owners whatever the store. Cart ids are sequential, so an anonymous
+cart is only reachable with its `token`, sent in the `X-Cart-Token` header
+(see `holds_token`).
+"""
+import hmac
+import threading
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from . import stock
+from .models import Cart, CartItem, Product, StockReservation
+
+KEY_PREFIX = 'cart'
+DIRTY_KEY = f'{KEY_PREFIX}:dirty'
+# Marks a hash as loaded from the database, so an emptied cart is not reloaded
+LOADED_FIELD = 'loaded'
+
+
+class CartStore:
+    """
+    Interface shared by the cart stores. Carts are addressed by `Cart` id
+    and their contents are dicts of product id to quantity.
+    """
+
+    def items(self, cart_id):
+        raise NotImplementedError
+
+    def add(self, cart_id, product_id, quantity):
+        """
+        Add `quantity` units of a product to the cart.
+        """
+        raise NotImplementedError
+
+    def set(self, cart_id, product_id, quantity):
+        """
+        Set the quantity of a product in the cart; 0 removes it.
+        """
+        raise NotImplementedError
+
+    def set_many(self, cart_id, quantities):
+        """
+        Set the quantities of several products at once.
+        """
+        raise NotImplementedError
+
+    def merge(self, from_cart_id, into_cart_id):
+        """
+        Add the lines of one cart to another. The emptied cart is left for
+        the caller to delete.
+        """
+        raise NotImplementedError
+
+    def remove(self, cart_id, product_id):
+        self.set(cart_id, product_id, 0)
+
+    def flush(self, cart_id=None):
+        """
+        Write changed carts (or just `cart_id`) back to the database.
+
+        Returns:
+        - int: Number of carts written.
+        """
+        return 0
+
+    def discard(self, cart_id):
+        """
+        Forget any copy of the cart held outside the database.
+        """
+
+    def summary(self, cart_id):
+        """
+        Return the cart's lines priced from one products query, with its total.
+        """
+        quantities = self.items(cart_id)
+        products = Product.objects.filter(pk__in=list(quantities)).values_list('id', 'name', 'price')
+        lines, total, item_count = [], Decimal('0.00'), 0
+        for product_id, name, price in products.order_by('id'):
+            quantity = quantities[product_id]
+            line_total = price * quantity
+            lines.append({
+                'product': product_id,
+                'name': name,
+                'price': price,
+                'quantity': quantity,
+                'line_total': line_total,
+            })
+            total += line_total
+            item_count += quantity
+        return {'cart': cart_id, 'items': lines, 'item_count': item_count, 'total': total}
+
+
+class DatabaseCartStore(CartStore):
+
+    def items(self, cart_id):
+        quantities = {}
+        for product_id, quantity in CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'quantity'):
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        return quantities
+
+    def add(self, cart_id, product_id, quantity):
+        with transaction.atomic():
+            stock.reserve(_cart(cart_id), product_id, quantity)
+            line = CartItem.objects.filter(cart_id=cart_id, product_id=product_id).order_by('id').first()
+            if line is None:
+                CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+            else:
+                CartItem.objects.filter(pk=line.pk).update(quantity=F('quantity') + quantity)
+
+    def set(self, cart_id, product_id, quantity):
+        with transaction.atomic():
+            stock.release(_cart(cart_id), [product_id])
+            CartItem.objects.filter(cart_id=cart_id, product_id=product_id).delete()
+            if quantity:
+                stock.reserve(_cart(cart_id), product_id, quantity)
+                CartItem.objects.create(cart_id=cart_id, product_id=product_id, quantity=quantity)
+
+    def set_many(self, cart_id, quantities):
+        with transaction.atomic():
+            stock.release(_cart(cart_id), list(quantities))
+            stock.reserve_many(_cart(cart_id), quantities)
+            # One INSERT ... ON CONFLICT (cart, product) DO UPDATE for every line
+            CartItem.objects.bulk_create(
+                [
+                    CartItem(cart_id=cart_id, product_id=product_id, quantity=quantity)
+                    for product_id, quantity in quantities.items()
+                ],
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+
+    def merge(self, from_cart_id, into_cart_id):
+        table = CartItem._meta.db_table
+        with transaction.atomic(), connection.cursor() as cursor:
+            # bulk_create cannot add to the existing quantity, so upsert in SQL
+            cursor.execute(
+                f'INSERT INTO {table} (cart_id, product_id, quantity) '
+                f'SELECT %s, product_id, quantity FROM {table} WHERE cart_id = %s '
+                f'ON CONFLICT (cart_id, product_id) DO UPDATE SET quantity = {table}.quantity + excluded.quantity',
+                [into_cart_id, from_cart_id],
+            )
+            # The holds follow their units
+            StockReservation.objects.filter(cart_id=from_cart_id).update(cart_id=into_cart_id)
+
+
+class HashCartStore(CartStore):
+    """
+    Base for stores keeping each cart as a hash, with the set of carts
+    changed since their last write-back. Subclasses provide the hash
+    primitives.
+    """
+
+    def items(self, cart_id):
+        self._ensure_loaded(cart_id)
+        return {
+            int(field): int(quantity)
+            for field, quantity in self._hgetall(cart_id).items()
+            if field != LOADED_FIELD and int(quantity) > 0
+        }
+
+    def add(self, cart_id, product_id, quantity):
+        self._ensure_loaded(cart_id)
+        self._hincrby(cart_id, product_id, quantity)
+        self._mark_dirty(cart_id)
+
+    def set(self, cart_id, product_id, quantity):
+        self._ensure_loaded(cart_id)
+        if quantity:
+            self._hset(cart_id, {product_id: quantity})
+        else:
+            self._hdel(cart_id, product_id)
+        self._mark_dirty(cart_id)
+
+    def set_many(self, cart_id, quantities):
+        self._ensure_loaded(cart_id)
+        self._hset(cart_id, quantities)
+        self._mark_dirty(cart_id)
+
+    def merge(self, from_cart_id, into_cart_id):
+        for product_id, quantity in self.items(from_cart_id).items():
+            self.add(into_cart_id, product_id, quantity)
+        self.discard(from_cart_id)
+
+    def flush(self, cart_id=None):
+        cart_ids = list(self._pop_dirty(cart_id))
+        for index, dirty_id in enumerate(cart_ids):
+            try:
+                # Read after leaving the dirty set: a concurrent change marks the cart again
+                quantities = self.items(dirty_id)
+                with transaction.atomic():
+                    CartItem.objects.filter(cart_id=dirty_id).delete()
+                    CartItem.objects.bulk_create([
+                        CartItem(cart_id=dirty_id, product_id=product_id, quantity=quantity)
+                        for product_id, quantity in quantities.items()
+                    ])
+            except Exception:
+                # Unwritten carts stay dirty, so the next flush tries them again
+                for unwritten_id in cart_ids[index:]:
+                    self._mark_dirty(unwritten_id)
+                raise
+        return len(cart_ids)
+
+    def _ensure_loaded(self, cart_id):
+        if not self._exists(cart_id):
+            rows = CartItem.objects.filter(cart_id=cart_id).values_list('product_id', 'quantity')
+            self._load(cart_id, rows)
+
+    def _exists(self, cart_id):
+        raise NotImplementedError
+
+    def _load(self, cart_id, rows):
+        raise NotImplementedError
+
+    def _hgetall(self, cart_id):
+        raise NotImplementedError
+
+    def _hincrby(self, cart_id, product_id, quantity):
+        raise NotImplementedError
+
+    def _hset(self, cart_id, quantities):
+        raise NotImplementedError
+
+    def _hdel(self, cart_id, product_id):
+        raise NotImplementedError
+
+    def _mark_dirty(self, cart_id):
+        raise NotImplementedError
+
+    def _pop_dirty(self, cart_id=None):
+        raise NotImplementedError
+
+
+class MemoryCartStore(HashCartStore):
+    """
+    Keeps carts in this process; for development, tests and single-process
+    deployments.
+    """
+
+    def __init__(self):
+        self._carts = {}
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def discard(self, cart_id):
+        with self._lock:
+            self._carts.pop(cart_id, None)
+            self._dirty.discard(cart_id)
+
+    def _exists(self, cart_id):
+        return cart_id in self._carts
+
+    def _load(self, cart_id, rows):
+        rows = list(rows)
+        with self._lock:
+            if cart_id in self._carts:
+                return
+            cart = self._carts[cart_id] = {LOADED_FIELD: 1}
+            for product_id, quantity in rows:
+                cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
+
+    def _hgetall(self, cart_id):
+        with self._lock:
+            return dict(self._carts.get(cart_id, {}))
+
+    def _hincrby(self, cart_id, product_id, quantity):
+        with self._lock:
+            cart = self._carts.setdefault(cart_id, {LOADED_FIELD: 1})
+            cart[str(product_id)] = cart.get(str(product_id), 0) + quantity
+
+    def _hset(self, cart_id, quantities):
+        with self._lock:
+            cart = self._carts.setdefault(cart_id, {LOADED_FIELD: 1})
+            cart.update({str(product_id): quantity for product_id, quantity in quantities.items()})
+
+    def _hdel(self, cart_id, product_id):
+        with self._lock:
+            self._carts.get(cart_id, {}).pop(str(product_id), None)
+
+    def _mark_dirty(self, cart_id):
+        with self._lock:
+            self._dirty.add(cart_id)
+
+    def _pop_dirty(self, cart_id=None):
+        with self._lock:
+            if cart_id is None:
+                cart_ids, self._dirty = self._dirty, set()
+                return sorted(cart_ids)
+            if cart_id in self._dirty:
+                self._dirty.discard(cart_id)
+                return [cart_id]
+            return []
+
+
+class RedisCartStore(HashCartStore):
+    """
+    Keeps carts as Redis hashes shared by every worker. Untouched carts
+    expire after `CART_STORE_TTL` seconds; changes not yet written back are
+    lost with them, like the abandoned carts they belong to.
+    """
+
+    def __init__(self, url=None, ttl=None):
+        import redis
+
+        self.client = redis.Redis.from_url(url or settings.CART_STORE_URL, decode_responses=True)
+        self.ttl = ttl or settings.CART_STORE_TTL
+
+    def key(self, cart_id):
+        return f'{KEY_PREFIX}:{cart_id}'
+
+    def discard(self, cart_id):
+        pipe = self.client.pipeline()
+        pipe.delete(self.key(cart_id))
+        pipe.srem(DIRTY_KEY, cart_id)
+        pipe.execute()
+
+    def _exists(self, cart_id):
+        return self.client.exists(self.key(cart_id))
+
+    def _load(self, cart_id, rows):
+        mapping = {LOADED_FIELD: 1}
+        for product_id, quantity in rows:
+            mapping[str(product_id)] = mapping.get(str(product_id), 0) + quantity
+        pipe = self.client.pipeline()
+        # HSETNX on the marker keeps a concurrent load from doubling the lines
+        pipe.hsetnx(self.key(cart_id), LOADED_FIELD, 1)
+        pipe.expire(self.key(cart_id), self.ttl)
+        loaded, _ = pipe.execute()
+        if loaded and len(mapping) > 1:
+            self.client.hset(self.key(cart_id), mapping=mapping)
+
+    def _hgetall(self, cart_id):
+        return self.client.hgetall(self.key(cart_id))
+
+    def _hincrby(self, cart_id, product_id, quantity):
+        self._write(cart_id, lambda pipe: pipe.hincrby(self.key(cart_id), product_id, quantity))
+
+    def _hset(self, cart_id, quantities):
+        self._write(cart_id, lambda pipe: pipe.hset(self.key(cart_id), mapping=quantities))
+
+    def _hdel(self, cart_id, product_id):
+        self._write(cart_id, lambda pipe: pipe.hdel(self.key(cart_id), product_id))
+
+    def _write(self, cart_id, command):
+        pipe = self.client.pipeline()
+        command(pipe)
+        pipe.expire(self.key(cart_id), self.ttl)
+        pipe.execute()
+
+    def _mark_dirty(self, cart_id):
+        self.client.sadd(DIRTY_KEY, cart_id)
+
+    def _pop_dirty(self, cart_id=None):
+        if cart_id is not None:
+            return [cart_id] if self.client.srem(DIRTY_KEY, cart_id) else []
+        cart_ids = []
+        while True:
+            batch = self.client.spop(DIRTY_KEY, 500)
+            if not batch:
+                return sorted(cart_ids)
+            cart_ids += [int(cart_id) for cart_id in batch]
+
+
+def _cart(cart_id):
+    # `stock` only needs the cart's id, so skip loading the row
+    return Cart(pk=cart_id)
+
+
+def holds_token(cart, token):
+    """
+    Return whether `token` (a UUID or its string form, possibly None) is the
+    token of `cart`.
+    """
+    try:
+        token = uuid.UUID(str(token))
+    except ValueError:
+        return False
+    return hmac.compare_digest(cart.token.hex, token.hex)
+
+
+def claim(cart_id, token, user):
+    """
+    Hand an anonymous cart to `user` at login. If the user already has a
+    cart, the anonymous one is merged into their latest cart and deleted.
+
+    Returns:
+    - int or None: The user's cart id, or None if `cart_id` is not an
+      anonymous cart or `token` is not its token.
+    """
+    cart = Cart.objects.filter(pk=cart_id, user__isnull=True).only('id', 'token').first()
+    if cart is None or not holds_token(cart, token):
+        return None
+    into_cart_id = Cart.objects.filter(user=user).order_by('-id').values_list('pk', flat=True).first()
+    if into_cart_id is None:
+        Cart.objects.filter(pk=cart_id, user__isnull=True).update(user=user)
+        return cart_id
+    with transaction.atomic():
+        get_cart_store().merge(cart_id, into_cart_id)
+        Cart.objects.filter(pk=cart_id).delete()
+    return into_cart_id
+
+
+STORES = {
+    'db': DatabaseCartStore,
+    'memory': MemoryCartStore,
+    'redis': RedisCartStore,
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = STORES[settings.CART_STORE]()
+        return _store
@@ -0,0 +1,92 @@
+"""
+Category resolution.
+
+Category names are unique, and product writes refer to categories by name.
+`registry` maps names to ids from a process-local copy of the (small)
+categories table, so resolving a known name costs no query. The copy is
+tagged with a generation in the shared cache that renames and deletions
+bump (see `products.signals`), so every process reloads its map once after
+another one changes a category. New categories leave existing entries
+valid, so they only add to the map, once the transaction that created them
+commits; unknown names are created race-safely through the unique
+constraint.
+
+The generation only reaches other processes through a shared cache, so
+multi-process deployments need `CACHE_URL` set. With the default in-memory
+cache each worker only sees its own renames and deletions, and may resolve
+a name to a renamed or deleted category until it restarts.
+"""
+import threading
+
+from django.db import transaction
+
+from . import cache as response_cache
+from .models import Category
+
+SCOPE = 'category-registry'
+
+
+class CategoryRegistry:
+
+    def __init__(self):
+        self._ids = None
+        self._generation = None
+        self._lock = threading.Lock()
+
+    def ids(self):
+        """
+        Return the current name -> id map, reloading it if categories changed.
+        """
+        generation = response_cache.get_generations([SCOPE])[0]
+        with self._lock:
+            if self._ids is None or self._generation != generation:
+                self._ids = dict(Category.objects.values_list('name', 'id'))
+                self._generation = generation
+            return self._ids
+
+    def resolve(self, name):
+        """
+        Return the id of the category called `name`, creating it if needed.
+        """
+        category_id = self.ids().get(name)
+        if category_id is None:
+            # get_or_create retries the lookup when a concurrent insert wins the unique constraint
+            category_id = Category.objects.get_or_create(name=name)[0].pk
+            self._remember({name: category_id})
+        return category_id
+
+    def resolve_many(self, names):
+        """
+        Return a name -> id map for `names`, creating missing categories in bulk.
+        """
+        known = self.ids()
+        missing = set(names) - known.keys()
+        if missing:
+            Category.objects.bulk_create([Category(name=name) for name in sorted(missing)], ignore_conflicts=True)
+            created = dict(Category.objects.filter(name__in=missing).values_list('name', 'id'))
+            self._remember(created)
+            known = {**known, **created}
+        return {name: known[name] for name in names}
+
+    def clear(self):
+        with self._lock:
+            self._ids = None
+
+    def invalidate(self):
+        """
+        Drop every process's copy of the map after a rename or deletion.
+        """
+        self.clear()
+        response_cache.invalidate(SCOPE)
+
+    def _remember(self, ids):
+        # A rolled-back transaction takes its categories with it, so only record them on commit
+        transaction.on_commit(lambda: self._add(ids))
+
+    def _add(self, ids):
+        with self._lock:
+            if self._ids is not None:
+                self._ids.update(ids)
+
+
+registry = CategoryRegistry()
@@ -0,0 +1,71 @@
+"""
+Cart checkout.
+
+`checkout` turns a cart into an order in one transaction with a fixed
+number of queries, however many lines the cart has: the lines are read in
+one query, their prices are snapshotted from one batched product fetch, the
+order items are written with a single `bulk_create`, and the order total is
+computed by the database.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import DecimalField, ExpressionWrapper, F, Q, Sum
+
+from . import stock
+from .carts import get_cart_store
+from .models import CartItem, ContactInfo, Order, OrderItem, Product
+
+
+class CheckoutError(Exception):
+    """
+    Raised when a cart cannot be checked out.
+    """
+
+
+def checkout(cart):
+    """
+    Create an order, with one item per product, from the lines of `cart`.
+
+    Stock is taken through `stock.commit`, so units the cart holds are
+    converted into sales. The cart, written back from the cart store first,
+    is emptied once the order exists.
+
+    Returns:
+    - Order: The new order, with `total_amount` and `item_count` set.
+
+    Raises:
+    - CheckoutError: The cart is empty or its owner has no contact info.
+    - stock.InsufficientStock: A product cannot cover the ordered quantity.
+    """
+    store = get_cart_store()
+    with transaction.atomic():
+        # Carts kept outside the database are written back first
+        store.flush(cart.pk)
+        quantities = defaultdict(int)
+        for product_id, quantity in CartItem.objects.filter(cart=cart).values_list('product_id', 'quantity'):
+            quantities[product_id] += quantity
+        if not quantities:
+            raise CheckoutError('The cart is empty.')
+
+        contact_info = ContactInfo.objects.filter(Q(user=cart.user_id) | Q(profile__user=cart.user_id)).first()
+        if contact_info is None:
+            raise CheckoutError('Add contact info before checking out.')
+
+        prices = dict(Product.objects.filter(pk__in=list(quantities)).values_list('pk', 'price'))
+        stock.commit(cart, quantities)
+
+        order = Order.objects.create(user_id=cart.user_id, cart=cart, contact_info=contact_info)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product_id=product_id, quantity=quantity, price=prices[product_id])
+            for product_id, quantity in quantities.items()
+        ])
+        # bulk_create skips the signals that keep the totals, so set them here
+        line_total = ExpressionWrapper(F('quantity') * F('price'), output_field=DecimalField())
+        totals = OrderItem.objects.filter(order=order).aggregate(total=Sum(line_total), count=Sum('quantity'))
+        order.total_amount, order.item_count = totals['total'], totals['count']
+        Order.objects.filter(pk=order.pk).update(total_amount=order.total_amount, item_count=order.item_count)
+
+        CartItem.objects.filter(cart=cart).delete()
+        transaction.on_commit(lambda: store.discard(cart.pk))
+    return order
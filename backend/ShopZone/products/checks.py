@@ -0,0 +1,70 @@
+"""
+System checks.
+
+`check_orderings` makes sure every ordering a view offers through
+`filters.DeclaredOrderingFilter` can be served by an index walk: its fields
+must be the leading columns of an index (or the primary key) of the view's
+model, sorted in one direction, and end in a unique field.
+"""
+from django.core import checks
+from django.urls import URLPattern, URLResolver, get_resolver
+
+from .filters import DeclaredOrderingFilter
+
+
+@checks.register(checks.Tags.urls)
+def check_orderings(app_configs=None, **kwargs):
+    errors = []
+    for view in ordered_views():
+        errors.extend(ordering_errors(view))
+    return errors
+
+
+def ordered_views(patterns=None):
+    """
+    Yield the class-based views routed in the URLconf that use `DeclaredOrderingFilter`.
+    """
+    seen = set()
+    for pattern in get_resolver().url_patterns if patterns is None else patterns:
+        if isinstance(pattern, URLResolver):
+            views = ordered_views(pattern.url_patterns)
+        elif isinstance(pattern, URLPattern):
+            views = [getattr(pattern.callback, 'cls', None)]
+        else:
+            continue
+        for view in views:
+            if view is None or view in seen:
+                continue
+            if any(issubclass(backend, DeclaredOrderingFilter) for backend in getattr(view, 'filter_backends', ())):
+                seen.add(view)
+                yield view
+
+
+def ordering_errors(view):
+    model = view.queryset.model
+    opts = model._meta
+    indexes = [[opts.pk.name]] + [list(index.fields) for index in opts.indexes if index.condition is None]
+    errors = []
+    for name, fields in view.orderings.items():
+        columns = [field.lstrip('-') for field in fields]
+        columns = [opts.pk.name if column == 'pk' else column for column in columns]
+        if len({field.startswith('-') for field in fields}) > 1:
+            problem = 'mixes ascending and descending fields'
+        elif not any(index[:len(columns)] == columns for index in indexes):
+            problem = f'is not the start of an index on {opts.label}'
+        elif not opts.get_field(columns[-1]).unique:
+            problem = 'does not end in a unique field'
+        else:
+            continue
+        errors.append(checks.Error(
+            f'Ordering {name!r} of {view.__module__}.{view.__qualname__} ({", ".join(fields)}) {problem}.',
+            obj=view,
+            id='products.E001',
+        ))
+    if view.ordering.lstrip('-') not in view.orderings:
+        errors.append(checks.Error(
+            f'Default ordering {view.ordering!r} of {view.__qualname__} is not one of its orderings.',
+            obj=view,
+            id='products.E002',
+        ))
+    return errors
@@ -0,0 +1,187 @@
+"""
+Catalogue facet counts.
+
+`ProductFacet` stores how many products fall in each combination of
+category, price bucket and stock state, so facet counts are sums over a
+table with a few rows per category rather than GROUP BYs over the catalogue.
+Like order totals (see `products.orders`), the table is never recomputed on
+write: every product save or delete applies the difference it makes as
+F-expression deltas (see `products.signals`). Writes that bypass signals,
+bulk imports and `stock.commit`, apply their own deltas, and `rebuild`
+recomputes the whole table (see the `rebuild_product_facets` command).
+
+Price buckets are the half-open ranges between `settings.PRODUCT_PRICE_BUCKETS`,
+the last one open-ended. Filters are answered from the table when the price
+range falls on bucket bounds; narrower ranges and text searches are counted
+over the matching products instead.
+"""
+from bisect import bisect_right
+from collections import Counter
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, Count, F, IntegerField, Q, Sum, Value, When
+
+from .models import Product, ProductFacet
+
+
+def bounds():
+    """
+    Lower bound of every price bucket, starting at 0.
+    """
+    return [Decimal('0')] + [Decimal(str(edge)) for edge in settings.PRODUCT_PRICE_BUCKETS]
+
+
+def bucket_of(price):
+    return bisect_right(bounds(), Decimal(str(price))) - 1
+
+
+def bucket_expression():
+    """
+    The price bucket of each row, computed in SQL.
+    """
+    edges = bounds()[1:]
+    return Case(
+        *[When(price__lt=edge, then=Value(bucket)) for bucket, edge in enumerate(edges)],
+        default=Value(len(edges)), output_field=IntegerField(),
+    )
+
+
+def key(category_id, price, stock):
+    """
+    The (category id, price bucket, in stock) combination a product counts towards.
+    """
+    return category_id, bucket_of(price), int(stock) > 0
+
+
+def snapshot(product):
+    return key(product.category_id, product.price, product.stock)
+
+
+def apply_delta(previous=(), current=()):
+    """
+    Move products from their `previous` combinations to their `current`
+    ones. None stands for a product that did not or no longer exists.
+    """
+    deltas = Counter()
+    for key_ in previous:
+        if key_ is not None:
+            deltas[key_] -= 1
+    for key_ in current:
+        if key_ is not None:
+            deltas[key_] += 1
+    for (category_id, bucket, in_stock), delta in deltas.items():
+        if not delta:
+            continue
+        rows = ProductFacet.objects.filter(category_id=category_id, price_bucket=bucket, in_stock=in_stock)
+        # A missing row being decremented belongs to a category that is being deleted
+        if rows.update(product_count=F('product_count') + delta) or delta < 0:
+            continue
+        # First product in this combination; a concurrent insert wins and the update lands on its row
+        ProductFacet.objects.bulk_create(
+            [ProductFacet(category_id=category_id, price_bucket=bucket, in_stock=in_stock)], ignore_conflicts=True
+        )
+        rows.update(product_count=F('product_count') + delta)
+
+
+def record_sold_out(product_ids):
+    """
+    Move the products among `product_ids` whose stock a decrement has just
+    taken to zero into the out-of-stock counts. Only call this after a
+    decrement every product could cover, i.e. all of them had stock before.
+    """
+    sold_out = [
+        key(category_id, price, 0)
+        for category_id, price in Product.objects.filter(pk__in=list(product_ids), stock=0).values_list('category_id', 'price')
+    ]
+    apply_delta([(category_id, bucket, True) for category_id, bucket, _ in sold_out], sold_out)
+
+
+def rebuild():
+    """
+    Recompute every facet count from the products.
+
+    Returns:
+    - int: Number of combinations stored.
+    """
+    rows = (
+        Product.objects.order_by()
+        .annotate(price_bucket=bucket_expression(), in_stock=Q(stock__gt=0))
+        .values('category_id', 'price_bucket', 'in_stock')
+        .annotate(product_count=Count('pk'))
+    )
+    with transaction.atomic():
+        ProductFacet.objects.all().delete()
+        created = ProductFacet.objects.bulk_create([ProductFacet(**row) for row in rows])
+    return len(created)
+
+
+def counts(category=None, min_price=None, max_price=None, in_stock=None, queryset=None):
+    """
+    Product counts per category and per price bucket under the given
+    filters. Each facet ignores its own filter, so its counts show what
+    choosing another value would return. `min_price` is inclusive and
+    `max_price` exclusive, like the buckets.
+
+    `queryset` is a text search the counts must be narrowed to; without
+    one, and with the price range on bucket bounds, the stored counts are used.
+
+    Returns:
+    - dict: 'category' (id, name, count per category with products) and
+      'price' (min, max, count per bucket).
+    """
+    lower = bounds()
+    aligned = min_price in (None, *lower) and max_price in (None, *lower)
+    if queryset is None and aligned:
+        categories, buckets = _stored_counts(lower, category, min_price, max_price, in_stock)
+    else:
+        products = Product.objects.all() if queryset is None else queryset
+        categories, buckets = _live_counts(products, category, min_price, max_price, in_stock)
+
+    buckets = dict(buckets)
+    upper = lower[1:] + [None]
+    return {
+        'category': [{'id': pk, 'name': name, 'count': count} for pk, name, count in categories],
+        'price': [
+            {'min': str(low), 'max': None if high is None else str(high), 'count': buckets.get(bucket, 0)}
+            for bucket, (low, high) in enumerate(zip(lower, upper))
+        ],
+    }
+
+
+def _stored_counts(lower, category, min_price, max_price, in_stock):
+    rows = ProductFacet.objects.filter(product_count__gt=0)
+    if in_stock is not None:
+        rows = rows.filter(in_stock=in_stock)
+    by_category, by_price = rows, rows
+    if category:
+        by_price = by_price.filter(category_id__in=category)
+    if min_price is not None:
+        by_category = by_category.filter(price_bucket__gte=lower.index(min_price))
+    if max_price is not None:
+        by_category = by_category.filter(price_bucket__lt=lower.index(max_price))
+    return (
+        by_category.values_list('category_id', 'category__name').annotate(count=Sum('product_count'))
+        .order_by('category__name'),
+        by_price.values_list('price_bucket').annotate(count=Sum('product_count')).order_by(),
+    )
+
+
+def _live_counts(products, category, min_price, max_price, in_stock):
+    products = products.order_by()
+    if in_stock is not None:
+        products = products.filter(stock__gt=0) if in_stock else products.filter(stock=0)
+    by_category, by_price = products, products
+    if category:
+        by_price = by_price.filter(category_id__in=category)
+    if min_price is not None:
+        by_category = by_category.filter(price__gte=min_price)
+    if max_price is not None:
+        by_category = by_category.filter(price__lt=max_price)
+    return (
+        by_category.values_list('category_id', 'category__name').annotate(count=Count('pk'))
+        .order_by('category__name'),
+        by_price.annotate(price_bucket=bucket_expression()).values_list('price_bucket')
+        .annotate(count=Count('pk')).order_by(),
+    )
@@ -0,0 +1,87 @@
+import django_filters
+from rest_framework import filters
+from rest_framework.exceptions import ValidationError
+
+from .models import Product
+from .search import get_search_backend
+
+
+class FullTextSearchFilter(filters.SearchFilter):
+    """
+    Matches the `search` query parameter against the product full-text index
+    (name, category and description) instead of `LIKE '%term%'` scans.
+    Views may also expose `search_param_fields`, mapping extra query
+    parameters to the index columns they search.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        backend = get_search_backend()
+        text = request.query_params.get(self.search_param, '')
+        if text:
+            queryset = backend.filter(queryset, text)
+        for param, fields in getattr(view, 'search_param_fields', {}).items():
+            text = request.query_params.get(param, '')
+            if text:
+                queryset = backend.filter(queryset, text, fields)
+        return queryset
+
+
+class DeclaredOrderingFilter(filters.OrderingFilter):
+    """
+    Orders by one of the view's `orderings`: a map of the names clients may
+    send as `?ordering=` (optionally prefixed with '-' to reverse them) to
+    the model fields they sort by. Each ordering ends in a unique field, so
+    rows sharing a sort value keep a stable order across keyset and numbered
+    pages, and is backed by an index (`checks.check_orderings` verifies both
+    at startup). `ordering` on the view names the default.
+
+    Anything else, including combinations of orderings, is rejected with a
+    400 before a query runs.
+    """
+
+    def get_ordering(self, request, queryset, view):
+        params = request.query_params.get(self.ordering_param)
+        if params is None or not params.strip():
+            return self.get_default_ordering(view)
+        terms = [term.strip() for term in params.split(',') if term.strip()]
+        if len(terms) != 1 or terms[0].lstrip('-') not in view.orderings:
+            raise ValidationError({
+                self.ordering_param: f'Use one of {", ".join(view.orderings)}, optionally prefixed with "-".'
+            })
+        return self.expand(terms[0], view)
+
+    def get_default_ordering(self, view):
+        return self.expand(view.ordering, view)
+
+    def expand(self, term, view):
+        fields = view.orderings[term.lstrip('-')]
+        if term.startswith('-'):
+            fields = [field[1:] if field.startswith('-') else '-' + field for field in fields]
+        return list(fields)
+
+    def get_valid_fields(self, queryset, view, context={}):
+        return [(name, name) for name in view.orderings]
+
+
+class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
+    pass
+
+
+class ProductFilter(django_filters.FilterSet):
+    """
+    Catalogue facets: `category` (comma-separated ids), a price range from
+    `min_price` (inclusive) to `max_price` (exclusive) matching the price
+    buckets of `products.facets`, and `in_stock`.
+    """
+    category = NumberInFilter(field_name='category')
+    min_price = django_filters.NumberFilter(field_name='price', lookup_expr='gte')
+    max_price = django_filters.NumberFilter(field_name='price', lookup_expr='lt')
+    # Spelled stock > 0 so category pages can use the partial in-stock index
+    in_stock = django_filters.BooleanFilter(method='filter_in_stock')
+
+    class Meta:
+        model = Product
+        fields = ['category', 'min_price', 'max_price', 'in_stock']
+
+    def filter_in_stock(self, queryset, name, value):
+        return queryset.filter(stock__gt=0) if value else queryset.filter(stock=0)
@@ -0,0 +1,133 @@
+"""
+Pre-serialised product fragments.
+
+Rendering a product through `ProductSerializer` (field lookups, decimal
+formatting, image URL building) costs far more than copying its JSON.
+`FragmentListSerializer` stores the encoded JSON of every product it
+serialises in the catalogue cache, keyed by the product id and the current
+generation of its 'product:<pk>' scope. Product saves and deletes,
+category renames, stock changes and image jobs all bump that generation
+(see `products.signals`), so a list re-serialises only the products
+that changed since they were last rendered. Fragments of products read from
+a replica are used but not stored: the replica may not have caught up with
+the write that bumped the generation.
+
+`FragmentJSONRenderer` splices the cached bytes into the response body
+without decoding them. Fragments still read like dicts, decoded on first
+access, so code inspecting `response.data` and other renderers keep working.
+"""
+import hashlib
+import json
+import re
+import secrets
+from collections.abc import Mapping
+
+from django.conf import settings
+from django.db.models.manager import BaseManager
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+
+from . import cache as response_cache
+from . import replicas
+
+
+class Fragment(Mapping):
+    """
+    One object's encoded JSON.
+    """
+    __slots__ = ('json', '_data')
+
+    def __init__(self, json):
+        self.json = json
+        self._data = None
+
+    def decoded(self):
+        if self._data is None:
+            self._data = json.loads(self.json)
+        return self._data
+
+    def __getitem__(self, key):
+        return self.decoded()[key]
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def __len__(self):
+        return len(self.decoded())
+
+    def __reduce__(self):
+        # Cached responses keep the bytes only
+        return Fragment, (self.json,)
+
+    def __repr__(self):
+        return f'Fragment({self.json!r})'
+
+
+def encode(data):
+    """
+    Encode `data` exactly as `JSONRenderer` writes it into responses.
+    """
+    return JSONRenderer().render(data)
+
+
+def fragment_keys(serializer, instances):
+    request = serializer.context.get('request')
+    # Image URLs are absolute, so fragments differ per scheme and host
+    origin = hashlib.sha1(request.build_absolute_uri('/').encode()).hexdigest()[:12] if request else '-'
+    generations = response_cache.get_generations([f'product:{instance.pk}' for instance in instances])
+    label = type(serializer).__name__
+    return [
+        f'{response_cache.KEY_PREFIX}:fragment:{label}:{origin}:{instance.pk}:{generation}'
+        for instance, generation in zip(instances, generations)
+    ]
+
+
+class FragmentListSerializer(serializers.ListSerializer):
+    """
+    Serialises products through the fragment cache; only the ones without a
+    current fragment go through the child serializer.
+    """
+
+    def to_representation(self, data):
+        instances = list(data.all() if isinstance(data, BaseManager) else data)
+        if not instances:
+            return []
+        keys = fragment_keys(self.child, instances)
+        cache = response_cache.get_cache()
+        cached = cache.get_many(keys)
+        missing = {}
+        for instance, key in zip(instances, keys):
+            if key not in cached:
+                missing[key] = encode(self.child.to_representation(instance))
+        if missing:
+            if not replicas.reading_from_replicas():
+                cache.set_many(missing, settings.CATALOGUE_CACHE_TIMEOUT)
+            cached.update(missing)
+        return [Fragment(cached[key]) for key in keys]
+
+
+class FragmentJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer that copies `Fragment`s into the body as they are.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        fragments = []
+        # Stands in for each fragment while the rest of the document is encoded
+        marker = f'fragment:{secrets.token_hex(8)}:'
+
+        def swap(value):
+            if isinstance(value, Fragment):
+                fragments.append(value.json)
+                return f'{marker}{len(fragments) - 1}'
+            if isinstance(value, dict):
+                return {key: swap(item) for key, item in value.items()}
+            if isinstance(value, (list, tuple)):
+                return [swap(item) for item in value]
+            return value
+
+        body = super().render(swap(data), accepted_media_type, renderer_context)
+        if not fragments:
+            return body
+        placeholder = re.compile(rb'"' + re.escape(marker.encode()) + rb'(\d+)"')
+        return placeholder.sub(lambda match: fragments[int(match[1])], body)
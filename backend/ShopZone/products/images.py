@@ -0,0 +1,247 @@
+"""
+Derived product images.
+
+Uploads are stored as-is, which is far too heavy for catalogue pages. After
+a product is saved with an image that has no variants yet, `enqueue` hands
+its id to a small background thread pool that resizes the upload to each of
+`settings.PRODUCT_IMAGE_WIDTHS` (never upscaling) and writes a WebP and a
+JPEG copy of each size to the default storage. Variant names are derived
+from the source name (`products/variants/<stem>-<width>w.<ext>`), so
+regenerating is idempotent, existing files are reused, and products sharing
+an image blob (see `products.storage`) share its variants too.
+
+The result is recorded in `Product.image_variants` together with the source
+it was built from; `srcset` ignores variants built from a previous image.
+Products left without variants by a restart are picked up again by the
+`generate_image_variants` management command.
+
+Images and variants nothing refers to any more are removed by
+`collect_garbage`, which can first move images uploaded before content
+addressing onto shared blobs (`adopt_images`).
+"""
+import io
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from PIL import Image, ImageOps
+
+from . import cache as response_cache
+from . import listings
+from .models import Product
+from .storage import get_product_image_storage, is_blob_name
+
+logger = logging.getLogger(__name__)
+
+IMAGE_DIR = 'products'
+VARIANT_DIR = 'products/variants'
+# Files younger than this are never collected; their product row may not be committed yet
+GARBAGE_MIN_AGE = timedelta(hours=24)
+# Format name -> (file extension, Pillow save options); WebP first, JPEG as the fallback
+FORMATS = {
+    'webp': ('webp', {'format': 'WEBP', 'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', {'format': 'JPEG', 'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.PRODUCT_IMAGE_WORKERS, thread_name_prefix='image-variants')
+        return _executor
+
+
+def needs_variants(product):
+    return bool(product.image) and product.image_variants.get('source') != product.image.name
+
+
+def enqueue(product_ids):
+    """
+    Generate variants for `product_ids` in the background once the current transaction commits.
+    """
+    product_ids = list(product_ids)
+    if product_ids:
+        transaction.on_commit(lambda: get_executor().submit(run_variants, product_ids))
+
+
+def run_variants(product_ids):
+    # Worker threads own their connections, so release them after each job
+    close_old_connections()
+    try:
+        for product_id in product_ids:
+            try:
+                generate_variants(product_id)
+            except FileNotFoundError:
+                logger.warning('Image of product %s is missing; no variants generated', product_id)
+            except Exception:
+                logger.exception('Generating image variants for product %s failed', product_id)
+    finally:
+        close_old_connections()
+
+
+def variant_name(source_name, width, format):
+    stem = posixpath.splitext(posixpath.basename(source_name))[0]
+    return f'{VARIANT_DIR}/{stem}-{width}w.{FORMATS[format][0]}'
+
+
+def generate_variants(product_id):
+    """
+    Build the variants of a product's current image and record them.
+
+    Returns:
+    - bool: False when the product is gone, has no image or is already done.
+    """
+    product = Product.objects.filter(pk=product_id).only('image', 'image_variants').first()
+    if product is None or not needs_variants(product):
+        return False
+
+    source = product.image.name
+    with product.image.open('rb') as file, Image.open(file) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            # Palette and greyscale images would otherwise resize with nearest-neighbour sampling
+            image = image.convert('RGBA')
+        widths = sorted({min(width, image.width) for width in settings.PRODUCT_IMAGE_WIDTHS})
+        variants = {format: {} for format in FORMATS}
+        for width in widths:
+            resized = None
+            for format in FORMATS:
+                name = variant_name(source, width, format)
+                if not default_storage.exists(name):
+                    if resized is None:
+                        height = max(1, round(image.height * width / image.width))
+                        resized = image.resize((width, height), Image.LANCZOS)
+                    default_storage.save(name, ContentFile(encode(resized, format)))
+                variants[format][str(width)] = name
+
+    # Conditional on the source, so a newer upload is not overwritten with stale variants
+    updated = Product.objects.filter(pk=product_id, image=source).update(
+        image_variants={'source': source, **variants}, updated_at=timezone.now()
+    )
+    if updated:
+        # update() skips auto_now and the signals that refresh the listing and invalidate cached responses
+        listings.refresh([product_id])
+        response_cache.invalidate('products', f'product:{product_id}')
+    return bool(updated)
+
+
+def encode(image, format):
+    options = FORMATS[format][1]
+    if format == 'jpeg' and image.mode == 'RGBA':
+        # JPEG has no alpha channel; flatten transparency onto white
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, **options)
+    return buffer.getvalue()
+
+
+def srcset(product, build_url=None):
+    """
+    Return a format -> srcset string map for a product's current image, or
+    an empty dict until its variants exist.
+    """
+    variants = product.image_variants or {}
+    if not product.image or variants.get('source') != product.image.name:
+        return {}
+    build_url = build_url or (lambda url: url)
+    return {
+        format: ', '.join(
+            f'{build_url(default_storage.url(name))} {width}w'
+            for width, name in sorted(variants[format].items(), key=lambda item: int(item[0]))
+        )
+        for format in FORMATS if variants.get(format)
+    }
+
+
+def variant_stem(name):
+    # 'products/variants/<stem>-160w.webp' -> '<stem>'
+    return posixpath.basename(name).rsplit('-', 1)[0]
+
+
+def adopt_images(dry_run=False):
+    """
+    Move products whose image predates content addressing onto shared blobs.
+    The old files become garbage for `collect_garbage`.
+
+    Returns:
+    - int: Number of distinct legacy images adopted.
+    """
+    storage = get_product_image_storage()
+    legacy = (
+        Product.objects.exclude(image='').order_by('image').values_list('image', flat=True).distinct()
+    )
+    adopted = 0
+    for name in [name for name in legacy.iterator() if not is_blob_name(name)]:
+        if not storage.exists(name):
+            logger.warning('Image %s is missing; not adopted', name)
+            continue
+        adopted += 1
+        if dry_run:
+            continue
+        with storage.open(name, 'rb') as file:
+            blob = storage.save(name, file)
+        # Conditional on the old name, so a product given a new image meanwhile keeps it
+        product_ids = list(Product.objects.filter(image=name).values_list('pk', flat=True))
+        Product.objects.filter(pk__in=product_ids, image=name).update(image=blob, updated_at=timezone.now())
+        listings.refresh(product_ids)
+        response_cache.invalidate('products', *[f'product:{pk}' for pk in product_ids])
+    return adopted
+
+
+def collect_garbage(min_age=GARBAGE_MIN_AGE, dry_run=False):
+    """
+    Delete product images, and variants, that no product refers to and that
+    are older than `min_age`.
+
+    Returns:
+    - list: Names of the deleted (or, with `dry_run`, deletable) files.
+    """
+    referenced = set(Product.objects.exclude(image='').values_list('image', flat=True).iterator())
+    stems = {posixpath.splitext(posixpath.basename(name))[0] for name in referenced}
+    cutoff = timezone.now() - min_age
+
+    storage = get_product_image_storage()
+    garbage = [
+        (storage, name) for name in walk(storage, IMAGE_DIR)
+        if not name.startswith(VARIANT_DIR + '/') and name not in referenced
+    ]
+    garbage += [
+        (default_storage, name) for name in walk(default_storage, VARIANT_DIR)
+        if variant_stem(name) not in stems
+    ]
+
+    deleted = []
+    for storage, name in garbage:
+        if storage.get_modified_time(name) > cutoff:
+            continue
+        if not dry_run:
+            storage.delete(name)
+        deleted.append(name)
+    return deleted
+
+
+def walk(storage, path):
+    """
+    Yield the names of all files below `path` in `storage`.
+    """
+    try:
+        directories, files = storage.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in files:
+        yield f'{path}/{name}'
+    for directory in directories:
+        yield from walk(storage, f'{path}/{directory}')
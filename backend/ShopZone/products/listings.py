@@ -0,0 +1,125 @@
+"""
+Catalogue listing read model.
+
+`ProductListing` holds one row per product with what a product card needs
+(name, price, category name, thumbnail URL, in-stock flag) already
+rendered, so `ProductListingView` pages through a single table without
+joins or model serializers.
+
+Rows are written from the products, never edited on their own:
+
+- Product saves and deletes, category renames and bulk imports go through
+  `products.signals`.
+- Writes that bypass signals call in here themselves: `stock.commit`
+  (`record_stock`) and the image variant jobs (`refresh`).
+- `rebuild` rewrites every row (see the `rebuild_product_listings` command).
+"""
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+
+from .models import Product, ProductListing
+
+REBUILD_BATCH_SIZE = 1000
+UPDATE_FIELDS = ['name', 'price', 'category_id', 'category_name', 'thumbnail', 'in_stock', 'updated_at']
+
+
+def thumbnail(product):
+    """
+    URL of the smallest image variant at least `settings.PRODUCT_THUMBNAIL_WIDTH`
+    wide, falling back to the largest variant and then to the upload itself.
+    """
+    if not product.image:
+        return ''
+    variants = product.image_variants or {}
+    if variants.get('source') == product.image.name:
+        for format in ('webp', 'jpeg'):
+            widths = sorted((int(width), name) for width, name in variants.get(format, {}).items())
+            if widths:
+                fits = [name for width, name in widths if width >= settings.PRODUCT_THUMBNAIL_WIDTH]
+                return default_storage.url(fits[0] if fits else widths[-1][1])
+    return product.image.url
+
+
+def build(product, now=None):
+    """
+    The listing row of `product`, whose category must be loaded or cheap to load.
+    """
+    return ProductListing(
+        id=product.pk,
+        name=product.name,
+        price=product.price,
+        category_id=product.category_id,
+        category_name=product.category.name,
+        thumbnail=thumbnail(product),
+        in_stock=int(product.stock) > 0,
+        updated_at=now or timezone.now(),
+    )
+
+
+def save(products):
+    """
+    Insert or overwrite the listing rows of `products` in one statement.
+    """
+    now = timezone.now()
+    ProductListing.objects.bulk_create(
+        [build(product, now) for product in products],
+        update_conflicts=True, unique_fields=['id'], update_fields=UPDATE_FIELDS,
+    )
+
+
+def refresh(product_ids):
+    """
+    Rewrite the listing rows of `product_ids` from the products, removing
+    those of products that no longer exist.
+    """
+    product_ids = list(product_ids)
+    products = list(Product.objects.filter(pk__in=product_ids).select_related('category'))
+    if products:
+        save(products)
+    missing = set(product_ids) - {product.pk for product in products}
+    if missing:
+        remove(missing)
+
+
+def remove(product_ids):
+    ProductListing.objects.filter(pk__in=list(product_ids)).delete()
+
+
+def rename_category(category):
+    ProductListing.objects.filter(category_id=category.pk).update(
+        category_name=category.name, updated_at=timezone.now()
+    )
+
+
+def record_stock(product_ids):
+    """
+    Copy the in-stock flag of `product_ids` after an UPDATE that bypassed signals.
+    """
+    in_stock = Exists(Product.objects.filter(pk=OuterRef('pk'), stock__gt=0))
+    ProductListing.objects.filter(pk__in=list(product_ids)).update(in_stock=in_stock, updated_at=timezone.now())
+
+
+def rebuild(batch_size=REBUILD_BATCH_SIZE):
+    """
+    Rewrite every listing row in batches of products and drop rows of
+    products that are gone.
+
+    Returns:
+    - int: Number of listing rows written.
+    """
+    written, last_id = 0, 0
+    while True:
+        batch = list(
+            Product.objects.filter(pk__gt=last_id).select_related('category').order_by('pk')[:batch_size]
+        )
+        if not batch:
+            break
+        with transaction.atomic():
+            save(batch)
+        written += len(batch)
+        last_id = batch[-1].pk
+    ProductListing.objects.exclude(Exists(Product.objects.filter(pk=OuterRef('pk')))).delete()
+    return written
@@ -0,0 +1,68 @@
+import time
+import uuid
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+
+from products import cache as response_cache
+from products.fragments import FragmentJSONRenderer
+from products.models import Category, Product
+from products.serializers import ProductSerializer
+
+
+class Command(BaseCommand):
+    help = (
+        'Render pages of products through ProductSerializer with and without the fragment cache and '
+        'report the time per page. Creates and removes its own fixtures.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100, help='Products per page.')
+        parser.add_argument('--rounds', type=int, default=50, help='Pages rendered per variant.')
+        parser.add_argument('--dirty', type=int, default=1, help='Products changed before each cached page.')
+
+    # Image URLs are built against the factory's 'testserver' host
+    @override_settings(ALLOWED_HOSTS=['testserver'])
+    def handle(self, *args, **options):
+        count, rounds, dirty = options['products'], options['rounds'], options['dirty']
+        request = Request(APIRequestFactory().get('/products/list/'))
+        context = {'request': request}
+        category = Category.objects.create(name=f'bench-{uuid.uuid4().hex}')
+        Product.objects.bulk_create([
+            Product(name=f'Benchmark product {i}', description='A product' * 10, image=f'products/bench-{i}.png',
+                    price=Decimal('10.00') + i, category=category, stock=i % 5)
+            for i in range(count)
+        ])
+        try:
+            products = list(ProductSerializer.setup_eager_loading(Product.objects.filter(category=category)))
+
+            def plain():
+                data = serializers.ListSerializer(products, child=ProductSerializer(), context=context).data
+                return JSONRenderer().render(data)
+
+            def fragments(round):
+                # A product write bumps its generation, as the product signals do
+                response_cache.invalidate(*[f'product:{product.pk}' for product in products[round % count:][:dirty]])
+                return FragmentJSONRenderer().render(ProductSerializer(products, many=True, context=context).data)
+
+            if plain() != fragments(0):
+                raise CommandError('The fragment cache renders a different body.')
+            results = {}
+            for name, render in [('serializer', lambda round: plain()), ('fragments', fragments)]:
+                began = time.perf_counter()
+                for round in range(rounds):
+                    render(round)
+                results[name] = (time.perf_counter() - began) / rounds
+        finally:
+            category.delete()
+
+        for name, seconds in results.items():
+            self.stdout.write(f'{name}: {seconds * 1000:.2f} ms per page of {count}')
+        self.stdout.write(self.style.SUCCESS(
+            f"Speedup {results['serializer'] / results['fragments']:.1f}x with {dirty} of {count} products changed per page."
+        ))
@@ -0,0 +1,93 @@
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from accounts.models import CustomUser
+from products.models import Cart, Category, ContactInfo, Product
+from products.views import CartItemCreateView, CheckoutView
+
+
+class Command(BaseCommand):
+    help = (
+        'Add cart items and check carts out through their views from concurrent threads and report '
+        'throughput and failed writes. Run it with and without SQLITE_TUNING to compare. '
+        'Creates and removes its own fixtures.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=32, help='Number of concurrent threads.')
+        parser.add_argument('--writes', type=int, default=20, help='Writes per thread.')
+
+    def handle(self, *args, **options):
+        writers, writes = options['writers'], options['writes']
+        self.stdout.write(
+            f"{connection.vendor} ({settings.DATABASES['default']['ENGINE']}), "
+            f"tuning {'on' if settings.SQLITE_TUNING else 'off'}"
+        )
+        user = CustomUser.objects.create_user(email=f'bench-{uuid.uuid4().hex}@example.com')
+        ContactInfo.objects.create(user=user, email=user.email)
+        category = Category.objects.create(name=f'bench-{uuid.uuid4().hex}')
+        products = Product.objects.bulk_create([
+            Product(name=f'Benchmark product {i}', description='', image='', price=Decimal('1.00'),
+                    category=category, stock=writers * writes)
+            for i in range(writes)
+        ])
+        carts = Cart.objects.bulk_create([Cart(user=user) for _ in range(writers)])
+        factory = APIRequestFactory()
+        add_item, check_out = CartItemCreateView.as_view(), CheckoutView.as_view()
+        start = threading.Barrier(writers)
+
+        def write(view, data):
+            request = factory.post('/', data, format='json')
+            force_authenticate(request, user)
+            try:
+                response = view(request)
+            except Exception as ex:
+                return type(ex).__name__
+            return 'ok' if response.status_code == 201 else f'HTTP {response.status_code}'
+
+        def writer(cart):
+            outcomes = Counter()
+            try:
+                start.wait()
+                for i in range(writes):
+                    # Every item added is checked out by the next write
+                    if i % 2:
+                        outcomes[write(check_out, {'cart': cart.pk})] += 1
+                    else:
+                        data = {'cart': cart.pk, 'product': products[i].pk, 'quantity': 1}
+                        outcomes[write(add_item, data)] += 1
+            finally:
+                connection.close()
+            return outcomes
+
+        try:
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=writers) as pool:
+                outcomes = sum(pool.map(writer, carts), Counter())
+            elapsed = time.perf_counter() - began
+        finally:
+            user.delete()
+            for product in products:
+                product.delete()
+            category.delete()
+
+        total = writers * writes
+        failed = total - outcomes['ok']
+        self.stdout.write(
+            f"{total} writes from {writers} threads in {elapsed:.2f}s: "
+            f"{outcomes['ok'] / elapsed:.0f} successful writes/s, {failed} failed"
+        )
+        for outcome, count in sorted(outcomes.items()):
+            if outcome != 'ok':
+                self.stdout.write(f'  {outcome}: {count}')
+        style = self.style.SUCCESS if not failed else self.style.WARNING
+        self.stdout.write(style('No failed writes.' if not failed else f'{failed} writes failed.'))
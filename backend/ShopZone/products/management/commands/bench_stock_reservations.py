@@ -0,0 +1,90 @@
+import random
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+from django.db.models import Sum
+
+from accounts.models import CustomUser
+from products import stock
+from products.models import Cart, Category, Product, StockReservation
+
+# SQLite reports lock timeouts as OperationalError; a checkout retries that many times
+MAX_ATTEMPTS = 50
+
+
+class Command(BaseCommand):
+    help = (
+        'Run concurrent checkouts (reserve, then commit) against a single product and '
+        'fail if any unit is oversold. Creates and removes its own fixtures.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checkouts', type=int, default=500, help='Number of concurrent checkouts.')
+        parser.add_argument('--stock', type=int, default=100, help='Units of stock available.')
+        parser.add_argument('--quantity', type=int, default=1, help='Units bought per checkout.')
+
+    def handle(self, *args, **options):
+        checkouts, quantity = options['checkouts'], options['quantity']
+        user = CustomUser.objects.create_user(email=f'bench-{uuid.uuid4().hex}@example.com')
+        category = Category.objects.create(name=f'bench-{uuid.uuid4().hex}')
+        product = Product.objects.create(
+            name='Benchmark product', description='', image='', price=Decimal('1.00'),
+            category=category, stock=options['stock'],
+        )
+        carts = Cart.objects.bulk_create([Cart(user=user) for _ in range(checkouts)])
+        start = threading.Barrier(checkouts)
+
+        def attempt(step, *args):
+            # Each step is its own transaction, so only the failed one is retried
+            for attempt in range(MAX_ATTEMPTS):
+                try:
+                    step(*args)
+                    return True
+                except OperationalError:
+                    time.sleep(random.uniform(0, 0.01 * (attempt + 1)))
+            return False
+
+        def checkout(cart):
+            try:
+                start.wait()
+                if not attempt(stock.reserve, cart, product.pk, quantity):
+                    return 'gave up'
+                if not attempt(stock.commit, cart, {product.pk: quantity}):
+                    return 'gave up'
+                return 'sold'
+            except stock.InsufficientStock:
+                return 'sold out'
+            finally:
+                connection.close()
+
+        try:
+            began = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=checkouts) as pool:
+                outcomes = Counter(pool.map(checkout, carts))
+            elapsed = time.perf_counter() - began
+            product.refresh_from_db()
+            held = StockReservation.objects.filter(product=product).aggregate(total=Sum('quantity'))['total'] or 0
+        finally:
+            user.delete()
+            product.delete()
+            category.delete()
+
+        sold_units = outcomes['sold'] * quantity
+        self.stdout.write(
+            f"{checkouts} checkouts in {elapsed:.2f}s ({checkouts / elapsed:.0f}/s): "
+            f"{outcomes['sold']} sold, {outcomes['sold out']} sold out, {outcomes['gave up']} gave up"
+        )
+        self.stdout.write(f'Stock left: {product.stock}, reserved: {product.reserved}, held by carts: {held}')
+        if sold_units != options['stock'] - product.stock:
+            raise CommandError('Stock taken does not match the checkouts that succeeded.')
+        if product.reserved != held or product.reserved > product.stock:
+            raise CommandError('Reserved stock does not match the holds left behind.')
+        if outcomes['sold out'] and product.stock - product.reserved >= quantity:
+            raise CommandError('Checkouts were turned away while stock was still available.')
+        self.stdout.write(self.style.SUCCESS('No oversell.'))
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from products.images import GARBAGE_MIN_AGE, adopt_images, collect_garbage
+
+
+class Command(BaseCommand):
+    help = 'Delete product images and image variants that no product refers to any more.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--min-age', type=float, default=GARBAGE_MIN_AGE.total_seconds() / 3600,
+            help='Only delete files older than this many hours.',
+        )
+        parser.add_argument(
+            '--adopt', action='store_true',
+            help='First move images uploaded before content addressing onto shared blobs.',
+        )
+        parser.add_argument('--dry-run', action='store_true', help='Only list the files that would be deleted.')
+
+    def handle(self, *args, **options):
+        if options['adopt']:
+            adopted = adopt_images(dry_run=options['dry_run'])
+            self.stdout.write(f'Adopted {adopted} legacy image(s).')
+        deleted = collect_garbage(min_age=timedelta(hours=options['min_age']), dry_run=options['dry_run'])
+        for name in deleted:
+            self.stdout.write(name)
+        action = 'can be deleted' if options['dry_run'] else 'deleted'
+        self.stdout.write(self.style.SUCCESS(f'{len(deleted)} unreferenced file(s) {action}.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from products.payments import CALLBACK_BATCH_SIZE, drain_callbacks
+
+
+class Command(BaseCommand):
+    help = 'Apply queued M-Pesa STK push results to their payments.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=CALLBACK_BATCH_SIZE, help='Callbacks claimed per batch.')
+
+    def handle(self, *args, **options):
+        drained = 0
+        while True:
+            claimed = drain_callbacks(options['batch_size'])
+            if not claimed:
+                break
+            drained += claimed
+        self.stdout.write(self.style.SUCCESS(f'Drained {drained} callback(s).'))
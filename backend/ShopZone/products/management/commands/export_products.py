@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from products.bulk import FORMATS, export_lines
+
+
+class Command(BaseCommand):
+    help = 'Stream every product to a CSV or JSONL file (or stdout).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', help='Output file; defaults to stdout.')
+        parser.add_argument('--format', choices=FORMATS, default='csv')
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            for line in export_lines(options['format']):
+                self.stdout.write(line, ending='')
+            return
+        with open(options['path'], 'w', newline='', encoding='utf-8') as stream:
+            for line in export_lines(options['format']):
+                stream.write(line)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from products.carts import get_cart_store
+
+
+class Command(BaseCommand):
+    help = 'Write carts changed in the cart store back to the database; run periodically.'
+
+    def handle(self, *args, **options):
+        flushed = get_cart_store().flush()
+        self.stdout.write(self.style.SUCCESS(f'Wrote back {flushed} cart(s).'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from products.images import generate_variants, needs_variants
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = 'Generate the resized image variants of products that do not have them yet, e.g. after a worker restart.'
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').only('id', 'image', 'image_variants').order_by('id')
+        product_ids = [product.pk for product in products.iterator() if needs_variants(product)]
+        generated = 0
+        for product_id in product_ids:
+            try:
+                generated += generate_variants(product_id)
+            except FileNotFoundError:
+                self.stderr.write(f'Image of product {product_id} is missing; skipped.')
+        self.stdout.write(self.style.SUCCESS(f'Generated image variants for {generated} product(s).'))
@@ -0,0 +1,26 @@
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.bulk import FORMATS, IMPORT_CHUNK_SIZE, import_products
+
+
+class Command(BaseCommand):
+    help = 'Create or update products from a CSV or JSONL file, streaming it in chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import.')
+        parser.add_argument('--format', choices=FORMATS, help='Defaults to the file extension.')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE, help='Rows written per transaction.')
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lstrip('.').lower()
+        if format not in FORMATS:
+            raise CommandError(f'Cannot tell the format of {options["path"]}; pass --format.')
+        with open(options['path'], 'rb') as stream:
+            result = import_products(stream, format, chunk_size=options['chunk_size'])
+        for error in result.errors:
+            self.stderr.write(f"Line {error['line']}: {error['errors']}")
+        self.stdout.write(self.style.SUCCESS(
+            f'{result.created} created, {result.updated} updated, {result.failed} failed.'
+        ))
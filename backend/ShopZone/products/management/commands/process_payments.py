@@ -0,0 +1,28 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from products.models import Payment
+from products.payments import SENDING_TIMEOUT, process_payment, recover_stale
+
+
+class Command(BaseCommand):
+    help = (
+        'Perform the STK push for payments still queued, e.g. after a worker restart. '
+        'Payments stuck sending are requeued first, or failed after too many attempts.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=500, help='Maximum number of payments to process.')
+        parser.add_argument(
+            '--stale-after', type=int, default=int(SENDING_TIMEOUT.total_seconds() // 60),
+            help='Minutes after which a payment still sending is recovered.',
+        )
+
+    def handle(self, *args, **options):
+        requeued, failed = recover_stale(timedelta(minutes=options['stale_after']))
+        if requeued or failed:
+            self.stdout.write(f'Recovered {requeued + failed} stale payment(s): {requeued} requeued, {failed} failed.')
+        payment_ids = Payment.objects.filter(status='queued').order_by('id').values_list('id', flat=True)
+        processed = sum(process_payment(pk) for pk in list(payment_ids[:options['limit']]))
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} queued payment(s).'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from products.facets import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Recompute the catalogue facet counts from the products.'
+
+    def handle(self, *args, **options):
+        combinations = rebuild()
+        self.stdout.write(self.style.SUCCESS(f'{combinations} facet counts stored.'))
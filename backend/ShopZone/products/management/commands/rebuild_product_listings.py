@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from products.listings import REBUILD_BATCH_SIZE, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Rewrite the catalogue listing rows from the products.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=REBUILD_BATCH_SIZE, help='Products written per batch.')
+
+    def handle(self, *args, **options):
+        written = rebuild(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'{written} listings rebuilt.'))
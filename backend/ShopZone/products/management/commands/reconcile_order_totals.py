@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from products.orders import RECONCILE_BATCH_SIZE, reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recompute total_amount and item_count for orders whose stored values drifted from their items.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RECONCILE_BATCH_SIZE, help='Orders updated per batch.')
+        parser.add_argument('--dry-run', action='store_true', help='Only count the orders that drifted.')
+
+    def handle(self, *args, **options):
+        drifted = reconcile(batch_size=options['batch_size'], dry_run=options['dry_run'])
+        action = 'need reconciling' if options['dry_run'] else 'reconciled'
+        self.stdout.write(self.style.SUCCESS(f'{drifted} orders {action}.'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from products.stock import RELEASE_BATCH_SIZE, release_expired
+
+
+class Command(BaseCommand):
+    help = 'Release expired cart stock holds back to the products they were taken from.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=RELEASE_BATCH_SIZE, help='Holds released per batch.')
+
+    def handle(self, *args, **options):
+        released = 0
+        while True:
+            count = release_expired(options['batch_size'])
+            if not count:
+                break
+            released += count
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired hold(s).'))
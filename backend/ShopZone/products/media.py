@@ -0,0 +1,159 @@
+"""
+Serving uploaded media.
+
+`serve` answers requests under MEDIA_URL in every environment. It handles
+conditional requests itself (ETag/If-None-Match, If-Modified-Since) and
+then, depending on `settings.MEDIA_SERVE_MODE`:
+
+- 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd): returns
+  an empty response with the header naming the file, so the front proxy
+  streams it and handles Range requests.
+- 'python': streams the file with `FileResponse`. Whole files go through
+  the server's `wsgi.file_wrapper`, which uses `os.sendfile` where the
+  server supports it; single byte ranges are streamed from the file.
+
+Content-addressed images (see `products.storage`) never change, so they are
+sent with an immutable, year-long Cache-Control and their digest as ETag.
+"""
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+
+from .storage import is_blob_name
+
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def serve(request, path):
+    """
+    Serve the media file at `path` below MEDIA_ROOT.
+
+    HTTP Methods:
+    - GET, HEAD
+
+    Response:
+    - 200/206 with the file or the requested byte range, 304 when the client's copy
+      is current, 416 for an unsatisfiable range, 404 when there is no such file.
+    """
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('No such file.')
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('No such file.')
+    if not os.path.isfile(full_path):
+        raise Http404('No such file.')
+
+    immutable = is_blob_name(path)
+    if immutable:
+        etag = quote_etag(os.path.splitext(os.path.basename(path))[0])
+    else:
+        etag = quote_etag(f'{stat.st_mtime_ns:x}-{stat.st_size:x}')
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE_CONTROL if immutable else f'public, max-age={settings.MEDIA_CACHE_MAX_AGE}',
+    }
+    not_modified = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if not_modified is not None:
+        for header in ('ETag', 'Last-Modified', 'Cache-Control'):
+            not_modified.setdefault(header, headers[header])
+        return not_modified
+
+    content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+    mode = settings.MEDIA_SERVE_MODE
+    if mode == 'x-accel-redirect':
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + quote(path)
+        return response
+    if mode == 'x-sendfile':
+        response = HttpResponse(content_type=content_type, headers=headers)
+        response['X-Sendfile'] = full_path
+        return response
+
+    headers['Accept-Ranges'] = 'bytes'
+    byte_range = requested_range(request, etag, stat.st_size)
+    if byte_range == 'unsatisfiable':
+        response = HttpResponse(status=416, headers=headers)
+        response['Content-Range'] = f'bytes */{stat.st_size}'
+        return response
+    file = open(full_path, 'rb')
+    if byte_range is None:
+        return FileResponse(file, content_type=content_type, headers=headers)
+
+    start, end = byte_range
+    file.seek(start)
+    response = FileResponse(FileRange(file, end - start + 1), status=206, content_type=content_type, headers=headers)
+    response['Content-Length'] = end - start + 1
+    response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+    return response
+
+
+def requested_range(request, etag, size):
+    """
+    Parse a single-range Range header into an inclusive (start, end) pair.
+
+    Returns:
+    - tuple: The byte range to send.
+    - None: Send the whole file (no Range, a stale If-Range, or several ranges).
+    - str: 'unsatisfiable' when the range lies outside the file.
+    """
+    header = request.META.get('HTTP_RANGE', '')
+    if not header or request.method not in ('GET', 'HEAD'):
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != etag:
+        return None
+    match = RANGE.match(header.replace(' ', ''))
+    if match is None or match.groups() == ('', ''):
+        # Multiple ranges are allowed to be answered with the whole file
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            # A syntactically invalid range is ignored
+            return None
+        if start >= size:
+            return 'unsatisfiable'
+    else:
+        # 'bytes=-500' asks for the last 500 bytes
+        if not int(last):
+            return 'unsatisfiable'
+        start, end = max(size - int(last), 0), size - 1
+    return start, end
+
+
+class FileRange:
+    """
+    A file object that ends after `length` bytes from its current position.
+
+    It has no fileno(), so servers stream it with read() rather than
+    sendfile, which would run on to the end of the file.
+    """
+
+    def __init__(self, file, length):
+        self.file = file
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.file.close()
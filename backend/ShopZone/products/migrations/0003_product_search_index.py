@@ -0,0 +1,57 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    "CREATE VIRTUAL TABLE products_product_fts USING fts5("
+    "name, category, description, tokenize='unicode61 remove_diacritics 2', prefix='2 3')",
+    "CREATE VIRTUAL TABLE products_product_fts_vocab USING fts5vocab(products_product_fts, row)",
+    "INSERT INTO products_product_fts(rowid, name, category, description) "
+    "SELECT p.id, p.name, c.name, p.description FROM products_product p "
+    "JOIN products_category c ON c.id = p.category_id",
+]
+SQLITE_BACKWARD = [
+    "DROP TABLE IF EXISTS products_product_fts_vocab",
+    "DROP TABLE IF EXISTS products_product_fts",
+]
+
+POSTGRES_FORWARD = [
+    "CREATE TABLE products_product_search ("
+    "product_id bigint PRIMARY KEY REFERENCES products_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "document tsvector NOT NULL)",
+    "CREATE INDEX products_product_search_document_idx ON products_product_search USING GIN (document)",
+    "INSERT INTO products_product_search (product_id, document) "
+    "SELECT p.id, setweight(to_tsvector('simple', p.name), 'A') || "
+    "setweight(to_tsvector('simple', c.name), 'B') || "
+    "setweight(to_tsvector('simple', p.description), 'C') "
+    "FROM products_product p JOIN products_category c ON c.id = p.category_id",
+    # Typo fallback for search; skipped when the role may not install extensions
+    "DO $$ BEGIN "
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm; "
+    "CREATE INDEX IF NOT EXISTS products_product_name_trgm_idx ON products_product USING GIN (lower(name) gin_trgm_ops); "
+    "EXCEPTION WHEN insufficient_privilege OR undefined_file THEN NULL; "
+    "END $$",
+]
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS products_product_name_trgm_idx",
+    "DROP TABLE IF EXISTS products_product_search",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, ()):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0002_cartitem_items_related_name'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.0 on 2026-10-18 18:17
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_totals(apps, schema_editor):
+    Order = apps.get_model('products', 'Order')
+    OrderItem = apps.get_model('products', 'OrderItem')
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    money = DecimalField(max_digits=8, decimal_places=2)
+    line_total = ExpressionWrapper(F('quantity') * F('price'), output_field=money)
+    Order.objects.update(
+        total_amount=Coalesce(Subquery(items.annotate(total=Sum(line_total)).values('total')), Value(Decimal('0')), output_field=money),
+        item_count=Coalesce(Subquery(items.annotate(count=Sum('quantity')).values('count')), Value(0)),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0007_stock_reservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='item_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=8),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0 on 2026-10-18 18:27
+
+from django.db import migrations, models
+from django.db.models import Count, Min
+
+
+def merge_duplicate_categories(apps, schema_editor):
+    # Every product create used to add a category, so fold same-named ones into the oldest
+    Category = apps.get_model('products', 'Category')
+    Product = apps.get_model('products', 'Product')
+    duplicates = Category.objects.values('name').annotate(copies=Count('id'), keep=Min('id')).filter(copies__gt=1)
+    for duplicate in duplicates:
+        others = Category.objects.filter(name=duplicate['name']).exclude(pk=duplicate['keep'])
+        Product.objects.filter(category__in=others).update(category_id=duplicate['keep'])
+        others.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0009_cartitem_unique_product'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_categories, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='category',
+            name='name',
+            field=models.CharField(max_length=200, unique=True),
+        ),
+    ]
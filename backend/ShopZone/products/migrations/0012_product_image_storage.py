@@ -0,0 +1,19 @@
+# Generated by Django 5.0 on 2026-10-18 18:33
+
+import products.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_product_image_variants'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='product',
+            name='image',
+            field=models.ImageField(storage=products.storage.get_product_image_storage, upload_to='products/'),
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.0 on 2026-10-18 18:49
+
+from decimal import Decimal
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+
+
+def count_products(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    ProductFacet = apps.get_model('products', 'ProductFacet')
+    edges = [Decimal(str(edge)) for edge in settings.PRODUCT_PRICE_BUCKETS]
+    bucket = Case(
+        *[When(price__lt=edge, then=Value(i)) for i, edge in enumerate(edges)],
+        default=Value(len(edges)), output_field=IntegerField(),
+    )
+    rows = (
+        Product.objects.order_by()
+        .annotate(price_bucket=bucket, in_stock=Q(stock__gt=0))
+        .values('category_id', 'price_bucket', 'in_stock')
+        .annotate(product_count=Count('pk'))
+    )
+    ProductFacet.objects.bulk_create([ProductFacet(**row) for row in rows])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0013_query_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductFacet',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('price_bucket', models.PositiveSmallIntegerField()),
+                ('in_stock', models.BooleanField()),
+                ('product_count', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='products.category')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='productfacet',
+            constraint=models.UniqueConstraint(fields=('category', 'price_bucket', 'in_stock'), name='productfacet_key_unique'),
+        ),
+        migrations.RunPython(count_products, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 5.0 on 2026-10-18 18:53
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def thumbnail(product):
+    if not product.image:
+        return ''
+    variants = product.image_variants or {}
+    if variants.get('source') == product.image.name:
+        for format in ('webp', 'jpeg'):
+            widths = sorted((int(width), name) for width, name in variants.get(format, {}).items())
+            if widths:
+                fits = [name for width, name in widths if width >= settings.PRODUCT_THUMBNAIL_WIDTH]
+                return default_storage.url(fits[0] if fits else widths[-1][1])
+    return product.image.url
+
+
+def list_products(apps, schema_editor):
+    Product = apps.get_model('products', 'Product')
+    ProductListing = apps.get_model('products', 'ProductListing')
+    now = timezone.now()
+    rows = []
+    for product in Product.objects.select_related('category').order_by('pk').iterator(chunk_size=1000):
+        rows.append(ProductListing(
+            id=product.pk,
+            name=product.name,
+            price=product.price,
+            category_id=product.category_id,
+            category_name=product.category.name,
+            thumbnail=thumbnail(product),
+            in_stock=product.stock > 0,
+            updated_at=now,
+        ))
+        if len(rows) >= 1000:
+            ProductListing.objects.bulk_create(rows)
+            rows = []
+    ProductListing.objects.bulk_create(rows)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0014_product_facets'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductListing',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=200)),
+                ('price', models.DecimalField(decimal_places=2, max_digits=8)),
+                ('category_id', models.BigIntegerField()),
+                ('category_name', models.CharField(max_length=200)),
+                ('thumbnail', models.CharField(blank=True, max_length=500)),
+                ('in_stock', models.BooleanField()),
+                ('updated_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['price', 'id'], name='listing_price_idx'), models.Index(fields=['name', 'id'], name='listing_name_idx'), models.Index(fields=['category_id', 'id'], name='listing_category_idx'), models.Index(fields=['updated_at', 'id'], name='listing_updated_idx')],
+            },
+        ),
+        migrations.RunPython(list_products, migrations.RunPython.noop),
+    ]
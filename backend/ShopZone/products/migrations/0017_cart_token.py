@@ -0,0 +1,34 @@
+# Generated by Django 5.0 on 2026-10-18 20:12
+
+import uuid
+
+from django.db import migrations, models
+
+
+def issue_tokens(apps, schema_editor):
+    Cart = apps.get_model('products', 'Cart')
+    carts = list(Cart.objects.only('pk'))
+    for cart in carts:
+        cart.token = uuid.uuid4()
+    Cart.objects.bulk_update(carts, ['token'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0016_order_paid_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='token',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(issue_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='cart',
+            name='token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+    ]
@@ -0,0 +1,145 @@
+import hashlib
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from . import cache as response_cache
+from . import replicas, write_queue
+
+
+class EagerLoadingViewMixin:
+    """
+    Applies the query shaping declared on the view's serializer
+    (see `serializers.EagerLoadingMixin`) to the view's queryset, so the
+    number of queries per page stays constant regardless of page size.
+    """
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        setup_eager_loading = getattr(self.get_serializer_class(), 'setup_eager_loading', None)
+        if setup_eager_loading is not None:
+            queryset = setup_eager_loading(queryset)
+        return queryset
+
+
+class OwnedQuerysetMixin:
+    """
+    Restricts the view's queryset to rows owned by the requesting user so the
+    database filters them; staff users keep access to every row.
+    """
+    owner_field = 'user'
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        user = self.request.user
+        if user.is_staff:
+            return queryset
+        return queryset.filter(**{self.owner_field: user})
+
+
+class CachedResponseMixin:
+    """
+    Serves GET responses from the catalogue cache (see `products.cache`).
+
+    `cache_scopes` lists the invalidation scopes the response depends on and
+    may reference URL kwargs, e.g. 'product:{pk}'. Only the response data is
+    cached, so content negotiation still happens per request.
+    """
+    cache_scopes = ()
+
+    def get_cache_scopes(self):
+        return [scope.format(**self.kwargs) for scope in self.cache_scopes]
+
+    def get(self, request, *args, **kwargs):
+        cache = response_cache.get_cache()
+        key = response_cache.response_key(request, self.get_cache_scopes())
+        data = cache.get(key)
+        if data is not None:
+            response_cache.record('hits')
+            response = Response(data)
+            response['X-Cache'] = 'HIT'
+            return response
+
+        response_cache.record('misses')
+        # The body is served until the next invalidation, so it must not come from a lagging replica
+        with replicas.read_from_primary():
+            response = super().get(request, *args, **kwargs)
+        if response.status_code == 200:
+            cache.set(key, response.data, settings.CATALOGUE_CACHE_TIMEOUT)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+class ConditionalGetMixin:
+    """
+    Answers conditional GETs (If-None-Match / If-Modified-Since) with 304
+    before the response body is built.
+
+    The validators come from a single aggregate over the view's filtered
+    queryset: the row count plus the latest value of each field in
+    `last_modified_fields`. Detail views aggregate over the one looked-up row;
+    responses depending on more rows than they list widen
+    `get_validator_queryset`.
+    """
+    last_modified_fields = ['updated_at']
+
+    def get_validator_queryset(self):
+        return self.filter_queryset(self.get_queryset())
+
+    def get_validators(self):
+        queryset = self.get_validator_queryset()
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        if lookup_url_kwarg in self.kwargs:
+            queryset = queryset.filter(**{self.lookup_field: self.kwargs[lookup_url_kwarg]})
+        aggregates = {f'latest_{i}': Max(field) for i, field in enumerate(self.last_modified_fields)}
+        values = queryset.order_by().aggregate(count=Count('pk'), **aggregates)
+
+        timestamps = [values[key] for key in aggregates if values[key] is not None]
+        last_modified = max(timestamps) if timestamps else None
+        fingerprint = '%s|%s|%s' % (self.request.get_full_path(), values['count'], sorted(
+            value.isoformat() for value in timestamps
+        ))
+        etag = quote_etag(hashlib.md5(fingerprint.encode()).hexdigest())
+        return etag, last_modified
+
+    def get(self, request, *args, **kwargs):
+        etag, last_modified = self.get_validators()
+        timestamp = int(last_modified.timestamp()) if last_modified else None
+
+        response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        if response.status_code in (200, 304):
+            response['ETag'] = etag
+            if timestamp is not None:
+                response['Last-Modified'] = http_date(timestamp)
+        return response
+
+
+class ReplicaReadMixin:
+    """
+    Runs the reads of safe requests on a database replica (see
+    `products.replicas`), unless the client wrote recently and has to see
+    its own writes.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in SAFE_METHODS or replicas.is_pinned(request):
+            return super().dispatch(request, *args, **kwargs)
+        with replicas.read_from_replicas():
+            return super().dispatch(request, *args, **kwargs)
+
+
+class QueuedWriteMixin:
+    """
+    Handles creates through the write queue (see `products.write_queue`), so
+    concurrent creates on SQLite wait their turn instead of failing with
+    "database is locked".
+    """
+
+    def create(self, request, *args, **kwargs):
+        return write_queue.run(super().create, request, *args, **kwargs)
@@ -1,9 +1,13 @@
-from django.db import models
+import uuid
+
+from django.db import models, transaction
 from accounts.models import CustomUser
 from phonenumber_field.modelfields import PhoneNumberField
+from .storage import get_product_image_storage
 
 class Category(models.Model):
-    name = models.CharField(max_length=200)
+    name = models.CharField(max_length=200, unique=True)
+    updated_at = models.DateTimeField(auto_now=True)
     
     def __str__(self):
         return self.name
@@ -11,26 +15,103 @@ class Category(models.Model):
 class Product(models.Model):
     name = models.CharField(max_length=200)
     description = models.TextField()
-    image = models.ImageField(upload_to='products/')
+    # Stored once per distinct content (see `products.storage`)
+    image = models.ImageField(upload_to='products/', storage=get_product_image_storage)
+    # Resized WebP/JPEG copies of `image`, built in the background (see `products.images`)
+    image_variants = models.JSONField(default=dict, blank=True, editable=False)
     price = models.DecimalField(max_digits=8, decimal_places=2)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     stock = models.PositiveIntegerField(default=0)
+    # Units held by carts (see `products.stock`); stock - reserved can still be sold
+    reserved = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # Client orderings, each with the id tiebreaker keyset pages append
+            models.Index(fields=['price', 'id'], name='product_price_idx'),
+            models.Index(fields=['name', 'id'], name='product_name_idx'),
+            models.Index(fields=['stock', 'id'], name='product_stock_idx'),
+            # Covers the list validators (count, latest update, category join) without reading rows
+            models.Index(fields=['updated_at', 'category'], name='product_updated_idx'),
+            # Browsing a category's in-stock products by price
+            models.Index(
+                fields=['category', 'price', 'id'], condition=models.Q(stock__gt=0), name='product_in_stock_idx'
+            ),
+            # The newest in-stock products, the default list order under ?in_stock=true
+            models.Index(fields=['id'], condition=models.Q(stock__gt=0), name='product_in_stock_id_idx'),
+        ]
     
     def __str__(self):
         return self.name
 
+class ProductFacet(models.Model):
+    """
+    Number of products in a category, price bucket and stock state, kept up
+    to date as products change (see `products.facets`).
+    """
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    price_bucket = models.PositiveSmallIntegerField()
+    in_stock = models.BooleanField()
+    product_count = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'price_bucket', 'in_stock'], name='productfacet_key_unique'),
+        ]
+
+class ProductListing(models.Model):
+    """
+    Catalogue listing row of a product, with everything a product card shows
+    already rendered. Kept in step with products by `products.listings`.
+    """
+    # The product's id; no foreign key, so listings are read without joins
+    id = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=200)
+    price = models.DecimalField(max_digits=8, decimal_places=2)
+    category_id = models.BigIntegerField()
+    category_name = models.CharField(max_length=200)
+    thumbnail = models.CharField(max_length=500, blank=True)
+    in_stock = models.BooleanField()
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # Listing orderings, and the rows a category rename rewrites
+            models.Index(fields=['price', 'id'], name='listing_price_idx'),
+            models.Index(fields=['name', 'id'], name='listing_name_idx'),
+            models.Index(fields=['category_id', 'id'], name='listing_category_idx'),
+            # Covers the list validators (count, latest update) without reading rows
+            models.Index(fields=['updated_at', 'id'], name='listing_updated_idx'),
+        ]
+
 class Cart(models.Model):
-    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
+    # Anonymous carts have no user until they are claimed at login (see `carts.claim`)
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Proves possession of an anonymous cart, whose sequential id is guessable
+    token = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
 
 class CartItem(models.Model):
-    cart = models.ForeignKey(Cart, on_delete=models.CASCADE)
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='items')
     product = models.ForeignKey(Product, on_delete=models.CASCADE)
     quantity = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['cart', 'product'], name='cartitem_cart_product_unique'),
+        ]
     
     def get_total_cost(self):
         return self.quantity * self.product.price
 
+class StockReservation(models.Model):
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
 class ContactInfo(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE)
     email = models.EmailField(max_length=255, null=True, blank=True)
@@ -44,17 +125,26 @@ class Order(models.Model):
     )
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE)
     cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='orders')
-    total_amount = models.DecimalField(max_digits=8, decimal_places=2)
+    # Maintained incrementally as items change (see `products.orders`)
+    total_amount = models.DecimalField(max_digits=8, decimal_places=2, default=0)
+    item_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='processing')
+    # Set when an M-Pesa payment for the order succeeds (see `payments.apply_result`)
+    paid_at = models.DateTimeField(null=True, blank=True)
     contact_info = models.ForeignKey(ContactInfo, on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            # A customer's orders by status, and the back office's status queues by date
+            models.Index(fields=['user', 'status'], name='order_user_status_idx'),
+            models.Index(fields=['status', 'created_at'], name='order_status_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
-        if not self.contact_info:
+        if not self.contact_info_id:
             profile = self.user.profile
             self.contact_info = profile.contact_info
-        # Calculate total_amount by summing up the total cost of all order items
-        self.total_amount = sum(item.get_total_cost() for item in self.items.all())
         super().save(*args, **kwargs)
 
 class OrderItem(models.Model):
@@ -66,6 +156,20 @@ class OrderItem(models.Model):
     def get_total_cost(self):
         return self.quantity * self.price
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What the order's totals already include, so saves can apply a delta
+        # without reading the row again
+        if not instance.get_deferred_fields() & {'order_id', 'quantity', 'price'}:
+            instance._counted = (instance.order_id, instance.quantity, instance.price)
+        return instance
+
+    def save(self, *args, **kwargs):
+        # The item and its order's totals change together
+        with transaction.atomic(using=kwargs.get('using')):
+            super().save(*args, **kwargs)
+
 class Profile(models.Model):
     user = models.OneToOneField(CustomUser, on_delete=models.CASCADE)
     contact_info = models.OneToOneField(ContactInfo, on_delete=models.CASCADE, null=True, blank=True)
@@ -78,3 +182,58 @@ class Profile(models.Model):
         if not self.contact_info:
             self.contact_info = ContactInfo.objects.create()
         super().save(*args, **kwargs)
+
+class Payment(models.Model):
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('sending', 'Sending'),
+        ('sent', 'Sent'),
+        ('paid', 'Paid'),
+        ('failed', 'Failed'),
+    )
+    user = models.ForeignKey(CustomUser, on_delete=models.SET_NULL, null=True, blank=True)
+    order = models.ForeignKey(Order, on_delete=models.SET_NULL, null=True, blank=True, related_name='payments')
+    phone_number = models.CharField(max_length=20)
+    amount = models.PositiveIntegerField()
+    account_reference = models.CharField(max_length=12)
+    transaction_desc = models.CharField(max_length=13)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    merchant_request_id = models.CharField(max_length=100, blank=True)
+    checkout_request_id = models.CharField(max_length=100, blank=True, db_index=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    error = models.TextField(blank=True)
+    result_code = models.IntegerField(null=True, blank=True)
+    mpesa_receipt_number = models.CharField(max_length=50, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # process_payments picks up payments still queued
+            models.Index(fields=['id'], condition=models.Q(status='queued'), name='payment_queued_idx'),
+        ]
+        constraints = [
+            # Results are matched to payments by Daraja's id, which is blank until the push is sent
+            models.UniqueConstraint(
+                fields=['checkout_request_id'], condition=~models.Q(checkout_request_id=''),
+                name='payment_checkout_request_id_unique',
+            ),
+        ]
+
+class PaymentCallback(models.Model):
+    """
+    Append-only queue of STK push results received from Daraja, drained in
+    batches by `payments.drain_callbacks`.
+    """
+    checkout_request_id = models.CharField(max_length=100, unique=True)
+    payload = models.JSONField()
+    received_at = models.DateTimeField(auto_now_add=True)
+    claimed_by = models.CharField(max_length=32, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(processed_at__isnull=True), name='paymentcallback_pending_idx'),
+        ]
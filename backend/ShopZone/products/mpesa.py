@@ -0,0 +1,115 @@
+"""
+Daraja (M-Pesa) API client used by the payment workers.
+
+Unlike `django_daraja.mpesa.core.MpesaClient`, which fetches its token from
+the database and opens a new HTTP connection per call, a `DarajaClient`
+keeps the OAuth access token in memory until shortly before it expires and
+sends every request through one pooled `requests.Session`. A single
+process-wide client is shared by all worker threads (see `get_client`).
+"""
+import base64
+import threading
+import time
+from datetime import datetime
+
+import requests
+from django.conf import settings
+from django_daraja.mpesa.exceptions import MpesaConnectionError, MpesaError
+from django_daraja.mpesa.utils import api_base_url, format_phone_number, mpesa_config
+from requests.adapters import HTTPAdapter
+
+# Tokens are refreshed this many seconds before Daraja says they expire
+TOKEN_EXPIRY_MARGIN = 60
+
+
+class DarajaClient:
+
+    def __init__(self, base_url=None, consumer_key=None, consumer_secret=None, pool_size=10, timeout=10):
+        self.base_url = (base_url or api_base_url()).rstrip('/') + '/'
+        self.consumer_key = consumer_key or mpesa_config('MPESA_CONSUMER_KEY')
+        self.consumer_secret = consumer_secret or mpesa_config('MPESA_CONSUMER_SECRET')
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+    def access_token(self, refresh=False):
+        with self._token_lock:
+            if refresh or self._token is None or time.monotonic() >= self._token_expires_at:
+                response = self._request(
+                    'get', 'oauth/v1/generate?grant_type=client_credentials',
+                    auth=(self.consumer_key, self.consumer_secret),
+                )
+                if response.status_code != 200:
+                    raise MpesaError('Unable to generate access token')
+                payload = response.json()
+                self._token = payload['access_token']
+                expires_in = int(payload.get('expires_in', 3599))
+                self._token_expires_at = time.monotonic() + max(expires_in - TOKEN_EXPIRY_MARGIN, 0)
+            return self._token
+
+    def stk_push(self, phone_number, amount, account_reference, transaction_desc, callback_url):
+        """
+        Send an STK push prompt to a customer's phone.
+
+        Returns:
+        - dict: The decoded Daraja response, including `CheckoutRequestID` on success.
+        """
+        if mpesa_config('MPESA_ENVIRONMENT') == 'sandbox':
+            short_code = mpesa_config('MPESA_EXPRESS_SHORTCODE')
+        else:
+            short_code = mpesa_config('MPESA_SHORTCODE')
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(
+            (short_code + mpesa_config('MPESA_PASSKEY') + timestamp).encode('ascii')
+        ).decode('utf-8')
+        phone_number = format_phone_number(phone_number)
+        data = {
+            'BusinessShortCode': short_code,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': amount,
+            'PartyA': phone_number,
+            'PartyB': short_code,
+            'PhoneNumber': phone_number,
+            'CallBackURL': callback_url,
+            'AccountReference': account_reference,
+            'TransactionDesc': transaction_desc,
+        }
+        response = self._post_authorized('mpesa/stkpush/v1/processrequest', data)
+        if response.status_code == 401:
+            # The token was revoked or expired early; fetch a new one once
+            self.access_token(refresh=True)
+            response = self._post_authorized('mpesa/stkpush/v1/processrequest', data)
+        return response.json()
+
+    def _post_authorized(self, path, data):
+        headers = {'Authorization': 'Bearer ' + self.access_token()}
+        return self._request('post', path, json=data, headers=headers)
+
+    def _request(self, method, path, **kwargs):
+        try:
+            return self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException as ex:
+            raise MpesaConnectionError(str(ex))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = DarajaClient(
+                base_url=settings.MPESA_API_BASE_URL or None,
+                pool_size=settings.MPESA_WORKERS,
+                timeout=settings.MPESA_HTTP_TIMEOUT,
+            )
+        return _client
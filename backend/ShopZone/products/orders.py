@@ -0,0 +1,82 @@
+"""
+Denormalised order totals.
+
+`Order.total_amount` and `Order.item_count` (units across all items) are
+never recomputed from the items on save. Instead every `OrderItem` write
+applies the difference it makes as an F-expression delta (see
+`products.signals`), so an order row is touched once per item change and
+never read back. Writes that bypass signals, such as `bulk_create` in
+`checkout.checkout`, set the totals themselves; `reconcile` repairs any
+drift in bulk.
+"""
+from decimal import Decimal
+
+from django.db.models import DecimalField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from .models import Order, OrderItem
+
+RECONCILE_BATCH_SIZE = 1000
+
+
+def snapshot(item):
+    """
+    The (order id, quantity, price) an item contributes to its order's totals.
+    """
+    return item.order_id, item.quantity, item.price
+
+
+def apply_delta(previous, current):
+    """
+    Move an order's totals from an item's `previous` snapshot to its
+    `current` one. Either may be None for a created or deleted item.
+    """
+    deltas = {}
+    for snapshot_, sign in ((previous, -1), (current, 1)):
+        if snapshot_ is None:
+            continue
+        order_id, quantity, price = snapshot_
+        amount, count = deltas.get(order_id, (Decimal('0'), 0))
+        deltas[order_id] = (amount + sign * quantity * Decimal(price), count + sign * quantity)
+    for order_id, (amount, count) in deltas.items():
+        if amount or count:
+            Order.objects.filter(pk=order_id).update(
+                total_amount=F('total_amount') + amount, item_count=F('item_count') + count
+            )
+
+
+def item_totals():
+    """
+    Subqueries computing an order's actual total and unit count from its items.
+    """
+    items = OrderItem.objects.filter(order=OuterRef('pk')).order_by().values('order')
+    line_total = ExpressionWrapper(F('quantity') * F('price'), output_field=DecimalField(max_digits=8, decimal_places=2))
+    total = Subquery(items.annotate(total=Sum(line_total)).values('total'))
+    count = Subquery(items.annotate(count=Sum('quantity')).values('count'))
+    return (
+        Coalesce(total, Value(Decimal('0')), output_field=DecimalField(max_digits=8, decimal_places=2)),
+        Coalesce(count, Value(0)),
+    )
+
+
+def reconcile(batch_size=RECONCILE_BATCH_SIZE, dry_run=False):
+    """
+    Recompute the totals of every order whose stored values have drifted
+    from its items, one UPDATE per batch of orders.
+
+    Returns:
+    - int: Number of orders that had drifted.
+    """
+    total, count = item_totals()
+    drifted = Order.objects.annotate(actual_total=total, actual_count=count).filter(
+        ~Q(total_amount=F('actual_total')) | ~Q(item_count=F('actual_count'))
+    )
+    fixed, last_id = 0, 0
+    while True:
+        ids = list(drifted.filter(pk__gt=last_id).order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not ids:
+            return fixed
+        if not dry_run:
+            Order.objects.filter(pk__in=ids).update(total_amount=total, item_count=count)
+        fixed += len(ids)
+        last_id = ids[-1]
@@ -1,4 +1,159 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+
+from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, CursorPagination, _reverse_ordering
+
+MAX_PAGE_SIZE = 100
+
 
 class SmallSetPagination(PageNumberPagination):
-    page_size = 3
\ No newline at end of file
+    page_size = 3
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Keyset (cursor) pagination, opted into by sending a `cursor` query
+    parameter (left empty for the first page) and following the `next` and
+    `previous` links from there.
+
+    Cursors hold the whole sort key, the ordering field and the id
+    tiebreaker, and each page seeks straight past it: first to the rows
+    tied with the cursor on the ordering field, then to the rows after that
+    value, one indexed range scan each (see `seek`). Deep pages therefore
+    cost the same as the first one even when many rows share a value, and
+    no COUNT query is issued. Requests without a `cursor` parameter are
+    handed to `fallback_class`, or left unpaginated when it is None, so
+    existing clients keep working.
+    """
+    ordering = '-id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+    # Appended to client orderings so rows sharing a sort value keep a stable order
+    tiebreaker = 'id'
+    fallback_class = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.fallback = None
+        if self.cursor_query_param not in request.query_params:
+            if self.fallback_class is None:
+                return None
+            self.fallback = self.fallback_class()
+            return self.fallback.paginate_queryset(queryset, request, view)
+
+        # CursorPagination.paginate_queryset, seeking on the whole sort key
+        # instead of its first field plus an offset past the ties
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            offset, reverse, current_position = 0, False, None
+        else:
+            offset, reverse, current_position = self.cursor
+
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        # One extra row tells whether another page follows
+        results = self.seek(queryset.order_by(*ordering), ordering, current_position, offset + self.page_size + 1)
+        results = results[offset:]
+        self.page = results[:self.page_size]
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def seek(self, queryset, ordering, position, limit):
+        """
+        Return up to `limit` rows of `queryset`, sorted by `ordering`, that
+        come after `position`.
+
+        A row comes after the key (v1, v2) when it has f1 past v1, or f1 = v1
+        and f2 past v2. SQLite does not seek an index on that disjunction (nor
+        on the row value comparison), so each branch runs as its own query,
+        the most specific first, and later ones only fill what is left.
+        """
+        if position is None:
+            return list(queryset[:limit])
+        values = self.decode_position(position, ordering)
+        results = []
+        try:
+            for i in reversed(range(len(ordering))):
+                field = ordering[i].lstrip('-')
+                lookup = 'lt' if ordering[i].startswith('-') else 'gt'
+                ties = {key.lstrip('-'): value for key, value in zip(ordering[:i], values)}
+                results += queryset.filter(**ties, **{f'{field}__{lookup}': values[i]})[:limit - len(results)]
+                if len(results) >= limit:
+                    break
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+        return results
+
+    def decode_position(self, position, ordering):
+        try:
+            values = json.loads(position)
+        except ValueError:
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(values, list) or len(values) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+        return values
+
+    def _get_position_from_instance(self, instance, ordering):
+        values = []
+        for key in ordering:
+            field = key.lstrip('-')
+            values.append(str(instance[field] if isinstance(instance, dict) else getattr(instance, field)))
+        return json.dumps(values)
+
+    def get_paginated_response(self, data):
+        if self.fallback is not None:
+            return self.fallback.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.fallback is not None:
+            return self.fallback.to_html()
+        return super().to_html()
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        if any(field.lstrip('-') in (self.tiebreaker, 'pk') for field in ordering):
+            return ordering
+        direction = '-' if ordering[0].startswith('-') else ''
+        return (*ordering, direction + self.tiebreaker)
+
+
+class CatalogPagination(KeysetPagination):
+    """
+    Product catalogue pagination: keyset pages for infinite-scroll clients,
+    numbered pages (with a total count) for everyone else.
+    """
+    page_size = SmallSetPagination.page_size
+    fallback_class = SmallSetPagination
@@ -0,0 +1,315 @@
+"""
+Background STK push pipeline.
+
+Request handlers only create a `Payment` row and call `enqueue`; once the
+surrounding transaction commits, the payment id is handed to a small
+process-wide thread pool that performs the push through the shared
+`DarajaClient`. Payments left queued by a restart are picked up again by
+the `process_payments` management command, which also requeues (or, after
+`MAX_PUSH_ATTEMPTS`, fails) payments a worker claimed but never finished.
+
+Daraja's results come back through `stk_push_callback`, which only appends
+them to the `PaymentCallback` queue table. `drain_callbacks` applies them to
+their payments in batches; any number of workers or processes can drain
+concurrently because each one claims its batch with a conditional UPDATE.
+"""
+import hmac
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+from django_daraja.mpesa.exceptions import MpesaConnectionError, MpesaError
+from rest_framework.utils.urls import replace_query_param
+
+from .models import Order, Payment, PaymentCallback
+from .mpesa import get_client
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_BATCH_SIZE = 500
+# A claimed batch not processed within this time is assumed lost with its worker
+CALLBACK_CLAIM_TIMEOUT = timedelta(minutes=5)
+# Results for unknown checkout ids, or that fail to apply, are retried this many drains, then dropped
+MAX_CALLBACK_ATTEMPTS = 5
+# A payment still 'sending' after this long lost its worker mid-push
+SENDING_TIMEOUT = timedelta(minutes=10)
+# Pushes interrupted this many times are failed rather than requeued
+MAX_PUSH_ATTEMPTS = 3
+# Raised for push responses that are not Daraja's JSON, e.g. an HTML error page
+PUSH_ERRORS = (MpesaConnectionError, MpesaError, requests.RequestException, ValueError)
+
+_executor = None
+_executor_lock = threading.Lock()
+_drain_scheduled = False
+_drain_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.MPESA_WORKERS, thread_name_prefix='stk-push')
+        return _executor
+
+
+def enqueue(payment):
+    """
+    Schedule an STK push for a queued payment once the current transaction commits.
+    """
+    transaction.on_commit(lambda: get_executor().submit(run_payment, payment.pk))
+
+
+def run_payment(payment_id):
+    # Worker threads own their connections, so release them after each job
+    close_old_connections()
+    try:
+        process_payment(payment_id)
+    except Exception:
+        logger.exception('STK push for payment %s failed', payment_id)
+    finally:
+        close_old_connections()
+
+
+def process_payment(payment_id):
+    """
+    Perform the STK push for a queued payment.
+
+    Returns:
+    - bool: False when another worker already claimed the payment.
+    """
+    # Claiming with a conditional UPDATE lets several workers share the queue safely
+    claimed = Payment.objects.filter(pk=payment_id, status='queued').update(
+        status='sending', attempts=F('attempts') + 1, updated_at=timezone.now()
+    )
+    if not claimed:
+        return False
+
+    payment = Payment.objects.get(pk=payment_id)
+    try:
+        response = get_client().stk_push(
+            payment.phone_number,
+            payment.amount,
+            payment.account_reference,
+            payment.transaction_desc,
+            callback_url(),
+        )
+    except PUSH_ERRORS as ex:
+        fail(payment_id, str(ex) or type(ex).__name__)
+        return True
+
+    if not isinstance(response, dict):
+        fail(payment_id, f'Unexpected push response: {response!r}')
+    elif str(response.get('ResponseCode')) == '0':
+        checkout_request_id = response.get('CheckoutRequestID', '')
+        try:
+            with transaction.atomic():
+                Payment.objects.filter(pk=payment_id).update(
+                    status='sent',
+                    merchant_request_id=response.get('MerchantRequestID', ''),
+                    checkout_request_id=checkout_request_id,
+                    updated_at=timezone.now(),
+                )
+        except IntegrityError:
+            # Another payment already holds this CheckoutRequestID; its result cannot be told apart
+            fail(payment_id, f'Duplicate CheckoutRequestID {checkout_request_id}')
+            return True
+        apply_early_callback(checkout_request_id)
+    else:
+        error = response.get('errorMessage') or response.get('ResponseDescription') or str(response)
+        fail(payment_id, error)
+    return True
+
+
+def fail(payment_id, error):
+    Payment.objects.filter(pk=payment_id).update(status='failed', error=error, updated_at=timezone.now())
+
+
+def recover_stale(timeout=SENDING_TIMEOUT):
+    """
+    Requeue payments whose worker died during the push, failing those that
+    already used `MAX_PUSH_ATTEMPTS`.
+
+    Returns:
+    - tuple: Numbers of requeued and failed payments.
+    """
+    now = timezone.now()
+    stale = Payment.objects.filter(status='sending', updated_at__lt=now - timeout)
+    failed = stale.filter(attempts__gte=MAX_PUSH_ATTEMPTS).update(
+        status='failed', error='Push interrupted too many times.', updated_at=now
+    )
+    requeued = stale.update(status='queued', updated_at=now)
+    return requeued, failed
+
+
+def callback_url():
+    return replace_query_param(settings.MPESA_CALLBACK_URL, 'token', settings.MPESA_CALLBACK_TOKEN)
+
+
+def is_authentic_callback(request):
+    """
+    Whether a result was posted to the URL carrying `settings.MPESA_CALLBACK_TOKEN`,
+    from an allowed address. Without a token configured every result is refused.
+    """
+    token = settings.MPESA_CALLBACK_TOKEN
+    if not token or not hmac.compare_digest(request.GET.get('token', ''), token):
+        return False
+    allowed = settings.MPESA_CALLBACK_ALLOWED_IPS
+    return not allowed or request.META.get('REMOTE_ADDR') in allowed
+
+
+def ingest_callback(payload):
+    """
+    Append an STK push result to the callback queue, ignoring duplicates.
+
+    Returns:
+    - str: The CheckoutRequestID of the result.
+
+    Raises:
+    - KeyError, TypeError, ValueError: The payload is not an STK push result.
+    """
+    result = payload['Body']['stkCallback']
+    checkout_request_id = result['CheckoutRequestID']
+    # Refuse what apply_result could not read, rather than queue it
+    parse_result(result)
+    # Daraja retries deliveries; the unique CheckoutRequestID turns repeats into no-ops
+    PaymentCallback.objects.bulk_create(
+        [PaymentCallback(checkout_request_id=checkout_request_id, payload=result)],
+        ignore_conflicts=True,
+    )
+    transaction.on_commit(schedule_drain)
+    return checkout_request_id
+
+
+def schedule_drain():
+    """
+    Start draining the callback queue on the worker pool, unless a drain is
+    already waiting to start; a burst of callbacks costs one drain.
+    """
+    global _drain_scheduled
+    with _drain_lock:
+        if _drain_scheduled:
+            return
+        _drain_scheduled = True
+    get_executor().submit(run_drain)
+
+
+def run_drain():
+    global _drain_scheduled
+    with _drain_lock:
+        # Callbacks arriving from now on schedule another drain
+        _drain_scheduled = False
+    close_old_connections()
+    try:
+        while drain_callbacks():
+            pass
+    except Exception:
+        logger.exception('Draining payment callbacks failed')
+    finally:
+        close_old_connections()
+
+
+def drain_callbacks(batch_size=CALLBACK_BATCH_SIZE):
+    """
+    Apply one batch of queued STK push results to their payments.
+
+    Returns:
+    - int: Number of callbacks claimed in this batch.
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    claimable = Q(claimed_by='') | Q(claimed_at__lt=now - CALLBACK_CLAIM_TIMEOUT)
+    batch = PaymentCallback.objects.filter(claimable, processed_at__isnull=True).order_by('id').values('id')
+    claimed = PaymentCallback.objects.filter(claimable, id__in=batch[:batch_size]).update(
+        claimed_by=token, claimed_at=now
+    )
+    if not claimed:
+        return 0
+
+    callbacks = PaymentCallback.objects.filter(claimed_by=token).values_list('id', 'checkout_request_id', 'payload')
+    applied, unmatched = [], []
+    with transaction.atomic():
+        for callback_id, checkout_request_id, result in callbacks:
+            # Each result in its own savepoint, so one that fails does not undo the batch
+            try:
+                with transaction.atomic():
+                    matched = apply_result(checkout_request_id, result)
+            except Exception:
+                logger.exception('Applying payment callback %s failed', callback_id)
+                matched = False
+            (applied if matched else unmatched).append(callback_id)
+        PaymentCallback.objects.filter(id__in=applied).update(processed_at=now)
+        # Unmatched and failed results keep their claim, so they are retried once
+        # it goes stale; the push worker also applies them as soon as it records the id
+        PaymentCallback.objects.filter(id__in=unmatched).update(attempts=F('attempts') + 1)
+        PaymentCallback.objects.filter(id__in=unmatched, attempts__gte=MAX_CALLBACK_ATTEMPTS).update(
+            processed_at=now
+        )
+    return claimed
+
+
+def apply_early_callback(checkout_request_id):
+    """
+    Apply a result that arrived before its push response was recorded.
+    """
+    callback = PaymentCallback.objects.filter(
+        checkout_request_id=checkout_request_id, processed_at__isnull=True
+    ).values_list('payload', flat=True).first()
+    if callback is not None and apply_result(checkout_request_id, callback):
+        PaymentCallback.objects.filter(checkout_request_id=checkout_request_id).update(processed_at=timezone.now())
+
+
+def parse_result(result):
+    """
+    Return the ResultCode of an STK push result and its CallbackMetadata as
+    a name -> value map.
+
+    Raises:
+    - KeyError, TypeError, ValueError: The result is malformed.
+    """
+    result_code = int(result['ResultCode'])
+    metadata = result.get('CallbackMetadata') or {}
+    if not isinstance(metadata, dict):
+        raise TypeError('CallbackMetadata is not an object.')
+    return result_code, {item['Name']: item.get('Value') for item in metadata.get('Item', [])}
+
+
+def apply_result(checkout_request_id, result):
+    """
+    Record an STK push result on its payment with a single conditional
+    UPDATE and, for a successful one, mark the payment's order paid with
+    another conditioned on that payment being paid and on the order's paid
+    payments covering its total.
+
+    Returns:
+    - bool: False when no payment is waiting on this CheckoutRequestID.
+    """
+    result_code, metadata = parse_result(result)
+    now = timezone.now()
+    with transaction.atomic():
+        updated = Payment.objects.filter(checkout_request_id=checkout_request_id, status='sent').update(
+            status='paid' if result_code == 0 else 'failed',
+            result_code=result_code,
+            error='' if result_code == 0 else result.get('ResultDesc', ''),
+            mpesa_receipt_number=metadata.get('MpesaReceiptNumber') or '',
+            updated_at=now,
+        )
+        if updated and result_code == 0:
+            paid = (
+                Payment.objects.filter(order=OuterRef('pk'), status='paid').order_by()
+                .values('order').annotate(total=Sum('amount')).values('total')
+            )
+            Order.objects.filter(
+                payments__checkout_request_id=checkout_request_id, payments__status='paid', paid_at__isnull=True,
+                total_amount__lte=Subquery(paid),
+            ).update(paid_at=now)
+    if updated:
+        return True
+    # Already applied by an earlier delivery of the same result
+    return Payment.objects.filter(checkout_request_id=checkout_request_id).exclude(status='sending').exists()
@@ -0,0 +1,92 @@
+"""
+Query plan checks.
+
+`full_scans` asks the database how it would run a statement and reports
+the steps that read a whole large table: a sequential scan, or any scan
+feeding a sort of the full result. Two kinds of scan are accepted:
+
+- Scans of a covering index, which read the index alone (counts, MAX()).
+- Scans in the requested order of a statement with a LIMIT, which stop
+  after the page (e.g. `ORDER BY id DESC LIMIT 20` walking the primary key).
+  Only scans that walk an index, or that no WHERE condition filters, are
+  sure to stop there; a filtered plain scan may read the whole table to
+  find the page.
+
+Supports SQLite (EXPLAIN QUERY PLAN) and PostgreSQL (EXPLAIN). The Postgres
+planner only prefers indexes once tables are ANALYZEd at a realistic size.
+"""
+import re
+
+from .models import Cart, CartItem, Order, OrderItem, Payment, PaymentCallback, Product, ProductListing, StockReservation
+
+LARGE_TABLES = frozenset(
+    model._meta.db_table
+    for model in (Product, ProductListing, Order, OrderItem, Cart, CartItem, StockReservation, Payment, PaymentCallback)
+)
+SQLITE_SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(.*)$')
+POSTGRES_SCAN = re.compile(r'Seq Scan on (\w+)')
+LIMIT = re.compile(r'\bLIMIT\b', re.IGNORECASE)
+WHERE = re.compile(r'\bWHERE\b(.*)', re.IGNORECASE | re.DOTALL)
+INDEXED = re.compile(r'\bUSING (?:INTEGER PRIMARY KEY|(?:COVERING )?INDEX)\b')
+
+
+def explain(connection, sql):
+    """
+    Return the plan of `sql` as a list of step descriptions.
+    """
+    with connection.cursor() as cursor:
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}')
+            return [row[0].strip() for row in cursor.fetchall()]
+    raise NotImplementedError(f'Query plans are not supported on {connection.vendor}.')
+
+
+def full_scans(connection, sql, tables=LARGE_TABLES):
+    """
+    Return the plan steps of `sql` that read a whole table in `tables`.
+    """
+    plan = explain(connection, sql)
+    if connection.vendor == 'postgresql':
+        return [step for step in plan if (match := POSTGRES_SCAN.search(step)) and match[1] in tables]
+
+    sorts = any(step.startswith('USE TEMP B-TREE FOR') for step in plan)
+    limited = bool(LIMIT.search(sql)) and not sorts
+    scans = []
+    for step in plan:
+        match = SQLITE_SCAN.match(step)
+        if match is None or match[1] not in tables or 'COVERING INDEX' in match[2]:
+            continue
+        if limited and (INDEXED.search(match[2]) or not filters(sql, match[1])):
+            continue
+        scans.append(' / '.join(plan) if sorts else step)
+    return scans
+
+
+def filters(sql, table):
+    """
+    Return whether the WHERE clause of `sql` may filter rows of `table`.
+    Unqualified columns could belong to any table, so they count too.
+    """
+    match = WHERE.search(sql)
+    if match is None:
+        return False
+    clause = match[1]
+    return bool(re.search(rf'\b{re.escape(table)}\b', clause)) or '.' not in clause
+
+
+def captured_full_scans(connection, queries, tables=LARGE_TABLES):
+    """
+    Map each captured SELECT (`CaptureQueriesContext.captured_queries`) that
+    reads a whole large table to its offending plan steps.
+    """
+    found = {}
+    for query in queries:
+        sql = query['sql']
+        if sql.lstrip().upper().startswith('SELECT'):
+            scans = full_scans(connection, sql, tables)
+            if scans:
+                found[sql] = scans
+    return found
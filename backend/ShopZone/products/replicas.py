@@ -0,0 +1,138 @@
+"""
+Read replica routing.
+
+Reads go to the primary ('default') unless a view opts in with
+`mixins.ReplicaReadMixin`, which runs safe (GET/HEAD/OPTIONS) requests
+inside `read_from_replicas`; their reads are then spread over
+`settings.DATABASE_REPLICAS`. Writes always go to the primary.
+
+Replicas lag behind the primary, so two pins keep clients reading their own
+writes:
+
+- Within a request, the first write (or open transaction) sends every later
+  read of that request to the primary.
+- `PrimaryPinMiddleware` gives a client that wrote a short-lived cookie;
+  while it is set, that client's requests read from the primary too.
+
+Cached catalogue responses are built from the primary (see
+`mixins.CachedResponseMixin`): a body read from a lagging replica would be
+served stale for the whole cache TTL. Other caches filled during a request
+check `reading_from_replicas` instead. Without replicas configured every
+read goes to the primary.
+"""
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_COOKIE = 'db_primary_pin'
+
+
+class RoutingState:
+
+    def __init__(self):
+        self.replica_reads = False
+        self.wrote = False
+
+
+_state = ContextVar('db_routing_state', default=None)
+
+
+@contextmanager
+def read_from_replicas():
+    """
+    Let reads in the block go to a replica until something is written.
+    """
+    state = _state.get()
+    token = None
+    if state is None:
+        state = RoutingState()
+        token = _state.set(state)
+    previous, state.replica_reads = state.replica_reads, True
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+        if token is not None:
+            _state.reset(token)
+
+
+@contextmanager
+def read_from_primary():
+    """
+    Send reads in the block to the primary, e.g. for data that outlives the request.
+    """
+    state = _state.get()
+    if state is None:
+        yield
+        return
+    previous, state.replica_reads = state.replica_reads, False
+    try:
+        yield
+    finally:
+        state.replica_reads = previous
+
+
+def reading_from_replicas():
+    """
+    Whether reads may currently go to a replica, so that what they return may
+    lag behind the primary. A later write does not clear it: rows read
+    before the write may still have come from a replica.
+    """
+    state = _state.get()
+    return state is not None and state.replica_reads and bool(settings.DATABASE_REPLICAS)
+
+
+def is_pinned(request):
+    """
+    Whether the client wrote recently enough that it must read from the primary.
+    """
+    return PIN_COOKIE in request.COOKIES
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (
+            state is None or not state.replica_reads or state.wrote or not settings.DATABASE_REPLICAS
+            # Reads inside a transaction must see its writes
+            or connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return DEFAULT_DB_ALIAS
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        return True
+
+
+class PrimaryPinMiddleware:
+    """
+    Tracks what each request writes and pins clients that wrote to the
+    primary for `settings.DB_REPLICA_PIN_SECONDS`.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RoutingState()
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if state.wrote and settings.DATABASE_REPLICAS:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.DB_REPLICA_PIN_SECONDS, httponly=True, samesite='Lax'
+            )
+        return response
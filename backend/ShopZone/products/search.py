@@ -0,0 +1,269 @@
+"""
+Full-text product search.
+
+Products are indexed on their name, category name and description in a
+database-native inverted index: an FTS5 virtual table on SQLite and a
+weighted tsvector table with a GIN index on PostgreSQL (both created by
+migration 0003). `products.signals` keeps the index in step with product
+and category writes.
+"""
+import difflib
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Product
+
+TOKEN_RE = re.compile(r'\w+')
+# Longer queries are truncated rather than turned into huge MATCH expressions
+MAX_TERMS = 8
+MAX_CORRECTIONS = 2
+# Terms shorter than this are never spell-corrected; they are prefix matched only
+MIN_CORRECTION_LENGTH = 4
+CORRECTION_CANDIDATES = 2000
+CORRECTION_CUTOFF = 0.75
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())[:MAX_TERMS]
+
+
+class SearchBackend:
+    """
+    Interface shared by the search backends.
+
+    `fields` arguments restrict matching to a subset of 'name', 'category'
+    and 'description'; None means all of them.
+    """
+
+    def search(self, text, fields=None, limit=20, offset=0):
+        """
+        Return the ids of matching products, best match first.
+        """
+        raise NotImplementedError
+
+    def filter(self, queryset, text, fields=None):
+        """
+        Restrict a product queryset to matching rows, leaving its ordering alone.
+        """
+        raise NotImplementedError
+
+    def index(self, product_ids):
+        raise NotImplementedError
+
+    def remove(self, product_ids):
+        raise NotImplementedError
+
+    def rebuild(self):
+        self.index(Product.objects.values_list('id', flat=True))
+
+    def documents(self, product_ids):
+        return Product.objects.filter(pk__in=list(product_ids)).values_list(
+            'id', 'name', 'category__name', 'description'
+        )
+
+
+class SQLiteSearchBackend(SearchBackend):
+    """
+    FTS5 backend. Every query term is prefix matched and, when the index has
+    no term starting with it, OR-ed with its closest spellings from the
+    index vocabulary.
+    """
+    table = 'products_product_fts'
+    vocab_table = 'products_product_fts_vocab'
+    # bm25 column weights, in table column order: name, category, description
+    weights = (10.0, 4.0, 1.0)
+
+    def build_query(self, text, fields=None):
+        terms = tokenize(text)
+        if not terms:
+            return None
+        clauses = []
+        with connection.cursor() as cursor:
+            for term in terms:
+                alternatives = ['"%s"*' % term]
+                alternatives += ['"%s"' % word for word in self.corrections(cursor, term)]
+                clauses.append('(%s)' % ' OR '.join(alternatives))
+        expression = ' AND '.join(clauses)
+        if fields:
+            expression = '{%s} : (%s)' % (' '.join(fields), expression)
+        return expression
+
+    def corrections(self, cursor, term):
+        if len(term) < MIN_CORRECTION_LENGTH:
+            return []
+        cursor.execute(
+            f'SELECT 1 FROM {self.vocab_table} WHERE term >= %s AND term < %s LIMIT 1',
+            [term, term + '\uffff'],
+        )
+        if cursor.fetchone():
+            return []
+        # Typos rarely hit the first letter, which keeps the candidate scan small
+        cursor.execute(
+            f'SELECT term FROM {self.vocab_table} WHERE term >= %s AND term < %s '
+            f'AND length(term) BETWEEN %s AND %s ORDER BY doc DESC LIMIT %s',
+            [term[0], chr(ord(term[0]) + 1), len(term) - 2, len(term) + 2, CORRECTION_CANDIDATES],
+        )
+        candidates = [row[0] for row in cursor.fetchall()]
+        return difflib.get_close_matches(term, candidates, n=MAX_CORRECTIONS, cutoff=CORRECTION_CUTOFF)
+
+    def search(self, text, fields=None, limit=20, offset=0):
+        expression = self.build_query(text, fields)
+        if expression is None:
+            return []
+        rank = 'bm25(%s, %s)' % (self.table, ', '.join(str(weight) for weight in self.weights))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s '
+                f'ORDER BY {rank} LIMIT %s OFFSET %s',
+                [expression, limit, offset],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def filter(self, queryset, text, fields=None):
+        expression = self.build_query(text, fields)
+        if expression is None:
+            return queryset
+        return queryset.filter(
+            pk__in=RawSQL(f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s', [expression])
+        )
+
+    def index(self, product_ids):
+        rows = list(self.documents(product_ids))
+        with connection.cursor() as cursor:
+            self._delete(cursor, [row[0] for row in rows])
+            cursor.executemany(
+                f'INSERT INTO {self.table}(rowid, name, category, description) VALUES (%s, %s, %s, %s)',
+                rows,
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            self._delete(cursor, list(product_ids))
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+        super().rebuild()
+
+    def _delete(self, cursor, product_ids):
+        if product_ids:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid IN (%s)' % ', '.join(['%s'] * len(product_ids)),
+                product_ids,
+            )
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    tsvector backend. Name, category and description are weighted A, B and
+    C, every term is prefix matched and results are ranked with ts_rank_cd.
+    Queries with no full-text match fall back to trigram similarity on the
+    product name when the pg_trgm extension is installed.
+    """
+    table = 'products_product_search'
+    config = 'simple'
+    weight_labels = {'name': 'A', 'category': 'B', 'description': 'C'}
+    document_sql = (
+        "setweight(to_tsvector('simple', p.name), 'A') || "
+        "setweight(to_tsvector('simple', c.name), 'B') || "
+        "setweight(to_tsvector('simple', p.description), 'C')"
+    )
+
+    def build_query(self, text, fields=None):
+        terms = tokenize(text)
+        if not terms:
+            return None
+        labels = ''.join(self.weight_labels[field] for field in fields or ())
+        return ' & '.join('%s:*%s' % (term, labels) for term in terms)
+
+    def search(self, text, fields=None, limit=20, offset=0):
+        expression = self.build_query(text, fields)
+        if expression is None:
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT product_id FROM {self.table}, to_tsquery('{self.config}', %s) query "
+                f"WHERE document @@ query ORDER BY ts_rank_cd(document, query) DESC, product_id DESC "
+                f"LIMIT %s OFFSET %s",
+                [expression, limit, offset],
+            )
+            ids = [row[0] for row in cursor.fetchall()]
+            if ids or offset or not self.has_trigram(cursor):
+                return ids
+            cursor.execute(
+                f'SELECT id FROM {Product._meta.db_table} WHERE lower(name) %% %s '
+                f'ORDER BY similarity(lower(name), %s) DESC LIMIT %s',
+                [text.lower(), text.lower(), limit],
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+    def has_trigram(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        return cursor.fetchone() is not None
+
+    def filter(self, queryset, text, fields=None):
+        expression = self.build_query(text, fields)
+        if expression is None:
+            return queryset
+        return queryset.filter(
+            pk__in=RawSQL(
+                f"SELECT product_id FROM {self.table} WHERE document @@ to_tsquery('{self.config}', %s)",
+                [expression],
+            )
+        )
+
+    def index(self, product_ids):
+        product_ids = list(product_ids)
+        if not product_ids:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {self.table} (product_id, document) '
+                f'SELECT p.id, {self.document_sql} FROM {Product._meta.db_table} p '
+                f'JOIN products_category c ON c.id = p.category_id WHERE p.id = ANY(%s) '
+                f'ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document',
+                [product_ids],
+            )
+
+    def remove(self, product_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table} WHERE product_id = ANY(%s)', [list(product_ids)])
+
+
+class LikeSearchBackend(SearchBackend):
+    """
+    Fallback for databases without a native full-text index: every term
+    must appear somewhere in the searched columns.
+    """
+    lookups = {'name': 'name', 'category': 'category__name', 'description': 'description'}
+
+    def filter(self, queryset, text, fields=None):
+        for term in tokenize(text):
+            condition = Q()
+            for field in fields or self.lookups:
+                condition |= Q(**{f'{self.lookups[field]}__icontains': term})
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def search(self, text, fields=None, limit=20, offset=0):
+        queryset = self.filter(Product.objects.order_by('-id'), text, fields)
+        return list(queryset.values_list('id', flat=True)[offset:offset + limit])
+
+    def index(self, product_ids):
+        pass
+
+    def remove(self, product_ids):
+        pass
+
+
+BACKENDS = {
+    'sqlite': SQLiteSearchBackend,
+    'postgresql': PostgresSearchBackend,
+}
+
+
+def get_search_backend():
+    return BACKENDS.get(connection.vendor, LikeSearchBackend)()
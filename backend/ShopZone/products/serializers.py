@@ -1,8 +1,43 @@
+from decimal import ROUND_CEILING
+
+from django.db import transaction
+from django.db.models import F
 from rest_framework import serializers
-from .models import Product, Category, Cart, CartItem, ContactInfo, Profile, Order, OrderItem
+from django_daraja.mpesa.exceptions import IllegalPhoneNumberException
+from django_daraja.mpesa.utils import format_phone_number
+from .models import Product, Category, Cart, CartItem, ContactInfo, Profile, Order, OrderItem, Payment
 from accounts.models import CustomUser
+from . import images, stock
+from .fragments import FragmentListSerializer
+from .categories import registry as category_registry
 from accounts.serializers import CustomUserSerializer
 
+
+class EagerLoadingMixin:
+    """
+    Declares the related rows a serializer reads so list/detail views can
+    shape their queryset up front instead of issuing one query per row.
+
+    Attributes:
+    - `select_related_fields`: forward relations joined into the main query.
+    - `prefetch_related_fields`: reverse/many relations loaded in one extra query each.
+    - `only_fields`: columns to load; empty means all columns.
+    """
+    select_related_fields = ()
+    prefetch_related_fields = ()
+    only_fields = ()
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        if cls.select_related_fields:
+            queryset = queryset.select_related(*cls.select_related_fields)
+        if cls.prefetch_related_fields:
+            queryset = queryset.prefetch_related(*cls.prefetch_related_fields)
+        if cls.only_fields:
+            queryset = queryset.only(*cls.only_fields)
+        return queryset
+
+
 class CategorySerializer(serializers.ModelSerializer):
     class Meta:
         model = Category
@@ -16,20 +51,33 @@ class CategorySerializer(serializers.ModelSerializer):
         instance.save()
         return instance
     
-class ProductSerializer(serializers.ModelSerializer):
-    category = CategorySerializer()  # Include CategorySerializer for nested serialization
+class ProductCategorySerializer(CategorySerializer):
+    """
+    Category nested in a product; naming an existing category links to it
+    rather than failing its unique check.
+    """
+    class Meta(CategorySerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
+class ProductSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    category = ProductCategorySerializer()  # Include CategorySerializer for nested serialization
+    image_srcset = serializers.SerializerMethodField()
+
+    select_related_fields = ('category',)
+    only_fields = (
+        'id', 'name', 'description', 'image', 'image_variants', 'price', 'stock', 'category__id', 'category__name'
+    )
 
     class Meta:
         model = Product
-        fields = ['id', 'name', 'description', 'image', 'price', 'category', 'stock']
+        fields = ['id', 'name', 'description', 'image', 'image_srcset', 'price', 'category', 'stock']
+        # Lists reuse each product's cached JSON until it changes (see `products.fragments`)
+        list_serializer_class = FragmentListSerializer
         
     def create(self, validated_data):
-        # Extract and create category separately to avoid errors
+        # Link to the named category, creating it only if it does not exist yet
         category_data = validated_data.pop('category', None)
-        category_instance = Category.objects.create(**category_data)
-        
-        # Now, create the product with the category instance
-        validated_data['category'] = category_instance
+        validated_data['category'] = self.resolve_category(category_data['name'])
         return Product.objects.create(**validated_data)
     
     def update(self, instance, validated_data):
@@ -38,15 +86,46 @@ class ProductSerializer(serializers.ModelSerializer):
         instance.image = validated_data.get('image', instance.image)
         instance.price = validated_data.get('price', instance.price)
         
-        # Update category if provided
-        category_data = validated_data.get('category', {})
-        instance.category.name = category_data.get('name', instance.category.name)
-        instance.category.save()
+        # Move the product to another category if one is named; the shared
+        # category itself is renamed through the category endpoints
+        category_data = validated_data.get('category')
+        if category_data:
+            instance.category = self.resolve_category(category_data['name'])
         
         instance.stock = validated_data.get('stock', instance.stock)
         instance.save()
         return instance
 
+    def get_image_srcset(self, obj):
+        # Format -> "url 160w, url 320w, ..." for <source srcset>; empty until the variants are built
+        request = self.context.get('request')
+        return images.srcset(obj, request.build_absolute_uri if request else None)
+
+    def resolve_category(self, name):
+        # Built from the registry, so neither the write nor the response queries categories
+        return Category(pk=category_registry.resolve(name), name=name)
+
+
+class ProductListingSerializer(serializers.BaseSerializer):
+    """
+    Read-only rows of `ProductListing`. The fields are stored rendered, so
+    only the thumbnail URL is made absolute.
+    """
+
+    def to_representation(self, listing):
+        request = self.context.get('request')
+        thumbnail = listing.thumbnail
+        if thumbnail and request is not None:
+            thumbnail = request.build_absolute_uri(thumbnail)
+        return {
+            'id': listing.id,
+            'name': listing.name,
+            'price': str(listing.price),
+            'category': {'id': listing.category_id, 'name': listing.category_name},
+            'thumbnail': thumbnail,
+            'in_stock': listing.in_stock,
+        }
+
 
 class CartItemSerializer(serializers.ModelSerializer):
     cart = serializers.PrimaryKeyRelatedField(queryset=Cart.objects.all())
@@ -55,20 +134,48 @@ class CartItemSerializer(serializers.ModelSerializer):
     class Meta:
         model = CartItem
         fields = ['id', 'cart', 'product', 'quantity']
+        # Adding a product the cart already has tops up its line instead
+        validators = []
         
     def create(self, validated_data):
-        return CartItem.objects.create(**validated_data)
+        # Hold the units for this cart before the line exists
+        with transaction.atomic():
+            quantity = validated_data.get('quantity', 1)
+            self.reserve(validated_data['cart'], validated_data['product'], quantity)
+            item, created = CartItem.objects.get_or_create(
+                cart=validated_data['cart'], product=validated_data['product'], defaults={'quantity': quantity}
+            )
+            if not created:
+                CartItem.objects.filter(pk=item.pk).update(quantity=F('quantity') + quantity)
+                item.refresh_from_db(fields=['quantity'])
+            return item
     
     def update(self, instance, validated_data):
-        instance.cart = validated_data.get('cart', instance.cart)
-        instance.product = validated_data.get('product', instance.product)
-        instance.quantity = validated_data.get('quantity', instance.quantity)
-        instance.save()
+        cart = validated_data.get('cart', instance.cart)
+        product = validated_data.get('product', instance.product)
+        moved = (cart.pk, product.pk) != (instance.cart_id, instance.product_id)
+        if moved and CartItem.objects.filter(cart=cart, product=product).exists():
+            raise serializers.ValidationError({'product': 'The cart already has a line for this product.'})
+        with transaction.atomic():
+            stock.release(instance.cart, [instance.product_id])
+            instance.cart = cart
+            instance.product = product
+            instance.quantity = validated_data.get('quantity', instance.quantity)
+            self.reserve(instance.cart, instance.product, instance.quantity)
+            instance.save()
         return instance
+
+    def reserve(self, cart, product, quantity):
+        try:
+            stock.reserve(cart, product.pk, quantity)
+        except stock.InsufficientStock as ex:
+            raise serializers.ValidationError({'quantity': str(ex)})
     
-class CartSerializer(serializers.ModelSerializer):
-    user = serializers.PrimaryKeyRelatedField(queryset=CustomUser.objects.all())
+class CartSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    user = serializers.PrimaryKeyRelatedField(queryset=CustomUser.objects.all(), allow_null=True, required=False)
     items = CartItemSerializer(many=True, read_only=True)
+
+    prefetch_related_fields = ('items',)
     
     class Meta:
         model = Cart
@@ -81,6 +188,13 @@ class CartSerializer(serializers.ModelSerializer):
         instance.user = validated_data.get('user', instance.user)
         instance.save()
         return instance
+
+class CartCreateSerializer(CartSerializer):
+    # Only handed out once, to whoever creates the cart
+    token = serializers.UUIDField(read_only=True)
+
+    class Meta(CartSerializer.Meta):
+        fields = CartSerializer.Meta.fields + ['token']
     
 class ContactInfoSerializer(serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=CustomUser.objects.all())
@@ -98,9 +212,11 @@ class ContactInfoSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=CustomUser.objects.all())
     contact_info = ContactInfoSerializer()
+
+    select_related_fields = ('contact_info',)
     
     class Meta:
         model = Profile
@@ -136,17 +252,21 @@ class OrderItemSerializer(serializers.ModelSerializer):
         model = OrderItem
         fields = '__all__'
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True, read_only=True)
     user = serializers.PrimaryKeyRelatedField(queryset=CustomUser.objects.all())
     contact_info = ContactInfoSerializer()
 
+    select_related_fields = ('contact_info',)
+    prefetch_related_fields = ('items',)
+
     class Meta:
         model = Order
-        fields = ['id', 'user', 'items', 'total_amount', 'status', 'contact_info']
+        fields = ['id', 'user', 'items', 'total_amount', 'item_count', 'status', 'paid_at', 'contact_info']
+        read_only_fields = ['total_amount', 'item_count', 'paid_at']
 
     def create(self, validated_data):
-        items_data = validated_data.pop('items')
+        items_data = validated_data.pop('items', [])
         order = Order.objects.create(**validated_data)
         for item_data in items_data:
             OrderItem.objects.create(order=order, **item_data)
@@ -155,13 +275,107 @@ class OrderSerializer(serializers.ModelSerializer):
     def update(self, instance, validated_data):
         instance.user = validated_data.get('user', instance.user)
         instance.cart = validated_data.get('cart', instance.cart)
-        instance.total_amount = validated_data.get('total_amount', instance.total_amount)
         instance.status = validated_data.get('status', instance.status)
 
         # Update contact info if provided
-        contact_info_data = validated_data.get('contact_info', {})
-        instance.contact_info.email = contact_info_data.get('email', instance.contact_info.email)
-        instance.contact_info.save()
+        contact_info_data = validated_data.get('contact_info')
+        if contact_info_data:
+            instance.contact_info.email = contact_info_data.get('email', instance.contact_info.email)
+            instance.contact_info.save()
 
-        instance.save()
+        # The totals are kept by item changes; writing them back here could undo a concurrent one
+        instance.save(update_fields=['user', 'cart', 'status'])
         return instance
+
+
+class CartLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    name = serializers.CharField()
+    price = serializers.DecimalField(max_digits=8, decimal_places=2)
+    quantity = serializers.IntegerField()
+    line_total = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+class CartContentsSerializer(serializers.Serializer):
+    """
+    Read-only view of a cart store summary (see `carts.CartStore.summary`).
+    """
+    cart = serializers.IntegerField()
+    items = CartLineSerializer(many=True)
+    item_count = serializers.IntegerField()
+    total = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+class CartStoreItemSerializer(serializers.Serializer):
+    product = serializers.PrimaryKeyRelatedField(queryset=Product.objects.only('id'))
+    quantity = serializers.IntegerField(min_value=1)
+
+class CartStoreQuantitySerializer(CartStoreItemSerializer):
+    quantity = serializers.IntegerField(min_value=0)
+
+class CartBatchListSerializer(serializers.ListSerializer):
+
+    def validate(self, attrs):
+        # Every product id is checked in one IN query rather than one lookup per line
+        ids = {line['product'] for line in attrs}
+        missing = ids - set(Product.objects.filter(pk__in=ids).values_list('pk', flat=True))
+        if missing:
+            raise serializers.ValidationError(f'Unknown products: {sorted(missing)}.')
+        return attrs
+
+class CartBatchLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+    class Meta:
+        list_serializer_class = CartBatchListSerializer
+
+class CartClaimSerializer(serializers.Serializer):
+    cart = serializers.IntegerField()
+    token = serializers.UUIDField()
+
+class CheckoutSerializer(serializers.Serializer):
+    cart = serializers.PrimaryKeyRelatedField(queryset=Cart.objects.all())
+
+    def validate_cart(self, cart):
+        user = self.context['request'].user
+        if cart.user_id != user.pk and not user.is_staff:
+            raise serializers.ValidationError('You can only check out your own cart.')
+        return cart
+
+class PaymentSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Payment
+        fields = [
+            'id', 'order', 'phone_number', 'amount', 'account_reference', 'transaction_desc',
+            'status', 'checkout_request_id', 'error', 'created_at',
+        ]
+        read_only_fields = ['status', 'checkout_request_id', 'error', 'created_at']
+        # Payments for an order are charged its total; `amount` is only needed without one
+        extra_kwargs = {'amount': {'min_value': 1, 'required': False}}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Payments can only be started for the requester's own orders
+        user = getattr(self.context.get('request'), 'user', None)
+        orders = Order.objects.filter(user=user) if user is not None and user.is_authenticated else Order.objects.none()
+        self.fields['order'].queryset = orders
+
+    def validate_phone_number(self, value):
+        try:
+            return format_phone_number(value)
+        except IllegalPhoneNumberException as ex:
+            raise serializers.ValidationError(str(ex))
+
+    def validate(self, data):
+        order = data.get('order')
+        if order is None:
+            if 'amount' not in data:
+                raise serializers.ValidationError({'amount': 'This field is required for payments without an order.'})
+            return data
+        # M-Pesa takes whole shillings; round up so the payment covers the order
+        due = int(order.total_amount.to_integral_value(rounding=ROUND_CEILING))
+        if due < 1:
+            raise serializers.ValidationError({'order': 'This order has nothing to pay.'})
+        if data.get('amount', due) != due:
+            raise serializers.ValidationError({'amount': f'Payments for order {order.pk} must be for {due}.'})
+        data['amount'] = due
+        return data
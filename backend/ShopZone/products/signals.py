@@ -0,0 +1,148 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models import QuerySet
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save
+from django.dispatch import Signal, receiver
+
+from . import cache as response_cache
+from . import carts, facets, images, listings, orders, stock
+from .models import Product, Category, Cart, Order, OrderItem
+from .categories import registry as category_registry
+from .search import get_search_backend
+
+# Sent with `product_ids` after writes that bypass model signals, such as bulk imports
+products_bulk_changed = Signal()
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, raw=False, **kwargs):
+    if not raw:
+        get_search_backend().index([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def generate_image_variants(sender, instance, raw=False, **kwargs):
+    if not raw and images.needs_variants(instance):
+        images.enqueue([instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def update_listing(sender, instance, raw=False, **kwargs):
+    if not raw:
+        listings.save([instance])
+
+
+@receiver(post_delete, sender=Product)
+def remove_listing(sender, instance, **kwargs):
+    listings.remove([instance.pk])
+
+
+@receiver(pre_save, sender=Product)
+def remember_facet(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        instance._previous_facet = None
+    elif hasattr(instance, '_facet'):
+        instance._previous_facet = instance._facet
+    else:
+        # Loaded before this save, so ask the database what was counted
+        row = Product.objects.filter(pk=instance.pk).values_list('category_id', 'price', 'stock').first()
+        instance._previous_facet = row and facets.key(*row)
+
+
+@receiver(post_save, sender=Product)
+def update_facet_counts(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._facet = facets.snapshot(instance)
+    facets.apply_delta([instance._previous_facet], [instance._facet])
+
+
+@receiver(post_delete, sender=Product)
+def subtract_deleted_product(sender, instance, **kwargs):
+    facets.apply_delta([getattr(instance, '_facet', None) or facets.snapshot(instance)])
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    get_search_backend().remove([instance.pk])
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created=False, raw=False, **kwargs):
+    # A new category has no products yet; a renamed one changes their documents
+    if not raw and not created:
+        get_search_backend().index(instance.product_set.values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def rename_category_listings(sender, instance, created=False, raw=False, **kwargs):
+    if not raw and not created:
+        listings.rename_category(instance)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product_responses(sender, instance, **kwargs):
+    response_cache.invalidate('products', f'product:{instance.pk}')
+
+
+@receiver(products_bulk_changed)
+def handle_bulk_product_changes(sender, product_ids, **kwargs):
+    get_search_backend().index(product_ids)
+    listings.refresh(product_ids)
+    # Bulk writes may also have created categories
+    response_cache.invalidate('products', 'categories', *[f'product:{pk}' for pk in product_ids])
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_registry(sender, created=False, **kwargs):
+    # A new category cannot make a cached name -> id entry wrong
+    if not created:
+        category_registry.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category_responses(sender, instance, created=False, **kwargs):
+    scopes = ['categories', f'category:{instance.pk}']
+    if not created:
+        # Product responses embed the category name
+        scopes.append('products')
+        scopes += [f'product:{pk}' for pk in instance.product_set.values_list('id', flat=True)]
+    response_cache.invalidate(*scopes)
+
+
+@receiver(pre_delete, sender=Cart)
+def release_cart_holds(sender, instance, **kwargs):
+    # Cascading deletes would drop the holds without giving the units back
+    stock.release(instance)
+
+
+@receiver(pre_save, sender=OrderItem)
+def remember_counted_item(sender, instance, raw=False, **kwargs):
+    if raw or instance._state.adding:
+        instance._previous = None
+    elif hasattr(instance, '_counted'):
+        instance._previous = instance._counted
+    else:
+        # Built by hand rather than loaded, so ask the database what was counted
+        instance._previous = OrderItem.objects.filter(pk=instance.pk).values_list('order_id', 'quantity', 'price').first()
+
+
+@receiver(post_save, sender=OrderItem)
+def update_order_totals(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    instance._counted = orders.snapshot(instance)
+    orders.apply_delta(instance._previous, instance._counted)
+
+
+@receiver(post_delete, sender=OrderItem)
+def subtract_deleted_item(sender, instance, origin=None, **kwargs):
+    # Items deleted along with their order have no totals left to update
+    if isinstance(origin, Order) or (isinstance(origin, QuerySet) and origin.model is Order):
+        return
+    orders.apply_delta(getattr(instance, '_counted', orders.snapshot(instance)), None)
+
+
+@receiver(user_logged_in)
+def claim_anonymous_cart(sender, user, cart=None, cart_token=None, **kwargs):
+    if cart is not None:
+        carts.claim(cart, cart_token, user)
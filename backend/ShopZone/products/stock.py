@@ -0,0 +1,183 @@
+"""
+Stock reservation engine.
+
+`Product.stock` counts the units on hand and `Product.reserved` the units
+held by carts, so `stock - reserved` is what can still be sold. Adding to a
+cart places a hold with a TTL; placing an order converts the cart's holds
+into a stock decrement; expired holds are released in batches by
+`release_expired` (see the `release_stock_reservations` command).
+
+Every change to a product's counters is a single conditional UPDATE such as
+`UPDATE ... SET reserved = reserved + n WHERE stock >= reserved + n`, so
+concurrent checkouts can neither oversell nor lose updates, and no product
+row is ever read and written back.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.utils import timezone
+
+from . import cache as response_cache
+from . import facets, listings
+from .models import Product, StockReservation
+
+RELEASE_BATCH_SIZE = 1000
+
+
+class InsufficientStock(Exception):
+    """
+    Raised when a product does not have enough unreserved stock.
+    """
+
+    def __init__(self, product_id):
+        super().__init__(f'Not enough stock for product {product_id}.')
+        self.product_id = product_id
+
+
+def reserve(cart, product_id, quantity, ttl=None):
+    """
+    Hold `quantity` units of a product for a cart.
+
+    Raises:
+    - InsufficientStock: Fewer than `quantity` units are unreserved.
+    """
+    ttl = ttl or timedelta(minutes=settings.STOCK_RESERVATION_TTL)
+    with transaction.atomic():
+        held = Product.objects.filter(pk=product_id, stock__gte=F('reserved') + quantity).update(
+            reserved=F('reserved') + quantity
+        )
+        if not held:
+            raise InsufficientStock(product_id)
+        return StockReservation.objects.create(
+            cart=cart, product_id=product_id, quantity=quantity, expires_at=timezone.now() + ttl
+        )
+
+
+def reserve_many(cart, quantities, ttl=None):
+    """
+    Hold units of several products for a cart with one conditional UPDATE.
+    `quantities` maps product ids to units; either every hold is placed or
+    none is.
+
+    Raises:
+    - InsufficientStock: A product has too few unreserved units.
+    """
+    if not quantities:
+        return []
+    ttl = ttl or timedelta(minutes=settings.STOCK_RESERVATION_TTL)
+    with transaction.atomic():
+        held = Product.objects.filter(
+            pk__in=list(quantities), stock__gte=F('reserved') + _per_product(quantities)
+        ).update(reserved=F('reserved') + _per_product(quantities))
+        if held != len(quantities):
+            raise InsufficientStock(_first_short(quantities))
+        expires_at = timezone.now() + ttl
+        return StockReservation.objects.bulk_create([
+            StockReservation(cart=cart, product_id=product_id, quantity=quantity, expires_at=expires_at)
+            for product_id, quantity in quantities.items()
+        ])
+
+
+def release(cart, product_ids=None):
+    """
+    Drop a cart's holds, optionally only those on `product_ids`.
+    """
+    holds = StockReservation.objects.filter(cart=cart)
+    if product_ids is not None:
+        holds = holds.filter(product_id__in=product_ids)
+    with transaction.atomic():
+        _release(holds)
+
+
+def commit(cart, quantities):
+    """
+    Take stock for an order placed from `cart`.
+
+    `quantities` maps product ids to the units ordered. Units the cart holds
+    are converted from reserved into sold; any remainder must still be
+    unreserved, and holds beyond the ordered quantity are released. Either
+    every product is decremented or none is.
+
+    Raises:
+    - InsufficientStock: A product cannot cover the ordered quantity.
+    """
+    with transaction.atomic():
+        holds = _lock(StockReservation.objects.filter(cart=cart, product_id__in=list(quantities)))
+        held = _totals(holds)
+        StockReservation.objects.filter(pk__in=[pk for pk, _, _ in holds]).delete()
+        # Units each product must still have unreserved after its own holds are spent
+        shortfall = {
+            product_id: quantity - min(held.get(product_id, 0), quantity)
+            for product_id, quantity in quantities.items()
+        }
+        # One conditional UPDATE for all products; a product that cannot cover
+        # its quantity is skipped, and the short row count rolls everything back
+        updated = Product.objects.filter(
+            pk__in=list(quantities), stock__gte=F('reserved') + _per_product(shortfall)
+        ).update(
+            stock=F('stock') - _per_product(quantities),
+            reserved=F('reserved') - _per_product(held, quantities),
+            updated_at=timezone.now(),
+        )
+        if updated != len(quantities):
+            raise InsufficientStock(_first_short(shortfall))
+        # The UPDATE bypasses the signals that keep facet counts and listings current
+        facets.record_sold_out(quantities)
+        listings.record_stock(quantities)
+        # Catalogue responses show the stock level
+        scopes = ['products'] + [f'product:{product_id}' for product_id in quantities]
+        transaction.on_commit(lambda: response_cache.invalidate(*scopes))
+
+
+def release_expired(batch_size=RELEASE_BATCH_SIZE):
+    """
+    Release one batch of expired holds.
+
+    Returns:
+    - int: Number of holds released.
+    """
+    expired = StockReservation.objects.filter(expires_at__lte=timezone.now()).order_by('expires_at')
+    with transaction.atomic():
+        return _release(expired[:batch_size], skip_locked=True)
+
+
+def _release(holds, skip_locked=False):
+    rows = _lock(holds, skip_locked)
+    StockReservation.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+    totals = _totals(rows)
+    if totals:
+        # One UPDATE for every product, rather than one per hold
+        Product.objects.filter(pk__in=list(totals)).update(reserved=F('reserved') - _per_product(totals))
+    return len(rows)
+
+
+def _lock(holds, skip_locked=False):
+    # Only hold rows are locked up front; product rows are only ever touched
+    # by single-statement conditional UPDATEs
+    return list(holds.select_for_update(skip_locked=skip_locked).values_list('pk', 'product_id', 'quantity'))
+
+
+def _totals(rows):
+    totals = defaultdict(int)
+    for _, product_id, quantity in rows:
+        totals[product_id] += quantity
+    return totals
+
+
+def _per_product(values, product_ids=None):
+    # CASE id WHEN ... THEN n END, so one statement can apply a different amount to each product
+    return Case(
+        *[When(pk=product_id, then=Value(values.get(product_id, 0))) for product_id in product_ids or values],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def _first_short(shortfall):
+    rows = Product.objects.filter(pk__in=list(shortfall)).values_list('pk', 'stock', 'reserved')
+    available = {pk: stock - reserved for pk, stock, reserved in rows}
+    # A concurrent restock or release may have covered it since; blame the first product then
+    return next((pk for pk in shortfall if available.get(pk, 0) < shortfall[pk]), next(iter(shortfall)))
@@ -0,0 +1,70 @@
+"""
+Content-addressed storage for product images.
+
+`ContentAddressedStorage` names every upload after the SHA-256 of its bytes
+(`products/<first two hex digits>/<digest><ext>`), so uploading the same
+picture twice stores it once and every product showing it shares the file
+and its URL. The digest is computed from the upload's chunks, so large
+files are never held in memory. Since a name always refers to the same
+bytes, URLs of blobs can be cached forever.
+
+Blobs are never deleted when products change; the `collect_product_images`
+management command removes the ones nothing refers to any more once they
+are old enough. Reusing a blob refreshes its modification time, so a product
+about to refer to an old unreferenced blob does not lose it to a collection
+running in between.
+"""
+import hashlib
+import os
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage, storages
+from django.utils.deconstruct import deconstructible
+
+BLOB_NAME = re.compile(r'(?:^|/)[0-9a-f]{2}/[0-9a-f]{64}(?:\.\w+)?$')
+
+
+def get_product_image_storage():
+    return storages['products']
+
+
+def file_digest(content):
+    """
+    Return the hex SHA-256 of a Django `File`, read chunk by chunk.
+    """
+    digest = hashlib.sha256()
+    for chunk in content.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_blob_name(name):
+    return bool(BLOB_NAME.search(name))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+
+        # The upload's directory is kept; its file name is replaced by the digest
+        directory, filename = posixpath.split(name)
+        digest = file_digest(content)
+        extension = posixpath.splitext(filename)[1].lower()
+        name = posixpath.join(directory, digest[:2], digest + extension)
+        if self.exists(name):
+            try:
+                os.utime(self.path(name))
+                return name
+            except FileNotFoundError:
+                # Collected since the check; store it again
+                pass
+        # Another upload of the same bytes racing this one makes _save pick an
+        # alternative name; that copy is simply not shared
+        return self._save(name, content)
@@ -1,3 +1,1616 @@
-from django.test import TestCase
+import base64
+import io
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.http import HttpResponse
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory, APITestCase
+from PIL import Image
+
+from accounts.models import CustomUser
+from . import bulk, carts, facets, images, listings, mpesa, payments, replicas, stock, write_queue
+from .models import Product, Category, Cart, CartItem, ContactInfo, Profile, Order, OrderItem, Payment, PaymentCallback, ProductFacet, ProductListing, StockReservation
+from .orders import reconcile
+from .categories import registry as category_registry
+from .checks import check_orderings, ordering_errors
+from .pagination import CatalogPagination, MAX_PAGE_SIZE
+from .query_plans import captured_full_scans, full_scans
+from .fragments import Fragment, fragment_keys
+from .payments import drain_callbacks, process_payment
+from .serializers import ProductSerializer
+from .views import ProductListView
+from .search import get_search_backend
+from .storage import get_product_image_storage, is_blob_name
+
+
+class CatalogueFixturesMixin:
+    """
+    Shared fixtures for the products API tests.
+    """
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    def create_products(self, count, category=None):
+        category = category or Category.objects.get_or_create(name='Phones')[0]
+        return [
+            Product.objects.create(
+                name=f'Product {i}',
+                description='A product',
+                image='products/placeholder.png',
+                price=Decimal('10.00') + i,
+                category=category,
+                stock=5,
+            )
+            for i in range(count)
+        ]
+
+    def create_orders(self, user, count, items_per_order=3):
+        contact_info, _ = ContactInfo.objects.get_or_create(user=user, defaults={'email': user.email})
+        cart = Cart.objects.create(user=user)
+        products = self.create_products(items_per_order)
+        # Bulk inserts skip the OrderItem signals that keep order totals current
+        # (see `products.orders`), so the totals given here stay as they are:
+        # zero, which only matches orders created without items
+        # (`items_per_order=0`); other callers never read totals
+        orders = Order.objects.bulk_create([
+            Order(user=user, cart=cart, contact_info=contact_info, total_amount=0)
+            for _ in range(count)
+        ])
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, quantity=1, price=product.price)
+            for order in orders
+            for product in products
+        ])
+        return orders
+
+
+class QueryCountTests(CatalogueFixturesMixin, APITestCase):
+    """
+    List and detail endpoints must issue a constant number of queries no
+    matter how many rows they serialise.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        self.client.force_authenticate(self.user)
+
+    def assertConstantQueries(self, url, num, grow):
+        with self.assertNumQueries(num):
+            self.client.get(url)
+        grow()
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_product_list(self):
+        self.create_products(3)
+        # validator aggregate, paginator COUNT and one joined SELECT for the page
+        self.assertConstantQueries(
+            reverse('products:list-product'), 3, lambda: self.create_products(5)
+        )
+
+    def test_product_detail(self):
+        product = self.create_products(1)[0]
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('products:detail-product', args=[product.pk]))
+        self.assertEqual(response.data['category']['name'], 'Phones')
+
+    def test_cart_list(self):
+        products = self.create_products(3)
+
+        def add_cart():
+            cart = Cart.objects.create(user=self.user)
+            CartItem.objects.bulk_create([CartItem(cart=cart, product=p) for p in products])
+
+        add_cart()
+        response = self.assertConstantQueries(reverse('products:list-cart'), 2, add_cart)
+        self.assertEqual(len(response.data[0]['items']), 3)
+
+    def test_order_list(self):
+        self.create_orders(self.user, 2)
+        # orders joined with contact info, then their items
+        response = self.assertConstantQueries(
+            reverse('products:list-order'), 2, lambda: self.create_orders(self.user, 3)
+        )
+        self.assertEqual(len(response.data), 5)
+        self.assertEqual(len(response.data[0]['items']), 3)
+
+    def test_order_list_is_scoped_to_user(self):
+        other = CustomUser.objects.create_user(email='other@example.com', password='secret')
+        own_order = self.create_orders(self.user, 1)[0]
+        other_order = self.create_orders(other, 1)[0]
+
+        response = self.client.get(reverse('products:list-order'))
+        self.assertEqual([order['id'] for order in response.data], [own_order.pk])
+        response = self.client.get(reverse('products:detail-order', args=[other_order.pk]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_profile_list(self):
+        def add_profile():
+            user = CustomUser.objects.create_user(email=f'user{CustomUser.objects.count()}@example.com')
+            contact_info = ContactInfo.objects.create(user=user, email=user.email)
+            Profile.objects.create(
+                user=user, contact_info=contact_info, first_name='A', last_name='B', address='Nairobi'
+            )
+
+        add_profile()
+        self.assertConstantQueries(reverse('products:profile'), 1, add_profile)
+
+
+class KeysetPaginationTests(CatalogueFixturesMixin, APITestCase):
+
+    def walk(self, url, link='next'):
+        ids = []
+        while url:
+            # validator aggregate plus the page itself: one seek per sort key at most, never an offset
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertLessEqual(len(queries), 3)
+            self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+            self.assertEqual(captured_full_scans(connection, queries.captured_queries), {})
+            self.assertNotIn('count', response.data)
+            ids.extend(product['id'] for product in response.data['results'])
+            last = url
+            url = response.data[link]
+        return ids, last
+
+    def test_product_cursor_walk(self):
+        products = self.create_products(7)
+        ids, _ = self.walk(reverse('products:list-product') + '?cursor=&page_size=2')
+        self.assertEqual(ids, sorted((p.pk for p in products), reverse=True))
+
+    def test_cursor_walk_with_ties_on_ordering_field(self):
+        products = self.create_products(6)
+        Product.objects.update(price=Decimal('5.00'))
+        ids, _ = self.walk(reverse('products:list-product') + '?cursor=&page_size=4&ordering=price')
+        self.assertEqual(ids, sorted(p.pk for p in products))
+
+    def test_cursor_walks_both_ways_through_ties(self):
+        products = self.create_products(9)
+        Product.objects.filter(pk__in=[p.pk for p in products[2:8]]).update(price=Decimal('5.00'))
+        expected = [p.pk for p in sorted(Product.objects.all(), key=lambda p: (p.price, p.pk))]
+        ids, last = self.walk(reverse('products:list-product') + '?cursor=&page_size=2&ordering=price')
+        self.assertEqual(ids, expected)
+        # Back from the last page, prepending each previous page
+        previous = self.client.get(last).data['previous']
+        pages = []
+        while previous:
+            response = self.client.get(previous)
+            pages.insert(0, [product['id'] for product in response.data['results']])
+            previous = response.data['previous']
+        self.assertEqual(sum(pages, []), expected[:len(sum(pages, []))])
+        self.assertEqual(len(sum(pages, [])) + 1, len(expected))
+
+    def test_tampered_cursors_are_not_found(self):
+        self.create_products(2)
+        url = reverse('products:list-product')
+        for position in ['5', '["x", "1"]', 'not json']:
+            with self.subTest(position=position):
+                cursor = base64.b64encode(f'p={position}'.encode()).decode()
+                response = self.client.get(url, {'cursor': cursor, 'ordering': 'price'})
+                self.assertEqual(response.status_code, 404)
+
+    def test_numbered_pages_break_ties_on_id(self):
+        products = self.create_products(4)
+        Product.objects.update(price=Decimal('5.00'))
+        response = self.client.get(reverse('products:list-product'), {'ordering': '-price', 'page_size': 4})
+        self.assertEqual([item['id'] for item in response.data['results']], sorted((p.pk for p in products), reverse=True))
+
+    def test_unsupported_orderings_are_rejected(self):
+        self.create_products(2)
+        for ordering in ['description', '-updated_at', 'price,name', 'category__name']:
+            with self.subTest(ordering=ordering):
+                with CaptureQueriesContext(connection) as queries:
+                    response = self.client.get(reverse('products:list-product'), {'ordering': ordering})
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('ordering', response.data)
+                self.assertEqual(len(queries), 0)
+
+    def test_orderings_are_index_backed(self):
+        self.assertEqual(check_orderings(), [])
+
+        class UnindexedView(ProductListView):
+            orderings = {'id': ['id'], 'description': ['description', 'id'], 'price': ['price']}
+
+        errors = ordering_errors(UnindexedView)
+        self.assertEqual([error.id for error in errors], ['products.E001', 'products.E001'])
+        self.assertIn("'description'", errors[0].msg)
+        self.assertIn('unique', errors[1].msg)
+
+    def test_page_size_is_capped(self):
+        request = Request(APIRequestFactory().get('/', {'cursor': '', 'page_size': 100000}))
+        self.assertEqual(CatalogPagination().get_page_size(request), MAX_PAGE_SIZE)
+
+
+class ProductSearchTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        phones = Category.objects.create(name='Phones')
+        kitchen = Category.objects.create(name='Kitchen')
+        self.galaxy = Product.objects.create(
+            name='Samsung Galaxy', description='Android phone', image='products/a.png',
+            price=Decimal('300.00'), category=phones,
+        )
+        self.iphone = Product.objects.create(
+            name='Apple iPhone', description='Faster than any Samsung', image='products/b.png',
+            price=Decimal('900.00'), category=phones,
+        )
+        self.kettle = Product.objects.create(
+            name='Electric Kettle', description='Boils water', image='products/c.png',
+            price=Decimal('40.00'), category=kitchen,
+        )
+
+    def search(self, text):
+        response = self.client.get(reverse('products:search-product'), {'q': text})
+        return [product['id'] for product in response.data['results']]
+
+    def test_ranks_name_matches_first(self):
+        self.assertEqual(self.search('samsung'), [self.galaxy.pk, self.iphone.pk])
+
+    def test_prefix_and_category_matching(self):
+        self.assertEqual(self.search('kitch'), [self.kettle.pk])
+        self.assertEqual(set(self.search('phon')), {self.galaxy.pk, self.iphone.pk})
+
+    def test_tolerates_typos(self):
+        self.assertEqual(self.search('samsnug'), [self.galaxy.pk, self.iphone.pk])
+
+    def test_index_follows_writes(self):
+        self.kettle.name = 'Stovetop Kettle'
+        self.kettle.save()
+        self.assertEqual(self.search('stovetop'), [self.kettle.pk])
+        self.kettle.category.name = 'Cookware'
+        self.kettle.category.save()
+        self.assertEqual(self.search('cookware'), [self.kettle.pk])
+        self.kettle.delete()
+        self.assertEqual(self.search('kettle'), [])
+
+    def test_list_filters_through_index(self):
+        response = self.client.get(reverse('products:list-product'), {'name': 'galax'})
+        self.assertEqual([p['id'] for p in response.data['results']], [self.galaxy.pk])
+        response = self.client.get(reverse('products:list-product'), {'search': 'samsung'})
+        self.assertEqual(response.data['count'], 2)
+
+
+class CatalogueCacheTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(2)
+
+    def get(self, url):
+        response = self.client.get(url)
+        return response['X-Cache'], response.data
+
+    def test_list_is_served_from_cache_until_a_product_changes(self):
+        url = reverse('products:list-product')
+        self.assertEqual(self.get(url)[0], 'MISS')
+        # only the conditional GET validator query runs
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(url)[0], 'HIT')
+        self.assertEqual(self.get(url + '?page_size=1')[0], 'MISS')
+
+        self.products[0].name = 'Renamed'
+        self.products[0].save()
+        status, data = self.get(url)
+        self.assertEqual(status, 'MISS')
+        self.assertIn('Renamed', [p['name'] for p in data['results']])
+
+    def test_product_change_only_invalidates_its_own_detail(self):
+        first, second = [reverse('products:detail-product', args=[p.pk]) for p in self.products]
+        self.get(first), self.get(second)
+        self.products[0].save()
+        self.assertEqual(self.get(first)[0], 'MISS')
+        self.assertEqual(self.get(second)[0], 'HIT')
+
+    def test_category_rename_invalidates_products_and_categories(self):
+        category = self.products[0].category
+        detail = reverse('products:detail-product', args=[self.products[0].pk])
+        categories = reverse('products:list-category')
+        self.get(detail), self.get(categories)
+        category.name = 'Tablets'
+        category.save()
+        status, data = self.get(detail)
+        self.assertEqual((status, data['category']['name']), ('MISS', 'Tablets'))
+        self.assertEqual(self.get(categories)[0], 'MISS')
+
+    def test_stats_count_hits_and_misses(self):
+        url = reverse('products:list-category')
+        self.get(url), self.get(url), self.get(url)
+        admin = CustomUser.objects.create_superuser(email='admin@example.com', password='secret')
+        self.client.force_authenticate(admin)
+        response = self.client.get(reverse('products:catalogue-cache-stats'))
+        self.assertEqual(response.data, {'hits': 2, 'misses': 1})
+
+
+class ConditionalGetTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(3)
+
+    def test_unchanged_list_returns_304_from_one_query(self):
+        url = reverse('products:list-product')
+        etag = self.client.get(url)['ETag']
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+    def test_list_validator_changes_on_update_delete_and_query(self):
+        url = reverse('products:list-product')
+        etag = self.client.get(url)['ETag']
+        self.assertNotEqual(self.client.get(url + '?page_size=1')['ETag'], etag)
+
+        self.products[0].category.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        self.products[1].delete()
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_detail_last_modified(self):
+        url = reverse('products:detail-product', args=[self.products[0].pk])
+        last_modified = self.client.get(url)['Last-Modified']
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_missing_detail_is_still_404(self):
+        url = reverse('products:detail-category', args=[999])
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+
+class FakeDarajaHandler(BaseHTTPRequestHandler):
+    """
+    Minimal stand-in for the Daraja OAuth and STK push endpoints.
+    """
+
+    def do_GET(self):
+        self.server.token_requests += 1
+        self.send_json({'access_token': 'fake-token', 'expires_in': '3599'})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        if self.headers['Authorization'] != 'Bearer fake-token':
+            return self.send_json({'errorMessage': 'Invalid Access Token'}, status=401)
+        self.server.pushes.append(body)
+        if self.server.push_error:
+            # A gateway error page instead of Daraja's JSON
+            content = b'<html>Service Unavailable</html>'
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            return self.wfile.write(content)
+        self.send_json({
+            'MerchantRequestID': f'merchant-{len(self.server.pushes)}',
+            'CheckoutRequestID': f'ws_CO_{len(self.server.pushes)}',
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+        })
+
+    def send_json(self, payload, status=200):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PaymentPipelineTests(APITestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeDarajaHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.settings_override = override_settings(
+            MPESA_API_BASE_URL='http://127.0.0.1:%s/' % cls.server.server_port
+        )
+        cls.settings_override.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.settings_override.disable()
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.token_requests = 0
+        self.server.pushes = []
+        self.server.push_error = False
+        mpesa._client = None
+        self.user = CustomUser.objects.create_user(email='payer@example.com', password='secret')
+        self.client.force_authenticate(self.user)
+
+    def create_payment(self, **data):
+        data = {'phone_number': '0712345678', 'amount': 150, 'account_reference': 'ORDER1',
+                'transaction_desc': 'Checkout', **data}
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.post(reverse('products:create-payment'), data, format='json')
+        return response, callbacks
+
+    def test_create_returns_immediately_and_queues_the_push(self):
+        response, callbacks = self.create_payment()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'queued')
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(self.server.pushes, [])
+
+    def test_worker_pushes_and_reuses_the_access_token(self):
+        first = self.create_payment()[0].data['id']
+        second = self.create_payment(amount=20)[0].data['id']
+        self.assertTrue(process_payment(first))
+        self.assertTrue(process_payment(second))
+        self.assertFalse(process_payment(second))
+
+        self.assertEqual(self.server.token_requests, 1)
+        self.assertEqual([push['Amount'] for push in self.server.pushes], [150, 20])
+        self.assertEqual(self.server.pushes[0]['PhoneNumber'], '254712345678')
+        payment = Payment.objects.get(pk=first)
+        self.assertEqual((payment.status, payment.checkout_request_id), ('sent', 'ws_CO_1'))
+
+    def test_non_json_push_responses_fail_the_payment(self):
+        self.server.push_error = True
+        payment_id = self.create_payment()[0].data['id']
+        self.assertTrue(process_payment(payment_id))
+        self.assertEqual(Payment.objects.get(pk=payment_id).status, 'failed')
+
+    def test_stale_sending_payments_are_recovered(self):
+        stale = timezone.now() - payments.SENDING_TIMEOUT * 2
+        retry = Payment.objects.create(phone_number='254712345678', amount=1, status='sending', attempts=1)
+        give_up = Payment.objects.create(
+            phone_number='254712345678', amount=1, status='sending', attempts=payments.MAX_PUSH_ATTEMPTS
+        )
+        recent = Payment.objects.create(phone_number='254712345678', amount=1, status='sending', attempts=1)
+        Payment.objects.filter(pk__in=[retry.pk, give_up.pk]).update(updated_at=stale)
+        call_command('process_payments', stdout=io.StringIO())
+        self.assertEqual(
+            [Payment.objects.get(pk=p.pk).status for p in (retry, give_up, recent)], ['sent', 'failed', 'sending']
+        )
+
+    def test_orders_of_other_users_are_rejected(self):
+        other = CustomUser.objects.create_user(email='other@example.com', password='secret')
+        contact_info = ContactInfo.objects.create(user=other, email=other.email)
+        order = Order.objects.create(user=other, cart=Cart.objects.create(user=other), contact_info=contact_info)
+        response, callbacks = self.create_payment(order=order.pk)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('order', response.data)
+        self.assertEqual(callbacks, [])
+
+    def test_order_payments_are_charged_the_order_total(self):
+        contact_info = ContactInfo.objects.create(user=self.user, email=self.user.email)
+        order = Order.objects.create(
+            user=self.user, cart=Cart.objects.create(user=self.user), contact_info=contact_info,
+            total_amount=Decimal('4999.50'),
+        )
+        response, callbacks = self.create_payment(order=order.pk, amount=1)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('amount', response.data)
+        self.assertEqual(callbacks, [])
+
+        data = {'phone_number': '0712345678', 'order': order.pk, 'account_reference': 'ORDER1', 'transaction_desc': 'Checkout'}
+        response = self.client.post(reverse('products:create-payment'), data, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['amount'], 5000)
+
+    def test_rejects_invalid_phone_numbers(self):
+        response, callbacks = self.create_payment(phone_number='123')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(callbacks, [])
+
+
+@override_settings(MPESA_CALLBACK_TOKEN='callback-secret')
+class PaymentCallbackTests(APITestCase):
+
+    def setUp(self):
+        user = CustomUser.objects.create_user(email='payer@example.com', password='secret')
+        contact_info = ContactInfo.objects.create(user=user, email=user.email)
+        self.order = Order.objects.create(user=user, cart=Cart.objects.create(user=user), contact_info=contact_info)
+        self.payment = Payment.objects.create(
+            phone_number='254712345678', amount=150, account_reference='ORDER1', transaction_desc='Checkout',
+            status='sent', checkout_request_id='ws_CO_1', order=self.order,
+        )
+
+    def post_result(self, checkout_request_id='ws_CO_1', result_code=0, token='callback-secret'):
+        result = {
+            'MerchantRequestID': 'merchant-1',
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': result_code,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': 150},
+                {'Name': 'MpesaReceiptNumber', 'Value': 'NLJ7RT61SV'},
+            ]},
+        }
+        with self.captureOnCommitCallbacks():
+            return self.client.post(
+                f"{reverse('products:mpesa_stk_push_callback')}?token={token}",
+                {'Body': {'stkCallback': result}}, format='json',
+            )
+
+    def test_duplicate_deliveries_are_queued_once(self):
+        self.assertEqual(self.post_result().json(), {'ResultCode': 0, 'ResultDesc': 'Accepted'})
+        self.post_result()
+        self.assertEqual(PaymentCallback.objects.count(), 1)
+
+        self.assertEqual(drain_callbacks(), 1)
+        self.assertEqual(drain_callbacks(), 0)
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.mpesa_receipt_number), ('paid', 'NLJ7RT61SV'))
+        self.order.refresh_from_db()
+        self.assertIsNotNone(self.order.paid_at)
+
+    def test_underpayments_leave_the_order_unpaid(self):
+        Order.objects.filter(pk=self.order.pk).update(total_amount=Decimal('5000.00'))
+        self.post_result()
+        drain_callbacks()
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.status, 'paid')
+        self.assertIsNone(self.order.paid_at)
+
+        # A second payment for the rest settles it
+        Payment.objects.create(
+            phone_number='254712345678', amount=4850, account_reference='ORDER1', transaction_desc='Checkout',
+            status='sent', checkout_request_id='ws_CO_2', order=self.order,
+        )
+        self.post_result(checkout_request_id='ws_CO_2')
+        drain_callbacks()
+        self.order.refresh_from_db()
+        self.assertIsNotNone(self.order.paid_at)
+
+    def test_failed_result_marks_payment_failed(self):
+        self.post_result(result_code=1032)
+        drain_callbacks()
+        self.payment.refresh_from_db()
+        self.assertEqual((self.payment.status, self.payment.result_code), ('failed', 1032))
+        self.order.refresh_from_db()
+        self.assertIsNone(self.order.paid_at)
+
+    def test_unknown_checkout_ids_wait_for_their_payment(self):
+        self.post_result(checkout_request_id='ws_CO_2')
+        self.assertEqual(drain_callbacks(), 1)
+        self.assertEqual(drain_callbacks(), 0)
+        callback = PaymentCallback.objects.get()
+        self.assertIsNone(callback.processed_at)
+        self.assertEqual(callback.attempts, 1)
+
+    def test_rejects_malformed_payloads(self):
+        url = reverse('products:mpesa_stk_push_callback') + '?token=callback-secret'
+        response = self.client.post(url, {'Body': {}}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_rejects_malformed_result_codes(self):
+        for result_code in ['abc', None]:
+            with self.subTest(result_code=result_code):
+                self.assertEqual(self.post_result(result_code=result_code).status_code, 400)
+        self.assertFalse(PaymentCallback.objects.exists())
+
+    def test_a_failing_result_does_not_undo_its_batch(self):
+        poison = PaymentCallback.objects.create(checkout_request_id='ws_CO_0', payload={'ResultCode': 'abc'})
+        self.post_result()
+        with self.assertLogs('products.payments', 'ERROR'):
+            self.assertEqual(drain_callbacks(), 2)
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.status, 'paid')
+        poison.refresh_from_db()
+        self.assertEqual((poison.attempts, poison.processed_at), (1, None))
+
+        PaymentCallback.objects.filter(pk=poison.pk).update(attempts=payments.MAX_CALLBACK_ATTEMPTS - 1, claimed_by='')
+        with self.assertLogs('products.payments', 'ERROR'):
+            drain_callbacks()
+        poison.refresh_from_db()
+        self.assertIsNotNone(poison.processed_at)
+
+    def test_rejects_forged_results(self):
+        self.assertEqual(self.post_result(token='guess').status_code, 403)
+        with override_settings(MPESA_CALLBACK_ALLOWED_IPS=['196.201.214.200']):
+            self.assertEqual(self.post_result().status_code, 403)
+        self.assertFalse(PaymentCallback.objects.exists())
+
+
+class StockReservationTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        self.client.force_authenticate(self.user)
+        self.product = self.create_products(1)[0]
+        self.cart = Cart.objects.create(user=self.user)
+
+    def assertCounters(self, stock_left, reserved):
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.reserved), (stock_left, reserved))
+
+    def add_to_cart(self, cart, quantity):
+        return self.client.post(
+            reverse('products:create-cart-item'),
+            {'cart': cart.pk, 'product': self.product.pk, 'quantity': quantity},
+            format='json',
+        )
+
+    def test_cart_items_hold_stock_until_it_runs_out(self):
+        self.assertEqual(self.add_to_cart(self.cart, 3).status_code, 201)
+        self.assertCounters(5, 3)
+        other_cart = Cart.objects.create(user=self.user)
+        response = self.add_to_cart(other_cart, 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('quantity', response.json())
+        self.assertFalse(CartItem.objects.filter(cart=other_cart).exists())
+        self.assertCounters(5, 3)
+
+    def test_commit_converts_holds_into_sold_stock(self):
+        stock.reserve(self.cart, self.product.pk, 2)
+        stock.commit(self.cart, {self.product.pk: 3})
+        self.assertCounters(2, 0)
+        self.assertFalse(StockReservation.objects.exists())
+        with self.assertRaises(stock.InsufficientStock):
+            stock.commit(self.cart, {self.product.pk: 3})
+        self.assertCounters(2, 0)
+
+    def test_expired_holds_are_released(self):
+        stock.reserve(self.cart, self.product.pk, 2, ttl=timedelta(minutes=5))
+        stock.reserve(self.cart, self.product.pk, 1)
+        StockReservation.objects.filter(quantity=2).update(expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(stock.release_expired(), 1)
+        self.assertCounters(5, 1)
+
+    def test_deleting_a_cart_releases_its_holds(self):
+        stock.reserve(self.cart, self.product.pk, 4)
+        self.cart.delete()
+        self.assertCounters(5, 0)
+
+    def test_shortage_report_survives_a_concurrent_restock(self):
+        # The re-read finds enough stock, as if another request restocked in between
+        self.assertEqual(stock._first_short({self.product.pk: 1}), self.product.pk)
+
+
+class CheckoutTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        ContactInfo.objects.create(user=self.user, email=self.user.email)
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+
+    def fill_cart(self, count):
+        products = self.create_products(count)
+        CartItem.objects.bulk_create([CartItem(cart=self.cart, product=product, quantity=2) for product in products])
+        return products
+
+    def checkout(self):
+        return self.client.post(reverse('products:checkout'), {'cart': self.cart.pk}, format='json')
+
+    def test_checkout_creates_the_order_in_constant_queries(self):
+        self.fill_cart(2)
+        with self.assertNumQueries(19) as small:
+            self.checkout()
+        self.fill_cart(10)
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.checkout()
+
+        self.assertEqual(response.status_code, 201)
+        order = Order.objects.get(pk=response.json()['id'])
+        self.assertEqual(order.items.count(), 10)
+        self.assertEqual(order.total_amount, sum(2 * (Decimal('10.00') + i) for i in range(10)))
+        self.assertEqual(Decimal(response.json()['total_amount']), order.total_amount)
+        self.assertFalse(self.cart.items.exists())
+        self.assertEqual(set(Product.objects.filter(orderitem__order=order).values_list('stock', flat=True)), {3})
+
+    def test_empty_cart_is_rejected(self):
+        response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cart', response.json())
+
+    def test_insufficient_stock_rolls_back(self):
+        products = self.fill_cart(2)
+        CartItem.objects.filter(product=products[1]).update(quantity=6)
+        response = self.checkout()
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(self.cart.items.count(), 2)
+        self.assertEqual(Product.objects.get(pk=products[0].pk).stock, 5)
+
+    def test_cannot_check_out_another_users_cart(self):
+        other = CustomUser.objects.create_user(email='other@example.com', password='secret')
+        self.cart = Cart.objects.create(user=other)
+        self.assertEqual(self.checkout().status_code, 400)
+
+
+class OrderTotalsTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        self.client.force_authenticate(self.user)
+        self.order, self.other_order = self.create_orders(self.user, 2, items_per_order=0)
+        self.products = self.create_products(2)
+
+    def assertTotals(self, order, total_amount, item_count):
+        order.refresh_from_db()
+        self.assertEqual((order.total_amount, order.item_count), (Decimal(total_amount), item_count))
+
+    def test_item_changes_apply_deltas(self):
+        item = OrderItem.objects.create(order=self.order, product=self.products[0], quantity=2, price=Decimal('10.00'))
+        OrderItem.objects.create(order=self.order, product=self.products[1], quantity=1, price=Decimal('11.00'))
+        self.assertTotals(self.order, '31.00', 3)
+
+        item = OrderItem.objects.get(pk=item.pk)
+        item.quantity = 3
+        with self.assertNumQueries(4):
+            item.save()
+        self.assertTotals(self.order, '41.00', 4)
+
+        item.order = self.other_order
+        item.save()
+        self.assertTotals(self.order, '11.00', 1)
+        self.assertTotals(self.other_order, '30.00', 3)
+
+        OrderItem.objects.filter(order=self.other_order).delete()
+        self.assertTotals(self.other_order, '0.00', 0)
+
+    def test_status_update_leaves_totals_alone(self):
+        OrderItem.objects.create(order=self.order, product=self.products[0], quantity=2, price=Decimal('10.00'))
+        response = self.client.patch(
+            reverse('products:update-order', args=[self.order.pk]), {'status': 'shipped'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['total_amount'], '20.00')
+        self.assertTotals(self.order, '20.00', 2)
+
+    def test_reconcile_fixes_drift(self):
+        OrderItem.objects.create(order=self.order, product=self.products[0], quantity=2, price=Decimal('10.00'))
+        Order.objects.update(total_amount=99, item_count=7)
+        self.assertEqual(reconcile(batch_size=1), 2)
+        self.assertTotals(self.order, '20.00', 2)
+        self.assertTotals(self.other_order, '0.00', 0)
+        self.assertEqual(reconcile(), 0)
+
+
+class CartStoreTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        carts._store = None
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        ContactInfo.objects.create(user=self.user, email=self.user.email)
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = self.create_products(3)
+
+    def tearDown(self):
+        carts._store = None
+        super().tearDown()
+
+    def fill(self):
+        url = reverse('products:cart-contents', args=[self.cart.pk])
+        for product in self.products:
+            self.client.post(url, {'product': product.pk, 'quantity': 1}, format='json')
+        self.client.post(url, {'product': self.products[0].pk, 'quantity': 2}, format='json')
+        return self.client.put(
+            reverse('products:cart-contents-item', args=[self.cart.pk, self.products[2].pk]), {'quantity': 0}, format='json'
+        )
+
+    def assertSummary(self, response):
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([(line['product'], line['quantity']) for line in data['items']],
+                         [(self.products[0].pk, 3), (self.products[1].pk, 1)])
+        self.assertEqual((data['item_count'], data['total']), (4, '41.00'))
+
+    def test_database_store(self):
+        self.assertSummary(self.fill())
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 2)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).reserved, 3)
+        with self.assertNumQueries(3):
+            self.assertSummary(self.client.get(reverse('products:cart-contents', args=[self.cart.pk])))
+
+    @override_settings(CART_STORE='memory')
+    def test_memory_store_writes_back_at_checkout(self):
+        self.assertSummary(self.fill())
+        self.assertFalse(CartItem.objects.exists())
+        # The cart row and the products
+        with self.assertNumQueries(2):
+            self.assertSummary(self.client.get(reverse('products:cart-contents', args=[self.cart.pk])))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('products:checkout'), {'cart': self.cart.pk}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual((response.json()['item_count'], response.json()['total_amount']), (4, '41.00'))
+        self.assertEqual(carts.get_cart_store().items(self.cart.pk), {})
+
+    @override_settings(CART_STORE='memory')
+    def test_periodic_flush_writes_changed_carts(self):
+        self.fill()
+        self.assertEqual(carts.get_cart_store().flush(), 1)
+        self.assertEqual(carts.get_cart_store().flush(), 0)
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity')),
+            {self.products[0].pk: 3, self.products[1].pk: 1},
+        )
+
+    @override_settings(CART_STORE='memory')
+    def test_failed_flush_keeps_the_cart_dirty(self):
+        self.fill()
+        with mock.patch.object(CartItem.objects, 'bulk_create', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                carts.get_cart_store().flush()
+        self.assertEqual(carts.get_cart_store().flush(), 1)
+        self.assertEqual(CartItem.objects.filter(cart=self.cart).count(), 2)
+
+    def test_url_names_the_product_being_changed(self):
+        self.fill()
+        url = reverse('products:cart-contents-item', args=[self.cart.pk, self.products[0].pk])
+        self.client.put(url, {'product': self.products[1].pk, 'quantity': 5}, format='json')
+        self.assertEqual(
+            dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity')),
+            {self.products[0].pk: 5, self.products[1].pk: 1},
+        )
+
+    def test_other_users_cart_is_hidden(self):
+        other = CustomUser.objects.create_user(email='other@example.com', password='secret')
+        cart = Cart.objects.create(user=other)
+        self.assertEqual(self.client.get(reverse('products:cart-contents', args=[cart.pk])).status_code, 404)
+
+    def test_anonymous_cart_needs_its_token(self):
+        self.client.force_authenticate(None)
+        response = self.client.post(reverse('products:create-cart'), {}, format='json')
+        cart_id, token = response.json()['id'], response.json()['token']
+        url = reverse('products:cart-contents', args=[cart_id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_X_CART_TOKEN=str(uuid.uuid4())).status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_X_CART_TOKEN='not-a-token').status_code, 404)
+        self.assertEqual(self.client.get(url, HTTP_X_CART_TOKEN=token).status_code, 200)
+        self.assertNotIn('token', self.client.get(reverse('products:detail-cart', args=[cart_id])).json())
+
+
+class CartBatchTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        carts._store = None
+        self.user = CustomUser.objects.create_user(email='buyer@example.com', password='secret')
+        self.client.force_authenticate(self.user)
+        self.cart = Cart.objects.create(user=self.user)
+        self.products = self.create_products(10)
+
+    def tearDown(self):
+        carts._store = None
+        super().tearDown()
+
+    def batch(self, lines, cart=None):
+        cart = cart or self.cart
+        url = reverse('products:cart-contents-batch', args=[cart.pk])
+        return self.client.post(url, lines, format='json', HTTP_X_CART_TOKEN=str(cart.token))
+
+    def lines(self):
+        return dict(CartItem.objects.filter(cart=self.cart).values_list('product_id', 'quantity'))
+
+    def test_batch_upsert_uses_constant_queries(self):
+        self.batch([{'product': product.pk, 'quantity': 1} for product in self.products[:2]])
+        with self.assertNumQueries(16) as small:
+            self.batch([{'product': product.pk, 'quantity': 1} for product in self.products[:2]])
+        with self.assertNumQueries(len(small.captured_queries)):
+            response = self.batch([{'product': product.pk, 'quantity': 2} for product in self.products])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.lines(), {product.pk: 2 for product in self.products})
+        self.assertEqual(set(Product.objects.values_list('reserved', flat=True)), {2})
+
+    def test_unknown_products_reject_the_whole_batch(self):
+        response = self.batch([{'product': self.products[0].pk, 'quantity': 1}, {'product': 999, 'quantity': 1}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.lines(), {})
+
+    def test_adding_a_product_twice_tops_up_one_line(self):
+        url = reverse('products:create-cart-item')
+        for _ in range(2):
+            self.client.post(url, {'cart': self.cart.pk, 'product': self.products[0].pk, 'quantity': 2}, format='json')
+        self.assertEqual(self.lines(), {self.products[0].pk: 4})
+
+    def test_login_merges_the_anonymous_cart(self):
+        anonymous = Cart.objects.create()
+        self.batch([{'product': self.products[0].pk, 'quantity': 1}])
+        self.client.force_authenticate(None)
+        self.batch([{'product': self.products[0].pk, 'quantity': 2}, {'product': self.products[1].pk, 'quantity': 1}],
+                   cart=anonymous)
+
+        response = self.client.post(
+            reverse('login-customer'),
+            {'email': self.user.email, 'password': 'secret', 'cart': anonymous.pk, 'cart_token': str(anonymous.token)},
+            format='json',
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Cart.objects.filter(pk=anonymous.pk).exists())
+        self.assertEqual(self.lines(), {self.products[0].pk: 3, self.products[1].pk: 1})
+        self.assertEqual(StockReservation.objects.filter(cart=self.cart).count(), 3)
+        self.assertEqual(Product.objects.get(pk=self.products[0].pk).reserved, 3)
+
+    def test_claim_gives_an_anonymous_cart_to_a_user_without_one(self):
+        self.cart.delete()
+        anonymous = Cart.objects.create()
+        data = {'cart': anonymous.pk, 'token': str(anonymous.token)}
+        response = self.client.post(reverse('products:claim-cart'), data, format='json')
+        self.assertEqual(response.json()['cart'], anonymous.pk)
+        self.assertEqual(Cart.objects.get(pk=anonymous.pk).user, self.user)
+        response = self.client.post(reverse('products:claim-cart'), data, format='json')
+        self.assertEqual(response.status_code, 404)
+
+    def test_claim_needs_the_carts_token(self):
+        anonymous = Cart.objects.create()
+        data = {'cart': anonymous.pk, 'token': str(uuid.uuid4())}
+        response = self.client.post(reverse('products:claim-cart'), data, format='json')
+        self.assertEqual(response.status_code, 404)
+        self.assertIsNone(Cart.objects.get(pk=anonymous.pk).user)
+        response = self.client.post(reverse('products:claim-cart'), {'cart': anonymous.pk}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class BulkImportExportTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = CustomUser.objects.create_user(email='admin@example.com', password='secret', is_staff=True)
+        self.client.force_authenticate(self.admin)
+        self.existing = self.create_products(1)[0]
+
+    def upload(self, name, content, **data):
+        upload = SimpleUploadedFile(name, content.encode())
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(reverse('products:import-product'), {'file': upload, **data}, format='multipart')
+
+    def test_csv_import_creates_updates_and_reports_bad_rows(self):
+        content = (
+            'id,name,description,price,stock,category,image\n'
+            f'{self.existing.pk},Renamed phone,,99.00,7,Phones,\n'
+            ',Laptop,Fast,1200.50,3,Computers,\n'
+            ',Broken,,not-a-price,1,Computers,\n'
+            ',Mouse,,15,,Computers,\n'
+        )
+        # Per chunk: savepoints, one id lookup, one insert, one update, and one
+        # facet update per changed combination (plus an insert for new ones);
+        # then the search index and the listings. The registry only records
+        # new categories on commit, so inside the test's transaction the
+        # second chunk looks 'Computers' up again
+        with self.assertNumQueries(29):
+            response = self.upload('catalogue.csv', content, chunk_size=2)
+        result = response.json()
+        self.assertEqual((result['created'], result['updated'], result['failed']), (2, 1, 1))
+        self.assertEqual(result['errors'][0]['line'], 4)
+        self.assertIn('price', result['errors'][0]['errors'])
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.name, self.existing.stock), ('Renamed phone', 7))
+        self.assertEqual(Category.objects.filter(name='Computers').count(), 1)
+        self.assertEqual(Product.objects.get(name='Mouse').stock, 0)
+        self.assertEqual(get_search_backend().search('laptop'), [Product.objects.get(name='Laptop').pk])
+
+    def test_update_only_touches_the_columns_given(self):
+        Product.objects.filter(pk=self.existing.pk).update(description='Shiny', reserved=2)
+        before = Product.objects.get(pk=self.existing.pk)
+        content = f'id,stock\n{self.existing.pk},12\n{self.existing.pk},1\n,3\n'
+        result = self.upload('stock.csv', content).json()
+        self.assertEqual((result['created'], result['updated'], result['failed']), (0, 1, 2))
+        self.assertEqual(sorted(error['line'] for error in result['errors']), [3, 4])
+        self.assertIn('stock', [error for error in result['errors'] if error['line'] == 3][0]['errors'])
+        self.assertIn('name', [error for error in result['errors'] if error['line'] == 4][0]['errors'])
+
+        product = Product.objects.get(pk=self.existing.pk)
+        self.assertEqual(product.stock, 12)
+        self.assertEqual(
+            (product.name, product.description, product.price, product.category_id, product.image.name),
+            (before.name, 'Shiny', before.price, before.category_id, before.image.name),
+        )
+
+    def test_jsonl_round_trip_through_the_commands(self):
+        out = io.StringIO()
+        call_command('export_products', '--format', 'jsonl', stdout=out)
+        rows = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(rows[0]['name'], self.existing.name)
+
+        rows[0]['price'] = '1.00'
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl', delete=False) as source:
+            source.write('\n'.join(json.dumps(row) for row in rows) + '\n{not json}\n')
+        self.addCleanup(os.remove, source.name)
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_products', source.name, stdout=io.StringIO(), stderr=io.StringIO())
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.price, Decimal('1.00'))
+
+    def test_export_streams_csv(self):
+        self.create_products(3, category=self.existing.category)
+        response = self.client.get(reverse('products:export-product'), {'type': 'csv'})
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'id,name,description,price,stock,category,image')
+        self.assertEqual(len(lines), 5)
+
+
+PIXEL_GIF = b'GIF89a\x01\x00\x01\x00\x80\x00\x00\x00\x00\x00\xff\xff\xff!\xf9\x04\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;'
+
+
+class CategoryRegistryTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        category_registry.clear()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+
+    def create_product(self, name, category):
+        # Nested categories cannot travel in a multipart request, so drive the serializer directly
+        image = SimpleUploadedFile('pixel.gif', PIXEL_GIF, content_type='image/gif')
+        serializer = ProductSerializer(data={
+            'name': name, 'description': 'A product', 'price': '10.00', 'stock': 1,
+            'category': {'name': category}, 'image': image,
+        })
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return serializer
+
+    def category_queries(self, queries):
+        # The search index joins categories to build its documents; that is not a category lookup
+        return [
+            query['sql'] for query in queries
+            if 'products_category' in query['sql'] and 'products_product_fts' not in query['sql']
+            and 'INNER JOIN "products_category"' not in query['sql']
+        ]
+
+    def test_product_writes_reuse_categories_without_querying_them(self):
+        # Run the registry's on-commit hook, but not the image variants a product write would queue
+        with self.captureOnCommitCallbacks(execute=True):
+            category_registry.resolve('Phones')
+        with CaptureQueriesContext(connection) as queries:
+            serializer = self.create_product('Tablet', 'Phones')
+        self.assertEqual(serializer.data['category']['name'], 'Phones')
+        self.assertEqual(self.category_queries(queries.captured_queries), [])
+        self.assertEqual(Category.objects.count(), 1)
+
+    def test_rolled_back_categories_are_not_remembered(self):
+        category_registry.ids()
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                category_registry.resolve_many(['Phones'])
+                raise RuntimeError
+        self.assertNotIn('Phones', category_registry.ids())
+        self.assertEqual(category_registry.resolve('Phones'), Category.objects.get(name='Phones').pk)
+
+    def test_update_moves_the_product_instead_of_renaming_the_category(self):
+        phone = self.create_products(2)[0]
+        response = self.client.patch(
+            reverse('products:update-product', args=[phone.pk]), {'category': {'name': 'Tablets'}}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(Category.objects.values_list('name', flat=True)), ['Phones', 'Tablets'])
+        self.assertEqual(Product.objects.filter(category__name='Phones').count(), 1)
+
+    def test_registry_follows_category_changes(self):
+        category = Category.objects.create(name='Phones')
+        self.assertEqual(category_registry.resolve('Phones'), category.pk)
+        category.name = 'Mobiles'
+        category.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(category_registry.resolve('Mobiles'), category.pk)
+        self.create_product('Phone', 'Phones')
+        self.assertEqual(Category.objects.count(), 2)
+
+
+@override_settings(PRODUCT_IMAGE_WIDTHS=(160, 320, 1280))
+class ImageVariantTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.product = self.create_products(1)[0]
+        buffer = io.BytesIO()
+        Image.new('RGBA', (800, 600), (200, 30, 30, 128)).save(buffer, format='PNG')
+        self.product.image.save('photo.png', ContentFile(buffer.getvalue()))
+
+    def test_saving_an_image_queues_variants(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.product.image.save('other.png', ContentFile(b''))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_variants_are_resized_copies_exposed_as_srcset(self):
+        self.assertEqual(ProductSerializer(self.product).data['image_srcset'], {})
+        before = self.product.updated_at
+        self.assertTrue(images.generate_variants(self.product.pk))
+        self.assertFalse(images.generate_variants(self.product.pk))
+
+        self.product.refresh_from_db()
+        # Validators (ETag, Last-Modified) follow updated_at, so it must move with the variants
+        self.assertGreater(self.product.updated_at, before)
+        webp = self.product.image_variants['webp']
+        # 1280 is wider than the upload, so that copy keeps its width
+        self.assertEqual(sorted(webp, key=int), ['160', '320', '800'])
+        with default_storage.open(webp['320']) as file, Image.open(file) as image:
+            self.assertEqual((image.format, image.size), ('WEBP', (320, 240)))
+        with default_storage.open(self.product.image_variants['jpeg']['160']) as file, Image.open(file) as image:
+            self.assertEqual((image.format, image.mode), ('JPEG', 'RGB'))
+
+        srcset = ProductSerializer(self.product).data['image_srcset']
+        self.assertEqual(set(srcset), {'webp', 'jpeg'})
+        self.assertEqual(srcset['webp'].split(', ')[0], f'{default_storage.url(webp["160"])} 160w')
+
+    def test_variants_of_a_replaced_image_are_not_served(self):
+        images.generate_variants(self.product.pk)
+        self.product.refresh_from_db()
+        self.product.image = 'products/placeholder.png'
+        self.product.save()
+        self.assertEqual(ProductSerializer(self.product).data['image_srcset'], {})
+
+
+class ContentAddressedStorageTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.storage = get_product_image_storage()
+        self.first, self.second = self.create_products(2)
+
+    def test_identical_uploads_share_one_blob(self):
+        self.first.image.save('waka.png', ContentFile(PIXEL_GIF))
+        self.second.image.save('waka.png', ContentFile(PIXEL_GIF))
+        self.assertEqual(self.first.image.name, self.second.image.name)
+        self.assertTrue(is_blob_name(self.first.image.name))
+        self.assertEqual(self.storage.listdir(os.path.dirname(self.first.image.name))[1], [os.path.basename(self.first.image.name)])
+        with self.first.image.open('rb') as file:
+            self.assertEqual(file.read(), PIXEL_GIF)
+
+    def test_garbage_collection_keeps_referenced_blobs(self):
+        self.first.image.save('waka.png', ContentFile(PIXEL_GIF))
+        self.second.image.save('other.gif', ContentFile(PIXEL_GIF + b'\0'))
+        orphan = self.second.image.name
+        variant = images.variant_name(orphan, 160, 'webp')
+        default_storage.save(variant, ContentFile(b'variant'))
+        self.second.image = self.first.image.name
+        self.second.save()
+
+        self.assertEqual(images.collect_garbage(), [])
+        self.assertEqual(sorted(images.collect_garbage(min_age=timedelta(0))), sorted([orphan, variant]))
+        self.assertFalse(self.storage.exists(orphan))
+        self.assertFalse(default_storage.exists(variant))
+        self.assertTrue(self.storage.exists(self.first.image.name))
+
+    def test_reusing_a_blob_keeps_it_from_collection(self):
+        self.first.image.save('waka.png', ContentFile(PIXEL_GIF))
+        blob = self.first.image.name
+        Product.objects.filter(pk=self.first.pk).update(image='')
+        old = (timezone.now() - timedelta(days=30)).timestamp()
+        os.utime(self.storage.path(blob), (old, old))
+
+        self.assertEqual(self.storage.save('products/waka.png', ContentFile(PIXEL_GIF)), blob)
+        self.assertEqual(images.collect_garbage(), [])
+        self.assertTrue(self.storage.exists(blob))
+
+    def test_adopting_legacy_copies_moves_them_onto_one_blob(self):
+        legacy = [default_storage.save('products/waka.png', ContentFile(PIXEL_GIF)) for _ in range(2)]
+        Product.objects.filter(pk=self.first.pk).update(image=legacy[0])
+        Product.objects.filter(pk=self.second.pk).update(image=legacy[1])
+
+        out = io.StringIO()
+        call_command('collect_product_images', '--adopt', '--min-age=0', stdout=out)
+        names = set(Product.objects.values_list('image', flat=True))
+        self.assertEqual(len(names), 1)
+        self.assertTrue(is_blob_name(names.pop()))
+        self.assertIn('2 unreferenced file(s) deleted.', out.getvalue())
+        self.assertFalse(any(default_storage.exists(name) for name in legacy))
+
+
+class MediaServingTests(APITestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root))
+        self.blob = get_product_image_storage().save('products/waka.gif', ContentFile(PIXEL_GIF))
+        self.url = reverse('media', args=[self.blob])
+
+    def test_content_addressed_files_are_immutable(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), PIXEL_GIF)
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('immutable', response['Cache-Control'])
+
+    def test_other_files_get_a_bounded_max_age(self):
+        name = default_storage.save('products/variants/waka-160w.webp', ContentFile(b'variant'))
+        response = self.client.get(reverse('media', args=[name]))
+        self.assertEqual(response['Cache-Control'], 'public, max-age=3600')
+
+    def test_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=6-9')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), PIXEL_GIF[6:10])
+        self.assertEqual(response['Content-Range'], f'bytes 6-9/{len(PIXEL_GIF)}')
+        self.assertEqual(response['Content-Length'], '4')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), PIXEL_GIF[-3:])
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual(response.status_code, 416)
+        # A range for an older version of the file gets the whole current one
+        response = self.client.get(self.url, HTTP_RANGE='bytes=6-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_offload_to_the_front_proxy(self):
+        with self.settings(MEDIA_SERVE_MODE='x-accel-redirect'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/protected-media/{self.blob}')
+        self.assertEqual(response.content, b'')
+        with self.settings(MEDIA_SERVE_MODE='x-sendfile'):
+            response = self.client.get(self.url)
+        self.assertEqual(response['X-Sendfile'], os.path.join(settings.MEDIA_ROOT, self.blob))
+
+    def test_paths_outside_media_root_are_not_served(self):
+        self.assertEqual(self.client.get('/media/../manage.py').status_code, 404)
+        self.assertEqual(self.client.get('/media/products/missing.png').status_code, 404)
+
+
+@override_settings(DATABASE_REPLICAS=['replica1'])
+class ReplicaRoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.router = replicas.ReplicaRouter()
+
+    def test_reads_use_replicas_only_when_allowed_and_until_a_write(self):
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+        with replicas.read_from_replicas():
+            self.assertEqual(self.router.db_for_read(Product), 'replica1')
+            self.assertEqual(self.router.db_for_write(Product), 'default')
+            self.assertEqual(self.router.db_for_read(Product), 'default')
+        self.assertEqual(self.router.db_for_read(Product), 'default')
+
+    def test_clients_that_wrote_are_pinned_to_the_primary(self):
+        def view(request):
+            # What a view behind ReplicaReadMixin would read from
+            with replicas.read_from_replicas():
+                reads = self.router.db_for_read(Product)
+                if request.method == 'POST':
+                    self.router.db_for_write(Product)
+            return HttpResponse(reads)
+
+        middleware = replicas.PrimaryPinMiddleware(view)
+        factory = APIRequestFactory()
+        response = middleware(factory.get('/'))
+        self.assertEqual((response.content, response.cookies.get(replicas.PIN_COOKIE)), (b'replica1', None))
+
+        response = middleware(factory.post('/'))
+        cookie = response.cookies[replicas.PIN_COOKIE]
+        self.assertEqual(cookie['max-age'], 5)
+        request = factory.get('/')
+        request.COOKIES[replicas.PIN_COOKIE] = cookie.value
+        self.assertTrue(replicas.is_pinned(request))
+
+
+@override_settings(SQLITE_TUNING=True)
+class WriteQueueTests(TransactionTestCase):
+
+    def test_locked_writes_are_retried_in_a_fresh_transaction(self):
+        attempts = []
+
+        def create_category():
+            attempts.append(connection.in_atomic_block)
+            Category.objects.create(name=f'Attempt {len(attempts)}')
+            if len(attempts) == 1:
+                raise OperationalError('database is locked')
+            return len(attempts)
+
+        self.assertEqual(write_queue.run(create_category), 2)
+        self.assertEqual(attempts, [True, True])
+        # The failed attempt was rolled back
+        self.assertEqual(list(Category.objects.values_list('name', flat=True)), ['Attempt 2'])
+
+    def test_other_errors_are_not_retried(self):
+        def fail():
+            raise OperationalError('no such table')
+
+        with self.assertRaises(OperationalError):
+            write_queue.run(fail)
+
+
+class QueryPlanTests(CatalogueFixturesMixin, APITestCase):
+    """
+    Runs EXPLAIN on every query the list endpoints issue and fails on full
+    scans of large tables (see `products.query_plans`).
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.user = CustomUser.objects.create_user(email='plans@example.com', password='secret')
+        self.admin = CustomUser.objects.create_user(email='plans-admin@example.com', password='secret', is_staff=True)
+        self.create_orders(self.user, 3)
+
+    def assertNoFullScans(self, url_name, params=None, user=None):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(url_name), params or {})
+        self.assertEqual(response.status_code, 200)
+        scans = captured_full_scans(connection, queries.captured_queries)
+        self.assertEqual(scans, {}, f'{url_name} {params or ""} scans whole tables')
+
+    def test_product_list(self):
+        for ordering in ['', 'price', '-price', 'name', '-name', 'stock', '-stock']:
+            for params in ({}, {'cursor': ''}):
+                with self.subTest(ordering=ordering, **params):
+                    self.assertNoFullScans('products:list-product', {'ordering': ordering, **params} if ordering else params)
+        category = Product.objects.first().category_id
+        self.assertNoFullScans('products:list-product', {'category': category, 'in_stock': 'true', 'ordering': 'price'})
+        self.assertNoFullScans('products:list-product', {'facets': 'true', 'in_stock': 'true', 'min_price': 0})
+
+    def test_product_listing(self):
+        for ordering in ['', 'price', '-price', 'name', '-name']:
+            for params in ({}, {'cursor': ''}):
+                with self.subTest(ordering=ordering, **params):
+                    self.assertNoFullScans('products:list-product-listing', {'ordering': ordering, **params} if ordering else params)
+
+    def test_category_list(self):
+        self.assertNoFullScans('products:list-category')
+
+    def test_order_lists(self):
+        self.assertNoFullScans('products:list-order', user=self.user)
+        self.assertNoFullScans('products:list-order', {'cursor': ''}, user=self.user)
+        self.assertNoFullScans('products:list-order', {'cursor': ''}, user=self.admin)
+        self.assertNoFullScans('products:list-order-item', {'cursor': ''}, user=self.admin)
+
+    def test_limit_only_excuses_scans_that_stop_at_the_page(self):
+        table = Product._meta.db_table
+        self.assertEqual(full_scans(connection, f'SELECT "{table}"."id" FROM "{table}" LIMIT 20'), [])
+        self.assertEqual(full_scans(connection, f'SELECT "{table}"."id" FROM "{table}" ORDER BY "{table}"."id" DESC LIMIT 20'), [])
+        filtered = f'SELECT "{table}"."id" FROM "{table}" WHERE "{table}"."description" = \'x\' LIMIT 20'
+        self.assertEqual(len(full_scans(connection, filtered)), 1)
+        self.assertEqual(len(full_scans(connection, f'SELECT id FROM {table} WHERE description = \'x\' LIMIT 20')), 1)
+
+    def test_partial_indexes_serve_their_queries(self):
+        category = Product.objects.first().category
+        in_stock = Product.objects.filter(category=category, stock__gt=0).order_by('price', 'id')[:20]
+        self.assertIn('product_in_stock_idx', in_stock.explain())
+        queued = Payment.objects.filter(status='queued').order_by('id')[:500]
+        self.assertIn('payment_queued_idx', queued.explain())
+
+
+@override_settings(PRODUCT_PRICE_BUCKETS=(50, 100))
+class ProductFacetTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.phones = Category.objects.create(name='Phones')
+        self.kitchen = Category.objects.create(name='Kitchen')
+        self.cheap_phone = self.create_product('Cheap phone', 20, self.phones, stock=3)
+        self.phone = self.create_product('Phone', 80, self.phones, stock=0)
+        self.kettle = self.create_product('Kettle', 40, self.kitchen, stock=2)
+        self.oven = self.create_product('Oven', 300, self.kitchen, stock=1)
+
+    def create_product(self, name, price, category, stock):
+        return Product.objects.create(
+            name=name, description='', image='products/a.png', price=Decimal(price), category=category, stock=stock
+        )
+
+    def stored(self):
+        return {
+            (row.category_id, row.price_bucket, row.in_stock): row.product_count
+            for row in ProductFacet.objects.filter(product_count__gt=0)
+        }
+
+    def assertCountsMatchProducts(self):
+        stored = self.stored()
+        facets.rebuild()
+        self.assertEqual(stored, self.stored())
+
+    def get(self, **params):
+        return self.client.get(reverse('products:list-product'), {'facets': 'true', 'page_size': 10, **params})
+
+    def test_counts_follow_product_writes(self):
+        self.assertEqual(self.stored()[(self.kitchen.pk, 2, True)], 1)
+        self.phone.stock = 4
+        self.phone.save()
+        self.kettle.category, self.kettle.price = self.phones, Decimal('60')
+        self.kettle.save()
+        self.oven.delete()
+        self.assertCountsMatchProducts()
+
+        stock.commit(Cart.objects.create(), {self.cheap_phone.pk: 3, self.phone.pk: 1})
+        self.assertEqual(self.stored()[(self.phones.pk, 0, False)], 1)
+        self.assertCountsMatchProducts()
+
+        content = f'id,name,description,price,stock,category,image\n{self.phone.pk},Phone,,20,0,Kitchen,\n,Toaster,,30,5,Kitchen,\n'
+        bulk.import_products(io.StringIO(content), 'csv')
+        self.assertCountsMatchProducts()
+
+    def test_filters_and_facets(self):
+        response = self.get(category=self.kitchen.pk, in_stock='true', max_price=100)
+        self.assertEqual([item['name'] for item in response.data['results']], ['Kettle'])
+        self.assertEqual(response.data['facets'], {
+            # Each facet ignores its own filter
+            'category': [
+                {'id': self.kitchen.pk, 'name': 'Kitchen', 'count': 1},
+                {'id': self.phones.pk, 'name': 'Phones', 'count': 1},
+            ],
+            'price': [
+                {'min': '0', 'max': '50', 'count': 1},
+                {'min': '50', 'max': '100', 'count': 0},
+                {'min': '100', 'max': None, 'count': 1},
+            ],
+        })
+
+    def test_stored_counts_match_live_counts(self):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            stored = self.get(in_stock='true', min_price=0, max_price=100).data['facets']
+        self.assertFalse([q['sql'] for q in queries.captured_queries if 'GROUP BY "products_product"' in q['sql']])
+        # An unaligned bound is counted over the products instead
+        live = self.get(in_stock='true', min_price=0, max_price='100.01').data['facets']
+        self.assertEqual(stored['price'], live['price'])
+        self.assertEqual(stored['category'], live['category'])
+        searched = self.get(search='phone').data['facets']
+        self.assertEqual([c['count'] for c in searched['category']], [2])
+
+    def test_invalid_filters_are_rejected(self):
+        self.assertEqual(self.get(min_price='cheap').status_code, 400)
+        self.assertEqual(self.get(category='phones').status_code, 400)
+
+
+class ProductListingTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.phones = Category.objects.create(name='Phones')
+        self.products = self.create_products(3, self.phones)
+
+    def listing(self, product):
+        return ProductListing.objects.get(pk=product.pk)
+
+    def test_listings_follow_writes(self):
+        product = self.products[0]
+        self.assertEqual((self.listing(product).name, self.listing(product).category_name), ('Product 0', 'Phones'))
+        product.name, product.price = 'Renamed', Decimal('99.00')
+        product.save()
+        self.phones.name = 'Mobiles'
+        self.phones.save()
+        self.assertEqual(
+            ProductListing.objects.filter(pk=product.pk).values_list('name', 'price', 'category_name').get(),
+            ('Renamed', Decimal('99.00'), 'Mobiles'),
+        )
+
+        stock.commit(Cart.objects.create(), {product.pk: 5})
+        self.assertFalse(self.listing(product).in_stock)
+        self.products[1].delete()
+        self.assertFalse(ProductListing.objects.filter(pk=self.products[1].pk).exists())
+
+    def test_thumbnail_prefers_a_variant(self):
+        product = self.products[0]
+        self.assertEqual(self.listing(product).thumbnail, '/media/products/placeholder.png')
+        variants = {'160': 'products/variants/p-160w.webp', '640': 'products/variants/p-640w.webp'}
+        Product.objects.filter(pk=product.pk).update(
+            image_variants={'source': product.image.name, 'webp': variants, 'jpeg': {}}
+        )
+        listings.refresh([product.pk])
+        self.assertEqual(self.listing(product).thumbnail, '/media/products/variants/p-640w.webp')
+
+    def test_rebuild_restores_drifted_rows(self):
+        ProductListing.objects.filter(pk=self.products[0].pk).delete()
+        ProductListing.objects.filter(pk=self.products[1].pk).update(name='Stale')
+        ProductListing.objects.create(
+            id=10 ** 6, name='Gone', price=1, category_id=self.phones.pk, category_name='Phones',
+            in_stock=True, updated_at=timezone.now(),
+        )
+        call_command('rebuild_product_listings', batch_size=2, stdout=io.StringIO())
+        self.assertEqual(
+            list(ProductListing.objects.order_by('id').values_list('id', 'name')),
+            [(product.pk, product.name) for product in self.products],
+        )
+
+    def test_listing_endpoint(self):
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('products:list-product-listing'), {'ordering': 'price', 'cursor': ''})
+        first = response.data['results'][0]
+        self.assertEqual(first, {
+            'id': self.products[0].pk,
+            'name': 'Product 0',
+            'price': '10.00',
+            'category': {'id': self.phones.pk, 'name': 'Phones'},
+            'thumbnail': 'http://testserver/media/products/placeholder.png',
+            'in_stock': True,
+        })
+        self.assertEqual(self.client.get(reverse('products:list-product-listing'), {'ordering': 'stock'}).status_code, 400)
+
+
+class FragmentCacheTests(CatalogueFixturesMixin, APITestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = self.create_products(3)
+
+    def get_list(self):
+        # Every write bumps 'products', so each request rebuilds the page
+        response = self.client.get(reverse('products:list-product'), {'page_size': 10})
+        self.assertEqual(response['X-Cache'], 'MISS')
+        return response
+
+    def test_only_changed_products_are_serialised_again(self):
+        to_representation = ProductSerializer.to_representation
+        with mock.patch.object(ProductSerializer, 'to_representation', autospec=True, side_effect=to_representation) as serialize:
+            first = self.get_list()
+            self.assertEqual(serialize.call_count, 3)
+            product = self.products[1]
+            product.name = 'Renamed'
+            product.save()
+            second = self.get_list()
+            self.assertEqual(serialize.call_count, 4)
+            product.category.name = 'Mobiles'
+            product.category.save()
+            third = self.get_list()
+            self.assertEqual(serialize.call_count, 7)
+
+        self.assertEqual(json.loads(first.content)['results'][1]['name'], 'Product 1')
+        self.assertEqual(json.loads(second.content)['results'][1]['name'], 'Renamed')
+        self.assertEqual({item['category']['name'] for item in json.loads(third.content)['results']}, {'Mobiles'})
+
+    def test_spliced_body_matches_the_serializer(self):
+        self.get_list()
+        product = self.products[0]
+        product.stock = 0
+        product.save()
+        response = self.get_list()
+        expected = [
+            ProductSerializer(product, context={'request': response.wsgi_request}).data
+            for product in Product.objects.order_by('-id')
+        ]
+        # Two cached fragments and one new one, spliced into the page
+        self.assertEqual(json.loads(response.content)['results'], json.loads(json.dumps(expected)))
+        self.assertEqual(response.data['results'][2]['stock'], 0)
+
+    def test_fragments_read_from_replicas_are_not_cached(self):
+        keys = fragment_keys(ProductSerializer(), self.products)
+        fragments = caches[settings.CATALOGUE_CACHE_ALIAS]
+        with override_settings(DATABASE_REPLICAS=['replica1']), replicas.read_from_replicas():
+            ProductSerializer(self.products, many=True).data
+        self.assertEqual(fragments.get_many(keys), {})
+        ProductSerializer(self.products, many=True).data
+        self.assertEqual(len(fragments.get_many(keys)), 3)
+
+    def test_fragments_read_like_dicts_and_cache_as_bytes(self):
+        fragment = Fragment(b'{"id":1,"name":"Phone"}')
+        self.assertEqual(fragment, {'id': 1, 'name': 'Phone'})
+        self.assertEqual(pickle.loads(pickle.dumps(fragment)).json, fragment.json)
@@ -1,18 +1,23 @@
-from django.conf import settings
-from django.conf.urls.static import static
 from django.urls import path
 from . import views
-from .views import ProductCreateView, ProductListView, ProductDetailView, ProductUpdateView, ProductDeleteView, CartItemListView, CartItemCreateView, CartItemDeleteView, CartItemUpdateView, OrderCreateView, OrderListView, OrderDetailView, OrderUpdateView, OrderDeleteView, ContactInfoCreateView, ContactInfoListView, ContactInfoDetailView, ContactInfoUpdateView, ContactInfoDeleteView, ProfileListView, ProfileCreateView, ProfileDetailView, ProfileUpdateView, ProfileDeleteView, CategoryCreateView, CategoryListView, CategoryDetailView, CategoryUpdateView, CategoryDeleteView, OrderItemCreateView, OrderItemListView, OrderItemDetailView, OrderItemUpdateView, OrderItemDeleteView, CartCreateView, CartListView, CartDetailView, CartUpdateView, CartDeleteView
+from .views import ProductCreateView, ProductListView, ProductListingView, ProductDetailView, ProductUpdateView, ProductDeleteView, ProductSearchView, ProductImportView, ProductExportView, CatalogueCacheStatsView, CartItemListView, CartContentsView, CartContentsItemView, CartBatchView, CartClaimView, CartItemCreateView, CartItemDeleteView, CartItemUpdateView, OrderCreateView, OrderListView, OrderDetailView, OrderUpdateView, OrderDeleteView, CheckoutView, ContactInfoCreateView, ContactInfoListView, ContactInfoDetailView, ContactInfoUpdateView, ContactInfoDeleteView, ProfileListView, ProfileCreateView, ProfileDetailView, ProfileUpdateView, ProfileDeleteView, CategoryCreateView, CategoryListView, CategoryDetailView, CategoryUpdateView, CategoryDeleteView, OrderItemCreateView, OrderItemListView, OrderItemDetailView, OrderItemUpdateView, OrderItemDeleteView, CartCreateView, CartListView, CartDetailView, CartUpdateView, CartDeleteView, PaymentCreateView, PaymentDetailView
 app_name = 'products'
 
 urlpatterns = [
     path('', views.index, name='index'),
     path('daraja/stk-push', views.stk_push_callback, name='mpesa_stk_push_callback'),
+    path('payment/create/', PaymentCreateView.as_view(), name='create-payment'),
+    path('payment/detail/<int:pk>/', PaymentDetailView.as_view(), name='detail-payment'),
 
     
     
     path('create/', ProductCreateView.as_view(), name='create-product'),
     path('list/', ProductListView.as_view(), name='list-product'),
+    path('listing/', ProductListingView.as_view(), name='list-product-listing'),
+    path('search/', ProductSearchView.as_view(), name='search-product'),
+    path('import/', ProductImportView.as_view(), name='import-product'),
+    path('export/', ProductExportView.as_view(), name='export-product'),
+    path('cache/stats/', CatalogueCacheStatsView.as_view(), name='catalogue-cache-stats'),
     path('detail/<int:pk>/', ProductDetailView.as_view(), name='detail-product'),
     path('update/<int:pk>/', ProductUpdateView.as_view(), name='update-product'),
     path('delete/<int:pk>/', ProductDeleteView.as_view(), name='delete-product'),
@@ -33,6 +38,10 @@ urlpatterns = [
     path('cart/detail/<int:pk>/', CartDetailView.as_view(), name='detail-cart'),
     path('cart/update/<int:pk>/', CartUpdateView.as_view(), name='update-cart'),
     path('cart/delete/<int:pk>/', CartDeleteView.as_view(), name='delete-cart'),
+    path('cart/<int:pk>/items/', CartContentsView.as_view(), name='cart-contents'),
+    path('cart/<int:pk>/items/<int:product_id>/', CartContentsItemView.as_view(), name='cart-contents-item'),
+    path('cart/<int:pk>/items/batch/', CartBatchView.as_view(), name='cart-contents-batch'),
+    path('cart/claim/', CartClaimView.as_view(), name='claim-cart'),
 
     path('profile/', ProfileListView.as_view(), name='profile'),
     path('profile/create/', ProfileCreateView.as_view(), name='create-profile'),
@@ -41,6 +50,7 @@ urlpatterns = [
     path('profile/delete/<int:pk>/', ProfileDeleteView.as_view(), name='delete-profile'),
 
     path('order/create/', OrderCreateView.as_view(), name='create-order'),
+    path('order/checkout/', CheckoutView.as_view(), name='checkout'),
     path('order/list/', OrderListView.as_view(), name='list-order'),
     path('order/detail/<int:pk>/', OrderDetailView.as_view(), name='detail-order'),
     path('order/update/<int:pk>/', OrderUpdateView.as_view(), name='update-order'),
@@ -58,8 +68,3 @@ urlpatterns = [
     path('order-item/update/<int:pk>/', OrderItemUpdateView.as_view(), name='update-order-item'),
     path('order-item/delete/<int:pk>/', OrderItemDeleteView.as_view(), name='delete-order-item'),
 ]
-
-
-
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -1,16 +1,40 @@
+import json
+import os
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.urls import path
 from django_filters import rest_framework as filters
-from rest_framework import filters
 from . import views
 from rest_framework.generics import CreateAPIView, ListAPIView, RetrieveAPIView, UpdateAPIView, DestroyAPIView
-from .models import Product, Category, Cart, CartItem, ContactInfo, Profile, Order, OrderItem
-from .serializers import ProductSerializer, CategorySerializer, CartSerializer, CartItemSerializer, ContactInfoSerializer, ProfileSerializer, OrderSerializer, OrderItemSerializer
+from rest_framework.views import APIView
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.parsers import MultiPartParser
+from rest_framework.response import Response
+from rest_framework import status
+from rest_framework.utils.urls import replace_query_param
+from .models import Product, ProductListing, Category, Cart, CartItem, ContactInfo, Profile, Order, OrderItem, Payment
+from .serializers import ProductSerializer, ProductListingSerializer, CategorySerializer, CartSerializer, CartCreateSerializer, CartItemSerializer, ContactInfoSerializer, ProfileSerializer, OrderSerializer, OrderItemSerializer, PaymentSerializer, CheckoutSerializer, CartContentsSerializer, CartStoreItemSerializer, CartStoreQuantitySerializer, CartBatchLineSerializer, CartClaimSerializer
 from rest_framework import permissions 
-from django_daraja.mpesa.core import MpesaClient
-from .pagination import SmallSetPagination
+from django_daraja.mpesa.utils import format_phone_number
+from .pagination import CatalogPagination, KeysetPagination, MAX_PAGE_SIZE
+from .filters import DeclaredOrderingFilter, FullTextSearchFilter, ProductFilter
+from .fragments import FragmentJSONRenderer
+from .search import get_search_backend
 from .permissions import IsAdminUserorReadOnly
+from .mixins import EagerLoadingViewMixin, OwnedQuerysetMixin, CachedResponseMixin, ConditionalGetMixin, ReplicaReadMixin, QueuedWriteMixin
+from . import cache as response_cache
+from . import payments
+from . import bulk
+from . import facets
+from . import write_queue
+from . import stock
+from .checkout import checkout, CheckoutError
+from .carts import claim, get_cart_store, holds_token
+from django.db import transaction
+from rest_framework.exceptions import NotFound, ValidationError
+from django.shortcuts import get_object_or_404
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page
 from rest_framework import permissions
@@ -20,20 +44,39 @@ from django_filters.rest_framework import DjangoFilterBackend
 
 # Create your views here.
 def index(request):
-    cl = MpesaClient()
     # Use a Safaricom phone number that you have access to, for you to be able to view the prompt.
     phone_number = '0793058968'
     amount = 1
     account_reference = 'reference'
     transaction_desc = 'Description'
-    callback_url = 'https://api.darajambili.com/express-payment';
-    response = cl.stk_push(phone_number, amount, account_reference, transaction_desc, callback_url)
-    return HttpResponse(response)
-
+    # The push itself runs on a payment worker; this only queues it
+    payment = Payment.objects.create(
+        phone_number=format_phone_number(phone_number),
+        amount=amount,
+        account_reference=account_reference,
+        transaction_desc=transaction_desc,
+    )
+    payments.enqueue(payment)
+    return HttpResponse(f"STK push queued as payment {payment.pk}", status=202)
+
+@csrf_exempt
+@require_POST
 def stk_push_callback(request):
-        data = request.body
-        
-        return HttpResponse("STK Push in Django👋")
+    """
+    Receive an STK push result from Daraja.
+
+    The result is only appended to the callback queue and acknowledged; it is
+    applied to its payment by the callback drain running on the payment workers.
+    Results not posted with the callback token, or from outside the allowed
+    addresses, are refused.
+    """
+    if not payments.is_authentic_callback(request):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Rejected'}, status=403)
+    try:
+        payments.ingest_callback(json.loads(request.body))
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({'ResultCode': 1, 'ResultDesc': 'Rejected'}, status=400)
+    return JsonResponse({'ResultCode': 0, 'ResultDesc': 'Accepted'})
 
 
 class ProductCreateView(CreateAPIView):
@@ -53,32 +96,201 @@ class ProductCreateView(CreateAPIView):
         """
         serializer.save()
 
-class ProductListView(ListAPIView):
+class ProductImportView(APIView):
+    """
+    APIView for bulk-loading products from an uploaded CSV or JSONL file.
+
+    HTTP Methods:
+    - POST: Create or update products from the `file` upload.
+
+    Parameters:
+    - `format` (str): 'csv' or 'jsonl'; defaults to the file extension.
+    - `chunk_size` (int): Rows written per transaction.
+
+    Response:
+    - 200 OK: Returns counts of created, updated and failed rows, with errors by line.
+    - 400 Bad Request: No file, or an unknown format.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    parser_classes = [MultiPartParser]
+
+    def post(self, request, *args, **kwargs):
+        upload = request.FILES.get('file')
+        if upload is None:
+            raise ValidationError({'file': 'Upload a CSV or JSONL file.'})
+        format = request.data.get('format') or os.path.splitext(upload.name)[1].lstrip('.').lower()
+        if format not in bulk.FORMATS:
+            raise ValidationError({'format': f'Use one of {", ".join(bulk.FORMATS)}.'})
+        try:
+            chunk_size = max(int(request.data.get('chunk_size', bulk.IMPORT_CHUNK_SIZE)), 1)
+        except ValueError:
+            raise ValidationError({'chunk_size': 'A whole number is required.'})
+        result = bulk.import_products(upload, format, chunk_size=chunk_size)
+        return Response(result.as_dict())
+
+class ProductExportView(APIView):
+    """
+    APIView streaming the whole catalogue as CSV or JSONL.
+
+    HTTP Methods:
+    - GET: Download every product.
+
+    Parameters:
+    - `format` (str): 'csv' (default) or 'jsonl'.
+
+    Response:
+    - 200 OK: A streamed file attachment.
+    - 400 Bad Request: Unknown format.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    content_types = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+    def get(self, request, *args, **kwargs):
+        # `format` is taken by DRF's format suffixes, so the choice is `?type=`
+        format = request.query_params.get('type', 'csv')
+        if format not in bulk.FORMATS:
+            raise ValidationError({'type': f'Use one of {", ".join(bulk.FORMATS)}.'})
+        response = StreamingHttpResponse(bulk.export_lines(format), content_type=self.content_types[format])
+        response['Content-Disposition'] = f'attachment; filename="products.{format}"'
+        return response
+
+class ProductListView(ReplicaReadMixin, ConditionalGetMixin, CachedResponseMixin, EagerLoadingViewMixin, ListAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    pagination_class = SmallSetPagination
+    pagination_class = CatalogPagination
     permission_classes = [permissions.AllowAny]
-    filter_backends = [filters.SearchFilter, filters.OrderingFilter]
-    search_fields = ['name']
-    ordering_fields = '__all__'
+    # Copies the cached product fragments into the body as they are
+    renderer_classes = [FragmentJSONRenderer, BrowsableAPIRenderer]
+    filter_backends = [FullTextSearchFilter, DjangoFilterBackend, DeclaredOrderingFilter]
+    # `?name=` searches product names only, `?search=` every indexed column
+    search_param_fields = {'name': ['name']}
+    filterset_class = ProductFilter
+    # `?ordering=` names, each matching an index on Product (see `Product.Meta.indexes`)
+    orderings = {
+        'id': ['id'],
+        'price': ['price', 'id'],
+        'name': ['name', 'id'],
+        'stock': ['stock', 'id'],
+    }
+    ordering = '-id'
+    cache_scopes = ['products']
+    last_modified_fields = ['updated_at', 'category__updated_at']
 
     def get_queryset(self):
         """
-        Custom queryset to filter products by name.
+        Custom queryset ordered by newest product first.
 
         Returns:
-        - Queryset: Filtered queryset based on query parameters.
+        - Queryset: Products, filtered later by the search, facet and ordering backends.
         """
-        queryset = Product.objects.all().order_by("-id")
-        name = self.request.query_params.get('name', None)
-        if name is not None:
-            queryset = queryset.filter(name__icontains=name)
-        return queryset
+        return super().get_queryset().order_by("-id")
 
+    def facets_requested(self):
+        return self.request.query_params.get('facets') in ('1', 'true')
 
-class ProductDetailView(RetrieveAPIView):
+    def get_validator_queryset(self):
+        # Facet counts cover products outside the filtered page
+        if self.facets_requested():
+            return self.get_queryset()
+        return super().get_validator_queryset()
+
+    def list(self, request, *args, **kwargs):
+        """
+        Lists products; with `?facets=true` the response also carries
+        `facets`, the product counts per category and per price bucket under
+        the other filters (see `products.facets`).
+        """
+        response = super().list(request, *args, **kwargs)
+        if self.facets_requested():
+            response.data['facets'] = self.get_facets()
+        return response
+
+    def get_facets(self):
+        filterset = DjangoFilterBackend().get_filterset(self.request, self.get_queryset(), self)
+        filterset.is_valid()
+        searched = None
+        if any(self.request.query_params.get(param) for param in ['search', *self.search_param_fields]):
+            searched = FullTextSearchFilter().filter_queryset(self.request, self.get_queryset(), self)
+        return facets.counts(**filterset.form.cleaned_data, queryset=searched)
+
+
+class ProductListingView(ReplicaReadMixin, ConditionalGetMixin, CachedResponseMixin, ListAPIView):
+    """
+    ListAPIView for catalogue pages, read from the `ProductListing` read model.
+
+    HTTP Methods:
+    - GET: List product cards: id, name, price, category, thumbnail URL and in-stock flag.
+
+    Query Parameters:
+    - `ordering`: One of `id`, `price` or `name`, optionally prefixed with "-" (default `-id`).
+    - `cursor`, `page`, `page_size`: As for the product list.
+
+    Response:
+    - Paginated product cards. Full product fields stay on the product list and detail endpoints.
+    """
+    queryset = ProductListing.objects.all()
+    serializer_class = ProductListingSerializer
+    pagination_class = CatalogPagination
+    permission_classes = [permissions.AllowAny]
+    filter_backends = [DeclaredOrderingFilter]
+    # `?ordering=` names, each matching an index on ProductListing
+    orderings = {
+        'id': ['id'],
+        'price': ['price', 'id'],
+        'name': ['name', 'id'],
+    }
+    ordering = '-id'
+    cache_scopes = ['products']
+
+
+class ProductSearchView(ReplicaReadMixin, APIView):
+    """
+    APIView for ranked full-text product search.
+
+    HTTP Methods:
+    - GET: Search products by name, category name and description.
+
+    Query Parameters:
+    - `q`: Search text. Every term is prefix matched and small typos are tolerated.
+    - `page_size`: Number of results to return (default 20, capped at 100).
+    - `offset`: Number of results to skip.
+
+    Response:
+    - 200 OK: Returns matching products, best match first.
+    """
+    permission_classes = [permissions.AllowAny]
+    renderer_classes = [FragmentJSONRenderer, BrowsableAPIRenderer]
+    page_size = 20
+
+    def get(self, request):
+        text = request.query_params.get('q', '').strip()
+        limit = self.get_int_param('page_size', self.page_size, MAX_PAGE_SIZE)
+        offset = self.get_int_param('offset', 0)
+
+        # One extra id tells us whether there is a next page
+        ids = get_search_backend().search(text, limit=limit + 1, offset=offset) if text else []
+        products = ProductSerializer.setup_eager_loading(Product.objects.all()).in_bulk(ids[:limit])
+        results = [products[pk] for pk in ids[:limit] if pk in products]
+
+        next_url = None
+        if len(ids) > limit:
+            next_url = replace_query_param(request.build_absolute_uri(), 'offset', offset + limit)
+        serializer = ProductSerializer(results, many=True, context={'request': request})
+        return Response({'next': next_url, 'results': serializer.data})
+
+    def get_int_param(self, name, default, cutoff=None):
+        try:
+            value = max(int(self.request.query_params[name]), 0)
+        except (KeyError, ValueError):
+            return default
+        return min(value, cutoff) if cutoff else value
+
+
+class ProductDetailView(ReplicaReadMixin, ConditionalGetMixin, CachedResponseMixin, EagerLoadingViewMixin, RetrieveAPIView):
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
+    cache_scopes = ['product:{pk}']
+    last_modified_fields = ['updated_at', 'category__updated_at']
     
 
 class ProductUpdateView(UpdateAPIView):
@@ -97,6 +309,21 @@ class ProductDeleteView(DestroyAPIView):
     def perform_destroy(self, instance):
         instance.delete()
 
+class CatalogueCacheStatsView(APIView):
+    """
+    APIView reporting catalogue response cache effectiveness.
+
+    HTTP Methods:
+    - GET: Retrieve cumulative cache hit and miss counters.
+
+    Response:
+    - 200 OK: Returns `hits` and `misses`.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(response_cache.stats())
+
 class CategoryCreateView(CreateAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
@@ -105,14 +332,16 @@ class CategoryCreateView(CreateAPIView):
     def perform_create(self, serializer):
         serializer.save()
 
-class CategoryListView(ListAPIView):
+class CategoryListView(ReplicaReadMixin, ConditionalGetMixin, CachedResponseMixin, ListAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_scopes = ['categories']
     # permission_classes = [IsAdminUserorReadOnly]
 
-class CategoryDetailView(RetrieveAPIView):
+class CategoryDetailView(ReplicaReadMixin, ConditionalGetMixin, CachedResponseMixin, RetrieveAPIView):
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
+    cache_scopes = ['category:{pk}']
     # permission_classes = [IsAdminUserorReadOnly]
 
 class CategoryUpdateView(UpdateAPIView):
@@ -161,11 +390,11 @@ class CartCreateView(CreateAPIView):
     - JSON object containing cart details.
 
     Response:
-    - 201 Created: Cart created successfully.
+    - 201 Created: Cart created successfully, with the `token` needed to use it anonymously.
     - 400 Bad Request: Invalid data provided.
     """
     queryset = Cart.objects.all()
-    serializer_class = CartSerializer
+    serializer_class = CartCreateSerializer
     # permission_classes = [permissions.IsAuthenticated]
 
     def perform_create(self, serializer):
@@ -180,7 +409,7 @@ class CartCreateView(CreateAPIView):
         """
         serializer.save()
 
-class CartListView(ListAPIView):
+class CartListView(ReplicaReadMixin, EagerLoadingViewMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of carts.
 
@@ -194,7 +423,7 @@ class CartListView(ListAPIView):
     serializer_class = CartSerializer
     # permission_classes = [permissions.IsAuthenticated]
 
-class CartDetailView(RetrieveAPIView):
+class CartDetailView(ReplicaReadMixin, EagerLoadingViewMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific cart.
 
@@ -267,7 +496,167 @@ class CartDeleteView(DestroyAPIView):
         """
         instance.delete()
 
-class CartItemCreateView(CreateAPIView):
+class CartContentsView(APIView):
+    """
+    APIView for reading and changing a cart through the configured cart store.
+
+    HTTP Methods:
+    - GET: Retrieve the cart's lines and total.
+    - POST: Add units of a product to the cart.
+
+    Request Data:
+    - JSON object with the `product` and the `quantity` to add.
+    - Anonymous carts need their token in the `X-Cart-Token` header.
+
+    Response:
+    - 200 OK: Returns the cart's lines, item count and total.
+    - 400 Bad Request: Invalid data provided or insufficient stock.
+    - 404 Not Found: Cart not found, or the token does not match.
+    """
+    # Anonymous carts are open to whoever holds their token; owned carts are checked below
+    permission_classes = [permissions.AllowAny]
+
+    def get_cart_id(self):
+        """
+        Return the id of the requested cart after checking its owner, or its
+        token if it has none.
+
+        Returns:
+        - int: The cart id.
+        """
+        cart = get_object_or_404(Cart.objects.only('id', 'user_id', 'token'), pk=self.kwargs['pk'])
+        user = self.request.user
+        if cart.user_id is None:
+            if not user.is_staff and not holds_token(cart, self.request.headers.get('X-Cart-Token')):
+                raise NotFound()
+        elif cart.user_id != user.pk and not user.is_staff:
+            raise NotFound()
+        return cart.pk
+
+    def get(self, request, *args, **kwargs):
+        """
+        Return the cart's lines and total.
+        """
+        return self.respond(self.get_cart_id())
+
+    def respond(self, cart_id):
+        return Response(CartContentsSerializer(get_cart_store().summary(cart_id)).data)
+
+    def post(self, request, *args, **kwargs):
+        """
+        Add units of a product to the cart.
+        """
+        cart_id = self.get_cart_id()
+        serializer = CartStoreItemSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        self.apply(get_cart_store().add, cart_id, serializer.validated_data)
+        return self.respond(cart_id)
+
+    def apply(self, change, cart_id, data):
+        try:
+            change(cart_id, data['product'].pk, data['quantity'])
+        except stock.InsufficientStock as ex:
+            raise ValidationError({'quantity': str(ex)})
+
+class CartContentsItemView(CartContentsView):
+    """
+    APIView for changing one product's line in a cart through the cart store.
+
+    HTTP Methods:
+    - PUT/PATCH: Set the product's quantity; 0 removes it.
+    - DELETE: Remove the product from the cart.
+
+    Request Data:
+    - JSON object with the new `quantity`.
+
+    Response:
+    - 200 OK: Returns the cart's lines, item count and total.
+    - 400 Bad Request: Invalid data provided or insufficient stock.
+    - 404 Not Found: Cart or product not found.
+    """
+    http_method_names = ['put', 'patch', 'delete', 'options']
+
+    def put(self, request, *args, **kwargs):
+        """
+        Set the product's quantity in the cart.
+        """
+        cart_id = self.get_cart_id()
+        serializer = CartStoreQuantitySerializer(data={**request.data, 'product': kwargs['product_id']})
+        serializer.is_valid(raise_exception=True)
+        self.apply(get_cart_store().set, cart_id, serializer.validated_data)
+        return self.respond(cart_id)
+
+    patch = put
+
+    def delete(self, request, *args, **kwargs):
+        """
+        Remove the product from the cart.
+        """
+        cart_id = self.get_cart_id()
+        get_cart_store().remove(cart_id, kwargs['product_id'])
+        return self.respond(cart_id)
+
+class CartBatchView(CartContentsView):
+    """
+    APIView for setting many cart lines in one request.
+
+    HTTP Methods:
+    - POST: Upsert a list of lines; existing lines for the same products are replaced.
+
+    Request Data:
+    - JSON list of objects with a `product` and a `quantity`.
+
+    Response:
+    - 200 OK: Returns the cart's lines, item count and total.
+    - 400 Bad Request: Unknown products, invalid quantities or insufficient stock.
+    - 404 Not Found: Cart not found.
+    """
+    http_method_names = ['post', 'options']
+
+    def post(self, request, *args, **kwargs):
+        """
+        Upsert the lines in the request body.
+        """
+        cart_id = self.get_cart_id()
+        serializer = CartBatchLineSerializer(data=request.data, many=True, allow_empty=False)
+        serializer.is_valid(raise_exception=True)
+        quantities = {}
+        for line in serializer.validated_data:
+            quantities[line['product']] = quantities.get(line['product'], 0) + line['quantity']
+        try:
+            get_cart_store().set_many(cart_id, quantities)
+        except stock.InsufficientStock as ex:
+            raise ValidationError({'quantity': str(ex)})
+        return self.respond(cart_id)
+
+class CartClaimView(APIView):
+    """
+    APIView for taking over an anonymous cart after logging in.
+
+    HTTP Methods:
+    - POST: Merge the anonymous cart into the user's latest cart, or make it theirs.
+
+    Request Data:
+    - JSON object with the anonymous `cart` id and its `token`.
+
+    Response:
+    - 200 OK: Returns the user's cart lines, item count and total.
+    - 404 Not Found: No anonymous cart with that id and token.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Claim the anonymous cart for the current user.
+        """
+        serializer = CartClaimSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        cart_id = claim(serializer.validated_data['cart'], serializer.validated_data['token'], request.user)
+        if cart_id is None:
+            raise NotFound()
+        return Response(CartContentsSerializer(get_cart_store().summary(cart_id)).data)
+
+class CartItemCreateView(QueuedWriteMixin, CreateAPIView):
     """
     CreateAPIView for creating a new cart item.
 
@@ -297,7 +686,7 @@ class CartItemCreateView(CreateAPIView):
         """
         serializer.save()
 
-class CartItemListView(ListAPIView):
+class CartItemListView(ReplicaReadMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of cart items.
 
@@ -312,7 +701,7 @@ class CartItemListView(ListAPIView):
     # permission_classes = [permissions.IsAuthenticated]
 
     
-class CartItemDetailView(RetrieveAPIView):
+class CartItemDetailView(ReplicaReadMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific cart item.
 
@@ -378,7 +767,8 @@ class CartItemDeleteView(DestroyAPIView):
 
     def perform_destroy(self, instance):
         """
-        Perform the deletion of an existing cart item instance.
+        Perform the deletion of an existing cart item instance and release
+        the stock its cart holds for the product.
 
         Parameters:
         - `instance` (CartItem): The existing cart item instance to delete.
@@ -386,7 +776,9 @@ class CartItemDeleteView(DestroyAPIView):
         Returns:
         - None
         """
-        instance.delete()
+        with transaction.atomic():
+            stock.release(instance.cart, [instance.product_id])
+            instance.delete()
 
 class ContactInfoCreateView(CreateAPIView):
     """
@@ -419,7 +811,7 @@ class ContactInfoCreateView(CreateAPIView):
         """
         serializer.save()
 
-class ContactInfoListView(ListAPIView):
+class ContactInfoListView(ReplicaReadMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of contact infos.
 
@@ -434,7 +826,7 @@ class ContactInfoListView(ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class ContactInfoDetailView(RetrieveAPIView):
+class ContactInfoDetailView(ReplicaReadMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific contact info.
 
@@ -541,7 +933,7 @@ class ProfileCreateView(CreateAPIView):
         """
         serializer.save()
 
-class ProfileListView(ListAPIView):
+class ProfileListView(ReplicaReadMixin, EagerLoadingViewMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of profiles.
 
@@ -556,7 +948,7 @@ class ProfileListView(ListAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class ProfileDetailView(RetrieveAPIView):
+class ProfileDetailView(ReplicaReadMixin, EagerLoadingViewMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific profile.
 
@@ -632,7 +1024,7 @@ class ProfileDeleteView(DestroyAPIView):
         """
         instance.delete()
 
-class OrderCreateView(CreateAPIView):
+class OrderCreateView(QueuedWriteMixin, CreateAPIView):
     """
     CreateAPIView for creating a new order.
 
@@ -663,28 +1055,71 @@ class OrderCreateView(CreateAPIView):
         """
         serializer.save()
 
-class OrderListView(ListAPIView):
+class CheckoutView(APIView):
+    """
+    APIView for turning a cart into an order in a single transaction.
+
+    HTTP Methods:
+    - POST: Create an order, with one item per product, from the cart's lines.
+
+    Request Data:
+    - JSON object with the `cart` to check out.
+
+    Response:
+    - 201 Created: Returns the new order and its items.
+    - 400 Bad Request: Invalid cart, empty cart or insufficient stock.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Check out the requested cart.
+
+        Parameters:
+        - `request` (Request): The request carrying the cart id.
+
+        Returns:
+        - Response: The serialised order.
+        """
+        serializer = CheckoutSerializer(data=request.data, context={'request': request})
+        serializer.is_valid(raise_exception=True)
+        try:
+            order = write_queue.run(checkout, serializer.validated_data['cart'])
+        except CheckoutError as ex:
+            raise ValidationError({'cart': str(ex)})
+        except stock.InsufficientStock as ex:
+            raise ValidationError({'items': str(ex)})
+        order = OrderSerializer.setup_eager_loading(Order.objects.filter(pk=order.pk)).get()
+        return Response(OrderSerializer(order).data, status=status.HTTP_201_CREATED)
+
+class OrderListView(ReplicaReadMixin, OwnedQuerysetMixin, EagerLoadingViewMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of orders.
 
     HTTP Methods:
     - GET: Retrieve a list of orders.
 
+    Non-staff users only see their own orders. Send `?cursor=` to page
+    through them with keyset pagination.
+
     Response:
     - 200 OK: Returns a list of orders.
     """
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
+    pagination_class = KeysetPagination
     permission_classes = [permissions.IsAuthenticated]
 
 
-class OrderDetailView(RetrieveAPIView):
+class OrderDetailView(ReplicaReadMixin, OwnedQuerysetMixin, EagerLoadingViewMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific order.
 
     HTTP Methods:
     - GET: Retrieve details of a specific order.
 
+    Non-staff users can only retrieve their own orders.
+
     Response:
     - 200 OK: Returns details of the requested order.
     - 404 Not Found: Order not found.
@@ -775,7 +1210,8 @@ class OrderItemCreateView(CreateAPIView):
 
     def perform_create(self, serializer):
         """
-        Perform the creation of a new order item instance.
+        Perform the creation of a new order item instance, taking its stock
+        from the order cart's holds.
 
         Parameters:
         - `serializer` (OrderItemSerializer): The serializer instance.
@@ -783,23 +1219,31 @@ class OrderItemCreateView(CreateAPIView):
         Returns:
         - None
         """
-        serializer.save()
+        with transaction.atomic():
+            item = serializer.save()
+            try:
+                stock.commit(item.order.cart, {item.product_id: item.quantity})
+            except stock.InsufficientStock as ex:
+                raise ValidationError({'quantity': str(ex)})
         
-class OrderItemListView(ListAPIView):
+class OrderItemListView(ReplicaReadMixin, EagerLoadingViewMixin, ListAPIView):
     """
     ListAPIView for retrieving a list of order items.
 
     HTTP Methods:
     - GET: Retrieve a list of order items.
 
+    Send `?cursor=` to page through them with keyset pagination.
+
     Response:
     - 200 OK: Returns a list of order items.
     """
     queryset = OrderItem.objects.all()
     serializer_class = OrderItemSerializer
+    pagination_class = KeysetPagination
     permission_classes = [permissions.IsAuthenticated]
     
-class OrderItemDetailView(RetrieveAPIView):
+class OrderItemDetailView(ReplicaReadMixin, EagerLoadingViewMixin, RetrieveAPIView):
     """
     RetrieveAPIView for retrieving details of a specific order item.
 
@@ -872,4 +1316,55 @@ class OrderItemDeleteView(DestroyAPIView):
         Returns:
         - None
         """
-        instance.delete()
\ No newline at end of file
+        instance.delete()
+
+class PaymentCreateView(CreateAPIView):
+    """
+    CreateAPIView for starting an M-Pesa STK push payment.
+
+    HTTP Methods:
+    - POST: Queue an STK push to the given phone number.
+
+    Request Data:
+    - JSON object containing payment details.
+
+    Response:
+    - 202 Accepted: Payment queued; poll the detail endpoint for its status.
+    - 400 Bad Request: Invalid data provided.
+    """
+    queryset = Payment.objects.all()
+    serializer_class = PaymentSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def create(self, request, *args, **kwargs):
+        response = super().create(request, *args, **kwargs)
+        response.status_code = status.HTTP_202_ACCEPTED
+        return response
+
+    def perform_create(self, serializer):
+        """
+        Save the payment as queued and hand it to the payment workers.
+
+        Parameters:
+        - `serializer` (PaymentSerializer): The serializer instance.
+
+        Returns:
+        - None
+        """
+        payment = serializer.save(user=self.request.user)
+        payments.enqueue(payment)
+
+class PaymentDetailView(OwnedQuerysetMixin, RetrieveAPIView):
+    """
+    RetrieveAPIView for polling the status of a payment.
+
+    HTTP Methods:
+    - GET: Retrieve details of a specific payment.
+
+    Response:
+    - 200 OK: Returns details of the requested payment.
+    - 404 Not Found: Payment not found.
+    """
+    queryset = Payment.objects.all()
+    serializer_class = PaymentSerializer
+    permission_classes = [permissions.IsAuthenticated]
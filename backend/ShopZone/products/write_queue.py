@@ -0,0 +1,55 @@
+"""
+Queued database writes for SQLite.
+
+SQLite allows one writer at a time. With `settings.SQLITE_TUNING` on,
+`run` puts the writes of a process in a queue: each write waits for a
+process-wide lock, then runs in its own transaction, which takes the
+database write lock up front (see `products.backends.sqlite3`); writers in
+other processes wait in SQLite's busy handler. A write that still finds the
+database locked after the busy timeout is retried from the start with
+backoff, which is safe because its transaction was rolled back.
+
+On other databases, or without the tuning profile, `run` simply calls the
+function.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+
+MAX_ATTEMPTS = 5
+# Seconds; doubled after each failed attempt, with jitter
+RETRY_DELAY = 0.05
+
+_lock = threading.Lock()
+
+
+def is_queued(using=DEFAULT_DB_ALIAS):
+    return settings.SQLITE_TUNING and connections[using].vendor == 'sqlite'
+
+
+def run(func, *args, using=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Call `func`; on SQLite, in a transaction queued behind the process's other writes.
+
+    Returns:
+    - The return value of `func`.
+
+    Raises:
+    - OperationalError: The database stayed locked for every attempt.
+    """
+    connection = connections[using]
+    # Retrying would re-run only part of an enclosing transaction
+    if not is_queued(using) or connection.in_atomic_block:
+        return func(*args, **kwargs)
+
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            with _lock, transaction.atomic(using=using):
+                return func(*args, **kwargs)
+        except OperationalError as ex:
+            if 'locked' not in str(ex) or attempt == MAX_ATTEMPTS - 1:
+                raise
+        time.sleep(RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))